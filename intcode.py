@@ -1,6 +1,14 @@
+from collections import deque
+from copy import copy
 from dataclasses import dataclass
 from enum import Enum
+from importlib import import_module
+from itertools import product
+from time import monotonic
+from typing import List, Optional
 from intcode_memory import IntcodeMemory
+import intcode_checkpoint
+import intcode_image
 import unittest
 
 @dataclass
@@ -58,23 +66,290 @@ class ParameterMode(Enum):
     IMMEDIATE = 1
     RELATIVE = 2
 
+# Source fragments used to build the specialised instruction handlers below.
+# Reads are indexed by ParameterMode, and '{x}' is the source expression for
+# the argument's raw value.
+READ_TEMPLATES = {
+    ParameterMode.POSITION: "arr[{x}]",
+    ParameterMode.IMMEDIATE: "{x}",
+    ParameterMode.RELATIVE: "arr[{x} + sim.relativeBase]",
+}
+
+WRITE_TEMPLATES = {
+    ParameterMode.POSITION: "{x}",
+    ParameterMode.RELATIVE: "{x} + sim.relativeBase",
+}
+
+# Value written to memory by each instruction that produces a result.
+RESULT_TEMPLATES = {
+    Opcode.ADD: "{a} + {b}",
+    Opcode.MULTIPLY: "{a} * {b}",
+    Opcode.LESS_THAN: "1 if {a} < {b} else 0",
+    Opcode.EQUALS: "1 if {a} == {b} else 0",
+}
+
+# Body of each handler. {a}, {b} are the input arguments and {dest} is the
+# output address; {next} is the address of the following instruction.
+OPCODE_TEMPLATES = {
+    opcode: "arr[{dest}] = " + result + "\nsim.pos = {next}"
+    for opcode, result in RESULT_TEMPLATES.items()
+}
+OPCODE_TEMPLATES.update({
+    # _getInput may stop execution to wait for input, so the instruction
+    # is only completed once it returns.
+    Opcode.INPUT: "value = sim._getInput()\n"
+                  "sim.pos = {next}\n"
+                  "if value is None:\n"
+                  "    sim.finished = True\n"
+                  "else:\n"
+                  "    arr[{dest}] = value",
+    Opcode.OUTPUT: "sim.pos = {next}\n"
+                   "sim._putOutput({a})",
+    Opcode.JUMP_IF_TRUE: "sim.pos = {b} if {a} != 0 else {next}",
+    Opcode.JUMP_IF_FALSE: "sim.pos = {b} if {a} == 0 else {next}",
+    Opcode.ADJUST_RELBASE: "sim.relativeBase += {a}\n"
+                           "sim.pos = {next}",
+    Opcode.END: "sim.pos = {next}\n"
+                "sim.finished = True",
+})
+
+def instructionSource(fullOpcode, operands, pos, inputs=(), result=None):
+    """
+    Generates Python source executing a single instruction. The source expects
+    'sim' (the IntcodeSim) and 'arr' (its memory) to be in scope, and leaves
+    sim.pos pointing at the next instruction to execute.
+
+    :param fullOpcode: The integer opcode, such as 1102
+    :param operands: Source expressions for the raw value of each argument
+    :param pos: Source expression for the address of the instruction
+    :param inputs: Optional source expressions that replace the resolved value
+                   of input arguments (None entries are resolved as normal)
+    :param result: If set, the name of a local variable the instruction's
+                   result should also be stored in
+    :return: tuple of opcode, source, and the source expression for the address
+             written to (None if the instruction does not write to memory)
+    """
+    opcode, parameterModes = IntcodeSim.parseOpcode(fullOpcode)
+    op = opcode.op
+
+    fields = {"next": f"{pos} + {op.args + 1}", "dest": None}
+    for i, mode in enumerate(parameterModes):
+        if i >= op.inputs():
+            if mode not in WRITE_TEMPLATES:
+                raise ValueError("output address arguments cannot be in immediate mode")
+            fields["dest"] = WRITE_TEMPLATES[mode].format(x=operands[i])
+        elif i < len(inputs) and inputs[i] is not None:
+            fields["ab"[i]] = inputs[i]
+        else:
+            fields["ab"[i]] = READ_TEMPLATES[mode].format(x=operands[i])
+
+    template = OPCODE_TEMPLATES[opcode]
+    if result is not None and opcode in RESULT_TEMPLATES:
+        template = (f"{result} = {RESULT_TEMPLATES[opcode]}\n"
+                    f"arr[{{dest}}] = {result}\n"
+                    "sim.pos = {next}")
+
+    return opcode, template.format(**fields), fields["dest"]
+
+def indent(source, level=1):
+    "indent each line of source by the given number of levels"
+    return "".join("    " * level + line + "\n" for line in source.split("\n"))
+
+def buildHandler(fullOpcode):
+    """
+    Generates a function executing a single instruction with the given full
+    opcode (e.g. 1102). The parameter modes are baked into the function's
+    source, so no decoding is needed when it is called.
+
+    The function takes an IntcodeSim and executes the instruction at its
+    current position.
+    """
+    operands = [f"arr[pos + {k}]" for k in (1, 2, 3)]
+    opcode, body, _ = instructionSource(fullOpcode, operands, "pos")
+    source = (
+        "def handler(sim):\n"
+        "    arr = sim.arr\n"
+        "    pos = sim.pos\n"
+        "    sim.lastOpcode = opcode\n"
+        + indent(body)
+    )
+
+    namespace = {"opcode": opcode}
+    exec(compile(source, f"<intcode {fullOpcode}>", "exec"), namespace)
+    return namespace["handler"]
+
+class DispatchTable(dict):
+    """
+    Maps full opcodes (e.g. 1102) to the result of calling builder with them,
+    normally a handler function. Every canonical opcode/parameter mode
+    combination is built up front; anything else (such as opcodes with stray
+    high digits) is decoded and cached on first use.
+    """
+    def __init__(self, builder=buildHandler):
+        super().__init__()
+        self.builder = builder
+        for opcode in Opcode:
+            for modes in product(ParameterMode, repeat=opcode.op.args):
+                fullOpcode = opcode + sum(mode.value * 10 ** (i + 2) for i, mode in enumerate(modes))
+                try:
+                    self[fullOpcode] = builder(fullOpcode)
+                except ValueError:
+                    # Immediate-mode writes: left to __missing__ to raise
+                    pass
+
+    def __missing__(self, fullOpcode):
+        handler = self[fullOpcode] = self.builder(fullOpcode)
+        return handler
+
+
+@dataclass
+class Instruction:
+    """
+    A decoded instruction.
+
+    :param address: Address of the instruction's opcode
+    :param fullOpcode: The integer opcode, including parameter modes (e.g. 1102)
+    :param opcode: The Opcode
+    :param modes: ParameterMode of each argument
+    :param args: Raw value of each argument
+    """
+    address: int
+    fullOpcode: int
+    opcode: Opcode
+    modes: List[ParameterMode]
+    args: List[int]
+
+    @classmethod
+    def decode(cls, arr, address):
+        "decode the instruction at address in arr"
+        fullOpcode = arr[address]
+        opcode, modes = IntcodeSim.parseOpcode(fullOpcode)
+        args = [arr[address + k] for k in range(1, opcode.op.args + 1)]
+        return cls(address, fullOpcode, opcode, modes, args)
+
+    def length(self):
+        "number of memory cells taken up by the instruction"
+        return len(self.args) + 1
+
+    def dest(self):
+        "(mode, arg) of the output address argument, or None"
+        if self.opcode.op.posArgs == 0:
+            return None
+        return self.modes[-1], self.args[-1]
+
+    def readsOf(self, cell):
+        """
+        Returns the indexes of input arguments that read the given (mode, arg)
+        cell, assuming the relative base is unchanged.
+        """
+        mode, arg = cell
+        return [
+            i for i in range(self.opcode.op.inputs())
+            if self.modes[i] == mode and self.args[i] == arg
+        ]
+
+class Fusion(Enum):
+    """
+    Pairs of adjacent instructions that can be executed together as a single
+    superinstruction. The first instruction's result is still written to
+    memory; the second reads it from a local instead.
+
+    COMPARE_BRANCH: LESS_THAN/EQUALS, then a conditional jump on the flag it wrote
+    ADD_COMPARE: ADD, then a LESS_THAN/EQUALS reading the sum
+    RELBASE_ACCESS: ADJUST_RELBASE, then an instruction with a RELATIVE argument
+                    (i.e. the start of a call frame)
+    """
+    COMPARE_BRANCH = 1
+    ADD_COMPARE = 2
+    RELBASE_ACCESS = 3
+
+COMPARISONS = {Opcode.LESS_THAN, Opcode.EQUALS}
+BRANCHES = {Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE}
+
+def findFusion(first: Instruction, second: Instruction) -> Optional[Fusion]:
+    """
+    Returns the Fusion matched by two adjacent decoded instructions, or None
+    if they can't be fused.
+    """
+    dest = first.dest()
+    if dest is not None and dest[0] == ParameterMode.IMMEDIATE:
+        return None
+
+    if first.opcode in COMPARISONS and second.opcode in BRANCHES:
+        if 0 in second.readsOf(dest):
+            return Fusion.COMPARE_BRANCH
+
+    elif first.opcode == Opcode.ADD and second.opcode in COMPARISONS:
+        if second.readsOf(dest):
+            return Fusion.ADD_COMPARE
+
+    elif first.opcode == Opcode.ADJUST_RELBASE:
+        if ParameterMode.RELATIVE in second.modes:
+            return Fusion.RELBASE_ACCESS
+
+    return None
+
+# Execution engines that can be selected by name. Each maps to the module and
+# class implementing it (imported on first use) plus keyword arguments for the
+# class; None is the built-in dispatch table interpreter.
+ENGINES = {
+    "reference": None,
+    "cached": ("intcode_cache", "DecodeCacheEngine", {"fuse": False}),
+    "fused": ("intcode_cache", "DecodeCacheEngine", {"fuse": True}),
+    "memo": ("intcode_memo", "MemoEngine", {}),
+    "compiled": ("intcode_compiler", "CompilingEngine", {}),
+}
+
+class Status(Enum):
+    """
+    Why a machine stopped running (see IntcodeSim.runUntilIO).
+
+    NEEDS_INPUT: the program is waiting for input, and none is queued
+    OUTPUT: the program has output a value (the last of 'outputs')
+    HALTED: the program has finished
+    PREEMPTED: the step budget or deadline ran out
+    """
+    NEEDS_INPUT = 1
+    OUTPUT = 2
+    HALTED = 3
+    PREEMPTED = 4
+
+# How many instructions runUntilIO executes between checks of its deadline
+DEADLINE_CHECK_STEPS = 4096
+
+# Default number of instructions between automatic checkpoints
+CHECKPOINT_STEPS = 10 ** 6
+
+class Pause(Exception):
+    """
+    Raised from inside an instruction to stop execution at an I/O boundary.
+    The instruction pointer is left so that execution can be resumed.
+    """
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
 class IntcodeSim:
     """
     Parses and executes Intcode.
     """
 
-    def __init__(self, code):
+    def __init__(self, code, engine=None):
         """
         Create an IntcodeSim executor. Each executor can only be run
         once, and allows introspection of outputs and the memory state.
 
-        :param code: intcode, as a list of ints or a comma-separated string.
+        :param code: intcode, as a list of ints, a comma-separated string, or an
+                     IntcodeMemory (which is copied, sharing pages).
+        :param engine: Execution engine to use: a name from ENGINES, or a
+                       callable taking the IntcodeSim and returning an engine.
+                       Defaults to the reference interpreter.
         :attribute arr: The current intcode state. This may be modified as the code
                         is executed.
         :attribute pos: The instruction pointer: position of next intcode to execute
         :attribute finished: Boolean, true if the intcode has finished executing
-        :attribute queuedInputs: List of inputs to use if requested by intcode
-                                 (lower indexes are used first)
+        :attribute queuedInputs: deque of inputs to use if requested by intcode
+                                 (the left end is used first)
         :attribute outputs: List of outputs emitted by the intcode, earliest first.
         :attribute inputFn: If set, inputs will be retrieved by calling this function,
                             which should return an integer. (If queuedInputs is non-empty,
@@ -82,31 +357,105 @@ class IntcodeSim:
                             A return value of 'None' will cause the machine to terminate.
         :attribute outputFn: If set, will be called with a single integer argument for
                              for each output value. Values will also be added to 'outputs'
+        :attribute outputSink: If set, receives outputs grouped into records (see
+                               setOutputSink)
         :attribute relativeBase: the base address for RELATIVE-mode instructions
+        :attribute image: The memory the program started with (not modified)
+        :attribute source: The file the program was loaded from, if any
+        :attribute outputCursor: Number of outputs produced before 'outputs' was
+                                 started (by restoring a checkpoint, or forking)
+        :attribute engine: If set, an alternative execution engine (such as
+                           intcode_cache.DecodeCacheEngine) which run() hands over to.
+                           Engines have a run(maxSteps=None) method, which returns
+                           the number of instructions executed if maxSteps is set.
+                           Engines may cache code, so once one has run, memory should
+                           only be modified through setMemory().
         """
 
         # Allow a string to be passed, for convenience
         if isinstance(code, str):
             code = self.split(code)
 
-        # List subclass that extends to infinite size and forbids negative element
-        # access.
-        self.arr = IntcodeMemory(code)
+        # Paged memory that extends to infinite size and forbids negative
+        # addresses. Copies share pages until one of them writes to a page.
+        if not isinstance(code, IntcodeMemory):
+            code = IntcodeMemory(code)
+        self.image = code.copy()
+        self.arr = code.copy()
+        self.source = None
 
         self.pos = 0
         self.finished = False
-        self.queuedInputs = []
+        self.queuedInputs = deque()
         self.outputs = []
+        self.outputCursor = 0
         self.inputFn = None
         self.outputFn = None
+        self.outputSink = None
+        self.outputArity = 1
+        self.outputBatch = False
+        self.pendingOutputs = []
         self.relativeBase = 0
+        self.checkpointPath = None
+        self.checkpointEvery = None
+        self.checkpointDue = None
         self.lastOpcode = None
+        self.pauseOnOutput = False
+        self.engine = None
+        self.setEngine(engine)
+
+    def setEngine(self, engine):
+        """
+        Selects the execution engine used by run().
+
+        :param engine: A name from ENGINES, a callable taking this IntcodeSim and
+                       returning an engine, or None for the reference interpreter.
+        :return: Self, for chaining
+        """
+        if isinstance(engine, str):
+            if engine not in ENGINES:
+                raise ValueError(f"unknown engine '{engine}' (expected one of {', '.join(ENGINES)})")
+            if ENGINES[engine] is not None:
+                module, name, kwargs = ENGINES[engine]
+                engineClass = getattr(import_module(module), name)
+                engine = lambda sim: engineClass(sim, **kwargs)
+            else:
+                engine = None
+
+        self.engineFactory = engine
+        self.engine = engine(self) if engine is not None else None
+        return self
+
+    def fork(self):
+        """
+        Creates an independent copy of this machine, which can be run from
+        the current state. Memory is shared, copy-on-write, with this machine,
+        so forking costs the same however large the program is.
+
+        The fork starts with the same pending inputs, inputFn and outputFn,
+        and a fresh engine of the same type. Its outputs start empty: outputs
+        produced before the fork stay with this machine. It doesn't save
+        automatic checkpoints.
+
+        :return: The new IntcodeSim
+        """
+        child = copy(self)
+        child.arr = self.arr.copy()
+        child.queuedInputs = self.queuedInputs.copy()
+        child.pendingOutputs = self.pendingOutputs.copy()
+        child.outputs = []
+        child.outputCursor = self.outputCursor + len(self.outputs)
+        child.checkpointPath = None
+        child.setEngine(self.engineFactory)
+        return child
 
     def setMemory(self, position, value):
         "functional interface to setting the memory"
         if not isinstance(value, int):
             raise f"setMemory: '{value}' must be an int"
         self.arr[position] = value
+        if self.engine is not None:
+            self.engine.invalidate(position)
 
     def queueInput(self, value):
         """
@@ -120,32 +469,154 @@ class IntcodeSim:
         self.queuedInputs.append(value)
         return self
 
-    def __getInput(self):
-        if len(self.queuedInputs):
-            return self.queuedInputs.pop(0)
-        elif self.inputFn is not None:
-            return self.inputFn()
-        else:
-            value = input('Enter value: ')
-            return int(value)
+    def queueInputs(self, values):
+        """
+        Queues several input values at once, used in order after any already
+        queued.
+
+        :param values: Iterable of values to enqueue
+        :return: Returns self, for chaining.
+        """
+        self.queuedInputs.extend(values)
+        return self
+
+    def setOutputSink(self, sink, arity=1, batch=False):
+        """
+        Delivers outputs in fixed-size records, such as the (x, y, tile)
+        triples of a game screen, instead of one value at a time. Records are
+        delivered whenever the machine stops: when it needs input, pauses
+        after an output, or halts. A partial record is kept until the rest of
+        it has been output. Values are still added to 'outputs', and passed to
+        outputFn if it is set.
+
+        :param sink: Called with each record, as a tuple of arity values, or
+                     None to stop delivering records
+        :param arity: Number of values in each record
+        :param batch: If true, sink is instead called once each time the
+                      machine stops, with a list of the records since the last
+        :return: Self, for chaining
+        """
+        self.outputSink = sink
+        self.outputArity = arity
+        self.outputBatch = batch
+        self.pendingOutputs = []
+        return self
 
-    def __putOutput(self, value):
+    def _getInput(self):
+        if self.queuedInputs:
+            return self.queuedInputs.popleft()
+        raise Pause(Status.NEEDS_INPUT)
+
+    def _putOutput(self, value):
         self.outputs.append(value)
         if self.outputFn is not None:
             self.outputFn(value)
+        if self.outputSink is not None:
+            self.pendingOutputs.append(value)
+        if self.pauseOnOutput:
+            raise Pause(Status.OUTPUT)
+
+    def __deliverOutputs(self):
+        "pass the complete records in pendingOutputs to outputSink"
+        pending = self.pendingOutputs
+        complete = len(pending) - len(pending) % self.outputArity
+        if not complete:
+            return
+        values = iter(pending[:complete])
+        records = list(zip(*[values] * self.outputArity))
+        del pending[:complete]
+        if self.outputBatch:
+            self.outputSink(records)
+        else:
+            for record in records:
+                self.outputSink(record)
 
     @classmethod
-    def fromFile(cls, filename):
+    def fromFile(cls, filename, engine=None):
         """
         Creates an IntcodeSim with intcode loaded from the specified file.
+        The file is only parsed once: see intcode_image.load().
 
         :param filename: The file to load.
+        :param engine: Execution engine to use (see __init__)
+        """
+        sim = cls(intcode_image.load(filename).memory(), engine=engine)
+        sim.source = filename
+        return sim
+
+    def save(self, path):
+        """
+        Saves the machine's state to a checkpoint file: memory (just the pages
+        that differ from the program), pos, relativeBase, queued inputs, and
+        the number of outputs produced. inputFn, outputFn and the engine
+        aren't saved. See intcode_checkpoint for the format.
+
+        :param path: The file to write; it is replaced atomically
+        :return: Self, for chaining
+        """
+        intcode_checkpoint.save(self, path)
+        return self
+
+    @classmethod
+    def load(cls, path, code=None, engine=None):
+        """
+        Creates an IntcodeSim from a checkpoint written by save().
+
+        :param path: The checkpoint file
+        :param code: The program the machine was running. Only needed if it
+                     wasn't created with fromFile(), which the checkpoint
+                     records. Raises ValueError if the program doesn't match.
+        :param engine: Execution engine to use (see __init__)
+        """
+        return intcode_checkpoint.load(cls, path, code, engine)
+
+    def ascii(self):
+        """
+        Returns an intcode_ascii.AsciiIO, for exchanging text with the program:
+        queuing strings as input, and reading its output as lines or frames.
+        """
+        return import_module("intcode_ascii").AsciiIO(self)
+
+    def startTrace(self, capacity=None, path=None):
+        """
+        Records every instruction the machine executes from now on, in a
+        fixed-size ring buffer, using the tracing engine (which replaces any
+        other engine). See intcode_trace.Trace.
+
+        :param capacity: Number of instructions kept (default intcode_trace.CAPACITY)
+        :param path: If set, the file to keep the trace in
+        :return: The Trace
+        """
+        module = import_module("intcode_trace")
+        capacity = capacity or module.CAPACITY
+        self.setEngine(lambda sim: module.TracingEngine(sim, capacity, path))
+        return self.engine.trace
+
+    def startProfile(self):
         """
-        arr = []
-        with open(filename, 'r') as f:
-            for line in f:
-                arr += cls.split(line.rstrip('\n'))
-        return cls(arr)
+        Counts the instructions the machine executes from now on, by opcode
+        and by address, using the profiling engine (which replaces any other
+        engine). See intcode_profile.Profile.
+
+        :return: The Profile
+        """
+        module = import_module("intcode_profile")
+        self.setEngine(module.ProfilingEngine)
+        return self.engine.profile
+
+    def setCheckpoint(self, path, every=CHECKPOINT_STEPS):
+        """
+        Saves a checkpoint to path every 'every' instructions, while running.
+        Instructions are counted in chunks of up to DEADLINE_CHECK_STEPS, and
+        a chunk cut short by input or output counts in full, so checkpoints
+        may come early (at an I/O boundary) but never late.
+
+        :param path: The file to save to, or None to stop checkpointing
+        :return: Self, for chaining
+        """
+        self.checkpointPath = path
+        self.checkpointEvery = self.checkpointDue = every
+        return self
     
     @staticmethod
     def split(string):
@@ -176,104 +647,115 @@ class IntcodeSim:
 
     def run(self):
         """
-        Execute the intcode until the program finishes.
+        Execute the intcode until the program finishes. When the input queue
+        is empty, inputs are taken from inputFn, or prompted for on STDIN.
 
         :return: Self, for chaining
         """
-        while not self.finished:
-            self.__runStep()
+        while self.runUntilIO(pauseOnOutput=False) == Status.NEEDS_INPUT:
+            if self.inputFn is not None:
+                value = self.inputFn()
+            else:
+                value = int(input('Enter value: '))
+            # A value of None is passed on, to terminate the program
+            self.queuedInputs.append(value)
         return self
 
-         
-    def __runStep(self):
-        """
-        Execute a single instruction. Returns an int if the instruction
-        returned an output, otherwise None.
+    def runUntilIO(self, pauseOnOutput=True, maxSteps=None, deadline=None):
         """
-        if self.finished:
-            return None
-
-        opcode, parameterModes = self.parseOpcode(self.arr[self.pos])
-        self.lastOpcode = opcode
-        self.pos += 1
-
-        # Build arguments
-        args = []
-        for i in range(0, opcode.op.args):
-            value = self.arr[self.pos]
-            self.pos += 1
-
-            mode = parameterModes[i]
-
-            # Output arguments are left as addresses, which we look up in
-            # self.arr later when executing the instruction
-            if i >= opcode.op.inputs():
-                if mode == ParameterMode.IMMEDIATE:
-                    raise ValueError("output address arguments cannot be in immediate mode")
+        Execute the intcode until it needs input that isn't queued, outputs a
+        value, or finishes. Can be called again to resume where it stopped,
+        once any input needed has been queued.
 
-                elif mode == ParameterMode.POSITION:
-                    args.append(value)
+        inputFn is not used, but outputFn is still called for each output.
 
-                elif mode == ParameterMode.RELATIVE:
-                    args.append(value + self.relativeBase)
-
-                else:
-                    raise ValueError("invalid parameter mode")
-
-            # Input arguments are resolved completely before executing the
-            # instruction.
-            else:
-                if mode == ParameterMode.IMMEDIATE:
-                    args.append( value )
-
-                elif mode == ParameterMode.POSITION:
-                    args.append( self.arr[value] )
-
-                elif mode == ParameterMode.RELATIVE:
-                    args.append( self.arr[value + self.relativeBase] )
-
-                else:
-                    raise ValueError("invalid parameter mode")
-
-        # Execute opcode
-        if opcode == Opcode.ADD:
-            self.arr[args[2]] = args[0] + args[1]
+        :param pauseOnOutput: If false, keep running after each output
+        :param maxSteps: If set, stop after executing this many instructions
+        :param deadline: If set, a time.monotonic() value to stop at. The clock
+                         is checked every DEADLINE_CHECK_STEPS instructions.
+        :return: The Status describing why execution stopped
+        """
+        if self.finished:
+            return Status.HALTED
 
-        elif opcode == Opcode.MULTIPLY:
-            self.arr[args[2]] = args[0] * args[1]
-        
-        elif opcode == Opcode.INPUT:
-            value = self.__getInput()
-            if value is None:
-                self.finished = True
+        self.pauseOnOutput = pauseOnOutput
+        try:
+            if deadline is None and self.checkpointPath is None:
+                self.__execute(maxSteps)
             else:
-                self.arr[args[0]] = value
-
-        elif opcode == Opcode.OUTPUT:
-            self.__putOutput(args[0])
-
-        elif opcode == Opcode.JUMP_IF_TRUE:
-            if args[0] != 0:
-                self.pos = args[1]
-
-        elif opcode == Opcode.JUMP_IF_FALSE:
-            if args[0] == 0:
-                self.pos = args[1]
-
-        elif opcode == Opcode.LESS_THAN:
-            self.arr[args[2]] = 1 if args[0] < args[1] else 0
-
-        elif opcode == Opcode.EQUALS:
-            self.arr[args[2]] = 1 if args[0] == args[1] else 0
+                while not self.finished and (deadline is None or monotonic() < deadline):
+                    if maxSteps is None:
+                        self.__executeChunk(DEADLINE_CHECK_STEPS)
+                    elif maxSteps > 0:
+                        maxSteps -= self.__executeChunk(min(maxSteps, DEADLINE_CHECK_STEPS))
+                    else:
+                        break
+        except Pause as pause:
+            return pause.status
+        finally:
+            if self.outputSink is not None:
+                self.__deliverOutputs()
+        return Status.HALTED if self.finished else Status.PREEMPTED
+
+    def __executeChunk(self, maxSteps):
+        "__execute(maxSteps), saving a checkpoint if one falls due"
+        if self.checkpointPath is None:
+            return self.__execute(maxSteps)
+
+        maxSteps = min(maxSteps, self.checkpointDue)
+        try:
+            executed = self.__execute(maxSteps)
+        except Pause:
+            self.__countSteps(maxSteps)
+            raise
+        self.__countSteps(executed)
+        return executed
+
+    def __countSteps(self, steps):
+        self.checkpointDue -= steps
+        if self.checkpointDue <= 0:
+            self.save(self.checkpointPath)
+            self.checkpointDue = self.checkpointEvery
+
+    def __execute(self, maxSteps=None):
+        """
+        Execute instructions until the program finishes, or maxSteps have
+        been executed, returning the number executed if maxSteps is set.
+        """
+        if self.engine is not None:
+            return self.engine.run(maxSteps)
 
-        elif opcode == Opcode.ADJUST_RELBASE:
-            self.relativeBase += args[0]
+        dispatch = DISPATCH
+        if maxSteps is None:
+            while not self.finished:
+                dispatch[self.arr[self.pos]](self)
+            return None
 
-        elif opcode == Opcode.END:
-            self.finished = True
-        else:
-            raise ValueError("unknown opcode: " + opcode)
+        arr = self.arr
+        for steps in range(maxSteps):
+            if self.finished:
+                return steps
+            dispatch[arr[self.pos]](self)
+        return maxSteps
 
+    def interact(self):
+        """
+        Generator interface to the machine. Yields each value output, and
+        yields None when input is needed; values passed to send() are
+        queued as input. An iterable of values may be sent to queue several
+        at once. Returns when the program finishes.
+        """
+        while True:
+            status = self.runUntilIO()
+            if status == Status.HALTED:
+                return
+            sent = yield self.outputs[-1] if status == Status.OUTPUT else None
+            if isinstance(sent, int):
+                self.queueInput(sent)
+            elif sent is not None:
+                self.queuedInputs.extend(sent)
+
+DISPATCH = DispatchTable()
 
 class TestQ2(unittest.TestCase):
     """ tests from Advent Calendar question 2 """
@@ -388,3 +870,139 @@ class TestQ9(unittest.TestCase):
         i.run()
         self.assertEqual(i.relativeBase, 10)
         self.assertEqual(i.outputs, [42])
+
+class TestRunUntilIO(unittest.TestCase):
+    # Outputs each input doubled, until it reads a 0
+    DOUBLER = [3,15, 1006,15,14, 102,2,15,16, 4,16, 1105,1,0, 99, 0,0]
+
+    def test_statuses(self):
+        i = IntcodeSim(self.DOUBLER)
+        self.assertEqual(i.runUntilIO(), Status.NEEDS_INPUT)
+        self.assertEqual(i.runUntilIO(), Status.NEEDS_INPUT)
+        self.assertEqual(i.pos, 0)
+
+        i.queueInput(4).queueInput(5)
+        self.assertEqual(i.runUntilIO(), Status.OUTPUT)
+        self.assertEqual(i.outputs, [8])
+        self.assertEqual(i.runUntilIO(), Status.OUTPUT)
+        self.assertEqual(i.runUntilIO(), Status.NEEDS_INPUT)
+        self.assertEqual(i.outputs, [8, 10])
+
+        i.queueInput(6).queueInput(0)
+        self.assertEqual(i.runUntilIO(pauseOnOutput=False), Status.HALTED)
+        self.assertEqual(i.outputs, [8, 10, 12])
+        self.assertEqual(i.runUntilIO(), Status.HALTED)
+
+    def test_engines(self):
+        for engine in ENGINES:
+            with self.subTest(engine):
+                i = IntcodeSim(self.DOUBLER, engine=engine)
+                self.assertEqual(i.runUntilIO(), Status.NEEDS_INPUT)
+                i.queueInput(1)
+                self.assertEqual(i.runUntilIO(), Status.OUTPUT)
+                self.assertEqual(i.runUntilIO(), Status.NEEDS_INPUT)
+                i.queueInput(0)
+                self.assertEqual(i.runUntilIO(), Status.HALTED)
+                self.assertEqual(i.outputs, [2])
+
+    def test_max_steps(self):
+        code = IntcodeSim.fromFile('inputs/q09').arr
+        reference = IntcodeSim(code).queueInput(1)
+        reference.runUntilIO(pauseOnOutput=False, maxSteps=150)
+
+        for engine in ENGINES:
+            with self.subTest(engine):
+                i = IntcodeSim(code, engine=engine).queueInput(1)
+                for _ in range(150 // 7):
+                    self.assertEqual(i.runUntilIO(maxSteps=7), Status.PREEMPTED)
+                self.assertEqual(i.runUntilIO(maxSteps=150 % 7), Status.PREEMPTED)
+                self.assertEqual((i.pos, i.relativeBase, i.arr), (reference.pos, reference.relativeBase, reference.arr))
+
+                # Runs to the end when resumed
+                self.assertEqual(i.runUntilIO(pauseOnOutput=False), Status.HALTED)
+                self.assertEqual(i.outputs, [3345854957])
+
+    def test_deadline(self):
+        # Loops forever
+        i = IntcodeSim([1105,1,0])
+        self.assertEqual(i.runUntilIO(deadline=monotonic() + 0.01), Status.PREEMPTED)
+        self.assertEqual(i.runUntilIO(deadline=monotonic() - 1), Status.PREEMPTED)
+        self.assertEqual(i.runUntilIO(maxSteps=10, deadline=monotonic() + 10), Status.PREEMPTED)
+        self.assertEqual(IntcodeSim([99]).runUntilIO(deadline=monotonic() + 10), Status.HALTED)
+
+    def test_interact(self):
+        machine = IntcodeSim(self.DOUBLER).interact()
+        self.assertIsNone(next(machine))
+        self.assertEqual(machine.send(3), 6)
+        self.assertIsNone(next(machine))
+        self.assertEqual(machine.send([1, 2, 0]), 2)
+        self.assertEqual(list(machine), [4])
+
+    def test_input_fn(self):
+        inputs = iter([7, None])
+        i = IntcodeSim(self.DOUBLER)
+        i.inputFn = lambda: next(inputs)
+        i.run()
+        self.assertTrue(i.finished)
+        self.assertEqual(i.outputs, [14])
+
+    def test_queue_inputs(self):
+        i = IntcodeSim(self.DOUBLER).queueInputs(range(3, 6)).queueInputs([0])
+        self.assertEqual(i.run().outputs, [6, 8, 10])
+
+    def test_output_sink(self):
+        # Outputs each input, until it reads a 0
+        code = [3,11, 1006,11,10, 4,11, 1105,1,0, 99, 0]
+        records = []
+        i = IntcodeSim(code).setOutputSink(records.append, arity=2)
+        i.queueInputs([1, 2, 3])
+        self.assertEqual(i.runUntilIO(pauseOnOutput=False), Status.NEEDS_INPUT)
+        self.assertEqual(records, [(1, 2)])
+        i.queueInputs([4, 0]).run()
+        self.assertEqual(records, [(1, 2), (3, 4)])
+        self.assertEqual(i.outputs, [1, 2, 3, 4])
+
+        batches = []
+        inputs = iter([6, 0])
+        i = IntcodeSim(code).setOutputSink(batches.append, arity=3, batch=True)
+        i.queueInputs([1, 2, 3, 4, 5])
+        i.inputFn = lambda: next(inputs)
+        i.run()
+        self.assertEqual(batches, [[(1, 2, 3)], [(4, 5, 6)]])
+
+class TestFork(unittest.TestCase):
+    def test_fork(self):
+        # Outputs input + 10 for each input, until inputFn returns None
+        code = [3,11, 1001,11,10,11, 4,11, 1105,1,0, 0]
+        parent = IntcodeSim(code).queueInput(1)
+        parent.inputFn = lambda: None
+
+        child = parent.fork().queueInput(5)
+        parent.run()
+        child.run()
+        self.assertEqual(parent.outputs, [11])
+        self.assertEqual(child.outputs, [11, 15])
+        self.assertEqual(parent.arr[11], 11)
+        self.assertEqual(child.arr[11], 15)
+
+    def test_fork_engine(self):
+        parent = IntcodeSim.fromFile('inputs/q09', engine="compiled")
+        child = parent.fork()
+        self.assertIsNot(child.engine, parent.engine)
+        self.assertIs(child.engine.sim, child)
+        self.assertEqual(child.queueInput(1).run().outputs, [3345854957])
+        self.assertEqual(parent.outputs, [])
+
+class TestDispatch(unittest.TestCase):
+    def test_invalid_opcodes(self):
+        with self.assertRaises(ValueError):
+            IntcodeSim([42]).run()
+        with self.assertRaises(ValueError):
+            IntcodeSim([11101,1,1,0,99]).run()
+
+    def test_unused_mode_digits(self):
+        "mode digits beyond the instruction's arguments are ignored"
+        i = IntcodeSim([11104,7,10099]).run()
+        self.assertEqual(i.outputs, [7])
+        self.assertEqual(i.pos, 3)
+        self.assertEqual(i.lastOpcode, Opcode.END)
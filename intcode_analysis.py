@@ -0,0 +1,435 @@
+"Static analysis of intcode: disassembly, control-flow graphs and constant propagation"
+import unittest
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional, Set
+from intcode import IntcodeSim, Instruction, Opcode, ParameterMode
+from intcode_memory import IntcodeMemory
+
+JUMPS = {Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE}
+
+class Exit(Enum):
+    """
+    How control leaves a basic block.
+
+    FALL_THROUGH: into the next block, which starts at a jump target
+    JUMP: unconditionally, to a known address
+    BRANCH: conditionally, to a known address or the next instruction
+    CALL: to a function, which returns to the next instruction
+    RETURN: to an address held in the stack frame (a RELATIVE-mode jump)
+    INDIRECT: to an address read from memory, which isn't known statically
+    HALT: the program ends
+    INVALID: the next instruction can't be decoded
+    """
+    FALL_THROUGH = 1
+    JUMP = 2
+    BRANCH = 3
+    CALL = 4
+    RETURN = 5
+    INDIRECT = 6
+    HALT = 7
+    INVALID = 8
+
+@dataclass
+class BasicBlock:
+    """
+    A run of instructions that is only entered at the start and only left at
+    the end.
+
+    :param start: Address of the first instruction
+    :param instructions: The decoded instructions, in order
+    :param exit: How control leaves the block
+    :param successors: Start addresses of the blocks control can go to next
+                       (for a CALL, the block it returns to)
+    :param callee: For a CALL, the address of the function called
+    """
+    start: int
+    instructions: List[Instruction]
+    exit: Exit
+    successors: List[int] = field(default_factory=list)
+    callee: Optional[int] = None
+
+    def end(self):
+        "the address after the block's last instruction"
+        last = self.instructions[-1]
+        return last.address + last.length()
+
+@dataclass
+class Function:
+    """
+    The blocks reachable from a call target (or the program entry) without
+    following calls.
+
+    :param entry: Address of the first instruction
+    :param blocks: Start addresses of the function's blocks
+    :param frameSize: The stack frame size set up by an ADJUST_RELBASE
+                      prologue, if the function starts with one
+    :param callees: Entry addresses of the functions it calls
+    """
+    entry: int
+    blocks: List[int]
+    frameSize: Optional[int]
+    callees: Set[int]
+
+@dataclass
+class ControlFlowGraph:
+    """
+    :param image: The program analysed
+    :param entry: The address analysis started from
+    :param instructions: Address -> Instruction, for every reachable instruction
+    :param blocks: Start address -> BasicBlock
+    :param functions: Entry address -> Function
+    :param invalid: Reachable addresses holding something other than an
+                    instruction (e.g. an opcode the program writes before
+                    running it)
+    """
+    image: List[int]
+    entry: int
+    instructions: Dict[int, Instruction]
+    blocks: Dict[int, BasicBlock]
+    functions: Dict[int, Function]
+    invalid: Set[int]
+
+    def codeCells(self):
+        "the set of addresses holding reachable instructions or their arguments"
+        return {instruction.address + k for instruction in self.instructions.values()
+                for k in range(instruction.length())}
+
+    def dataCells(self):
+        "the addresses in the image that aren't reachable code"
+        code = self.codeCells()
+        return [address for address in range(len(self.image)) if address not in code]
+
+    def positionWrites(self):
+        "addresses written to by POSITION-mode output arguments"
+        return {dest[1] for dest in (instruction.dest() for instruction in self.instructions.values())
+                if dest is not None and dest[0] == ParameterMode.POSITION}
+
+    def positionReads(self):
+        "addresses read by POSITION-mode input arguments"
+        return {instruction.args[i] for instruction in self.instructions.values()
+                for i in range(instruction.opcode.op.inputs())
+                if instruction.modes[i] == ParameterMode.POSITION}
+
+    def isCodeStable(self):
+        """
+        True if the program never writes (with a POSITION-mode address) over
+        an opcode, a jump, an argument used as an address, or an address that
+        can't be decoded yet, so the graph, and the cells each instruction
+        reads and writes, hold however the program runs. It may still patch
+        the immediate arguments of other instructions.
+        """
+        written = self.positionWrites()
+        if written & self.invalid:
+            return False
+        for instruction in self.instructions.values():
+            if instruction.opcode in JUMPS:
+                cells = range(instruction.address, instruction.address + instruction.length())
+            else:
+                # The opcode, and arguments holding an address to read or write
+                cells = [instruction.address]
+                cells.extend(instruction.address + 1 + i for i, mode in enumerate(instruction.modes)
+                             if mode != ParameterMode.IMMEDIATE)
+            if any(cell in written for cell in cells):
+                return False
+        return True
+
+    def disassemble(self):
+        "return a listing of the reachable code, one instruction per line"
+        lines = []
+        for start, block in sorted(self.blocks.items()):
+            if start in self.functions:
+                lines.append(f"function_{start}:")
+            lines.append(f"  block_{start}:")
+            for instruction in block.instructions:
+                lines.append(f"    {instruction.address:>5}  {formatInstruction(instruction)}")
+        return "\n".join(lines)
+
+def formatInstruction(instruction):
+    "e.g. 'ADD [12], 5, rel[3]'"
+    prefixes = {ParameterMode.POSITION: "[{}]", ParameterMode.IMMEDIATE: "{}", ParameterMode.RELATIVE: "rel[{}]"}
+    args = ", ".join(prefixes[mode].format(arg) for mode, arg in zip(instruction.modes, instruction.args))
+    return f"{instruction.opcode.name} {args}".rstrip()
+
+def constantResult(instruction):
+    "the value written by an ADD or MULTIPLY with immediate inputs, or None"
+    if instruction.opcode not in (Opcode.ADD, Opcode.MULTIPLY):
+        return None
+    if instruction.modes[0] != ParameterMode.IMMEDIATE or instruction.modes[1] != ParameterMode.IMMEDIATE:
+        return None
+    a, b = instruction.args[:2]
+    return a + b if instruction.opcode == Opcode.ADD else a * b
+
+def jumpKind(instruction):
+    """
+    Classifies a jump instruction: whether it is always or never taken (if
+    its condition is immediate), and whether its target is known.
+
+    :return: tuple of (taken: True, False or None if it depends on memory,
+             target address or None)
+    """
+    condition, target = instruction.args
+    taken = None
+    if instruction.modes[0] == ParameterMode.IMMEDIATE:
+        taken = (condition != 0) == (instruction.opcode == Opcode.JUMP_IF_TRUE)
+    if instruction.modes[1] != ParameterMode.IMMEDIATE:
+        target = None
+    return taken, target
+
+def analyse(code, entry=0):
+    """
+    Disassembles the code reachable from entry and builds its control-flow
+    graph.
+
+    Calls are recognised by the pattern intcode compilers use: the return
+    address is stored into the stack frame (a RELATIVE-mode write of a
+    constant), then an unconditional jump goes to the function, which
+    returns with a RELATIVE-mode jump. The code after a call is reachable
+    through the return, so is disassembled too.
+
+    :param code: intcode, as a list of ints or a comma-separated string
+    :return: ControlFlowGraph
+    """
+    if isinstance(code, str):
+        code = IntcodeSim.split(code)
+    image = list(code)
+    memory = IntcodeMemory(image)
+
+    instructions = {}
+    invalid = set()
+    # Addresses control is transferred to, other than by falling through
+    targets = {entry}
+    # Jump address -> (callee, return address)
+    calls = {}
+    todo = [entry]
+    while todo:
+        address = todo.pop()
+        # Constants stored into the stack frame since the last jump
+        pushed = set()
+        while address not in instructions and 0 <= address < len(image):
+            try:
+                instruction = Instruction.decode(memory, address)
+            except ValueError:
+                invalid.add(address)
+                break
+            instructions[address] = instruction
+            after = address + instruction.length()
+
+            if instruction.opcode == Opcode.END:
+                break
+            if instruction.opcode not in JUMPS:
+                dest = instruction.dest()
+                if dest is not None and dest[0] == ParameterMode.RELATIVE and constantResult(instruction) is not None:
+                    pushed.add(constantResult(instruction))
+                address = after
+                continue
+
+            taken, target = jumpKind(instruction)
+            if target is not None and taken is not False:
+                targets.add(target)
+                todo.append(target)
+            if taken is True:
+                if target is not None and after in pushed:
+                    calls[address] = (target, after)
+                    targets.add(after)
+                    todo.append(after)
+                break
+            targets.add(after)
+            address = after
+
+    # A block starts at every target, and after every jump
+    leaders = {address for address in targets if address in instructions}
+    for instruction in instructions.values():
+        if instruction.opcode in JUMPS:
+            leaders.add(instruction.address + instruction.length())
+
+    blocks = {}
+    for start in sorted(leaders):
+        if start not in instructions:
+            continue
+        block = []
+        address = start
+        while True:
+            instruction = instructions[address]
+            block.append(instruction)
+            after = address + instruction.length()
+            if instruction.opcode == Opcode.END:
+                blocks[start] = BasicBlock(start, block, Exit.HALT)
+                break
+            if instruction.opcode in JUMPS:
+                blocks[start] = buildJumpBlock(start, block, calls, instructions)
+                break
+            if after not in instructions:
+                blocks[start] = BasicBlock(start, block, Exit.INVALID)
+                break
+            if after in leaders:
+                blocks[start] = BasicBlock(start, block, Exit.FALL_THROUGH, [after])
+                break
+            address = after
+
+    functions = {}
+    for functionEntry in [entry] + sorted({callee for callee, _ in calls.values()}):
+        if functionEntry in blocks and functionEntry not in functions:
+            functions[functionEntry] = buildFunction(functionEntry, blocks)
+
+    return ControlFlowGraph(image, entry, instructions, blocks, functions, invalid)
+
+def buildJumpBlock(start, block, calls, instructions):
+    "create the BasicBlock for block, which ends in a jump"
+    last = block[-1]
+    after = last.address + last.length()
+    fallThrough = [after] if after in instructions else []
+    taken, target = jumpKind(last)
+
+    if last.address in calls:
+        callee, returnAddress = calls[last.address]
+        return BasicBlock(start, block, Exit.CALL, [returnAddress], callee)
+    if taken is False:
+        return BasicBlock(start, block, Exit.FALL_THROUGH, fallThrough)
+    if target is None:
+        if taken and last.modes[1] == ParameterMode.RELATIVE:
+            return BasicBlock(start, block, Exit.RETURN)
+        return BasicBlock(start, block, Exit.INDIRECT, [] if taken else fallThrough)
+    if taken:
+        return BasicBlock(start, block, Exit.JUMP, [target])
+    return BasicBlock(start, block, Exit.BRANCH, [target] + fallThrough)
+
+def buildFunction(entry, blocks):
+    "collect the blocks reachable from entry without following calls"
+    seen = []
+    todo = [entry]
+    callees = set()
+    while todo:
+        start = todo.pop()
+        if start in seen or start not in blocks:
+            continue
+        seen.append(start)
+        block = blocks[start]
+        if block.callee is not None:
+            callees.add(block.callee)
+        todo.extend(block.successors)
+
+    first = blocks[entry].instructions[0]
+    frameSize = None
+    if first.opcode == Opcode.ADJUST_RELBASE and first.modes[0] == ParameterMode.IMMEDIATE:
+        frameSize = first.args[0]
+    return Function(entry, sorted(seen), frameSize, callees)
+
+def simplify(cfg, variable=()):
+    """
+    Constant propagation: returns a copy of the program image in which
+    POSITION-mode reads of cells that are never written are replaced by
+    IMMEDIATE-mode reads of their value. Conditional jumps on such cells
+    become jumps with an immediate condition.
+
+    Instructions the program writes over, or reads as data, are left alone.
+    This is only valid if the stack (RELATIVE-mode writes) stays clear of
+    the image, as it does in compiled intcode.
+
+    :param cfg: ControlFlowGraph from analyse()
+    :param variable: Addresses that are patched before the program runs (such
+                     as q02's noun and verb), so can't be treated as constant
+    :return: The simplified image (a list), or None if the program isn't code
+             stable (see ControlFlowGraph.isCodeStable)
+    """
+    if not cfg.isCodeStable():
+        return None
+
+    variable = set(variable)
+    written = cfg.positionWrites() | variable
+    # Cells the program changes or reads as data
+    untouchable = written | cfg.positionReads()
+    image = list(cfg.image)
+
+    for address, instruction in sorted(cfg.instructions.items()):
+        cells = range(address, address + instruction.length())
+        if any(cell in untouchable for cell in cells):
+            continue
+
+        modes = list(instruction.modes)
+        args = list(instruction.args)
+        for i in range(instruction.opcode.op.inputs()):
+            cell = args[i]
+            if modes[i] == ParameterMode.POSITION and 0 <= cell < len(image) and cell not in written:
+                modes[i] = ParameterMode.IMMEDIATE
+                args[i] = cfg.image[cell]
+
+        if modes != instruction.modes:
+            image[address] = instruction.opcode + sum(mode.value * 10 ** (i + 2) for i, mode in enumerate(modes))
+            image[address + 1:address + 1 + len(args)] = args
+    return image
+
+
+class TestAnalysis(unittest.TestCase):
+    # main: push the return address (9) and an argument, call double at 14,
+    # output the result left in the frame, halt
+    CALLS = [109,100, 21101,9,0,0, 1105,1,14, 204,1, 99, 0, 0,
+             # double: prologue, double the argument, epilogue, return
+             109,2, 22101,0,-1,-1, 1202,-1,2,-1, 109,-2, 2106,0,0]
+
+    def test_blocks(self):
+        # Counts down from 3 before halting
+        cfg = analyse([1001,9,-1,9, 1005,9,0, 99, 0, 3])
+        self.assertEqual(sorted(cfg.blocks), [0, 7])
+        self.assertEqual(cfg.blocks[0].exit, Exit.BRANCH)
+        self.assertEqual(cfg.blocks[0].successors, [0, 7])
+        self.assertEqual(cfg.blocks[7].exit, Exit.HALT)
+        self.assertEqual(cfg.dataCells(), [8, 9])
+
+    def test_calls(self):
+        cfg = analyse(self.CALLS)
+        self.assertEqual(sorted(cfg.functions), [0, 14])
+        self.assertEqual(cfg.functions[14].frameSize, 2)
+        self.assertEqual(cfg.functions[0].callees, {14})
+        self.assertEqual(cfg.blocks[0].exit, Exit.CALL)
+        self.assertEqual(cfg.blocks[0].successors, [9])
+        self.assertEqual(cfg.blocks[9].exit, Exit.HALT)
+        self.assertEqual(cfg.blocks[14].exit, Exit.RETURN)
+        # Cells 12 and 13 are never reached
+        self.assertEqual(cfg.dataCells(), [12, 13])
+        self.assertIn("function_14:", cfg.disassemble())
+
+    def test_puzzles(self):
+        "every puzzle program disassembles, and its CFG covers the code run"
+        from intcode_conformance import WORKLOADS
+        for name, (filename, setup) in WORKLOADS.items():
+            with self.subTest(name):
+                sim = IntcodeSim.fromFile(filename)
+                cfg = analyse(sim.arr)
+                profile = sim.startProfile()
+                sim.inputFn = lambda: None
+                setup(sim)
+                sim.run()
+                executed = {address for address in profile.addresses if address < len(cfg.image)}
+                if cfg.isCodeStable():
+                    self.assertLessEqual(executed, set(cfg.instructions))
+
+    def test_simplify(self):
+        "simplified puzzle programs produce the same output"
+        from intcode_conformance import WORKLOADS
+        changed = 0
+        for name, (filename, setup) in WORKLOADS.items():
+            with self.subTest(name):
+                code = list(IntcodeSim.fromFile(filename).arr)
+                # Some setups patch the first few cells
+                image = simplify(analyse(code), variable={0, 1, 2})
+                if image is None:
+                    continue
+                changed += image != code
+                outputs = []
+                for program in (code, image):
+                    sim = IntcodeSim(program)
+                    sim.inputFn = lambda: None
+                    setup(sim)
+                    outputs.append(sim.run().outputs)
+                self.assertEqual(outputs[0], outputs[1])
+        self.assertGreater(changed, 0)
+
+    def test_self_modifying(self):
+        # Writes over its own code
+        self.assertIsNone(simplify(analyse([1,0,0,0,99])))
+        # Writes over the output address of the instruction at 4, so cell 20
+        # changes although no instruction writes to it as written
+        code = [1101,0,20,7, 1101,5,0,30, 4,20, 99] + [0] * 20
+        self.assertFalse(analyse(code).isCodeStable())
+        self.assertIsNone(simplify(analyse(code)))
@@ -0,0 +1,128 @@
+"ASCII text interface to IntcodeSim"
+import unittest
+from intcode import IntcodeSim, Status
+
+# Instructions executed between collecting output, so frames and lines are
+# delivered while a long-running program is still producing them
+SLICE_STEPS = 10000
+
+class AsciiIO:
+    """
+    Talks to an ASCII-capable intcode program in text. Input is queued a
+    whole string at a time; output is decoded into lines or frames (blocks of
+    lines ended by a blank line, such as a camera feed).
+
+    Output is collected from the machine's 'outputs' in bulk into a
+    bytearray, which is searched for line breaks without handling values one
+    at a time. Collected outputs are removed from 'outputs' (and counted in
+    outputCursor), so a long video feed doesn't accumulate in memory.
+
+    :attribute sim: The IntcodeSim
+    :attribute buffer: Text output that hasn't been returned yet, as bytes
+    :attribute values: Outputs that aren't ASCII (e.g. a final answer), in order
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.buffer = bytearray()
+        self.values = []
+
+    def send(self, text):
+        """
+        Queues text as input, one value per character.
+
+        :return: Self, for chaining
+        """
+        self.sim.queueInputs(text.encode('ascii'))
+        return self
+
+    def sendLines(self, *lines):
+        """
+        Queues each of lines as input, each followed by a newline.
+
+        :return: Self, for chaining
+        """
+        return self.send("".join(line + "\n" for line in lines))
+
+    def collect(self):
+        "move the machine's outputs into buffer (and values)"
+        sim = self.sim
+        outputs = sim.outputs
+        if not outputs:
+            return
+        try:
+            self.buffer.extend(outputs)
+        except ValueError:
+            # Nothing is added if any value is out of range
+            for value in outputs:
+                if 0 <= value < 256:
+                    self.buffer.append(value)
+                else:
+                    self.values.append(value)
+        sim.outputCursor += len(outputs)
+        outputs.clear()
+
+    def __split(self, separator):
+        """
+        Runs the machine until it halts, or needs input that isn't queued,
+        yielding the output text ended by each separator (without it). When
+        the machine halts, any remaining text is yielded too.
+        """
+        buffer = self.buffer
+        while True:
+            status = self.sim.runUntilIO(pauseOnOutput=False, maxSteps=SLICE_STEPS)
+            self.collect()
+            start = 0
+            while True:
+                end = buffer.find(separator, start)
+                if end < 0:
+                    break
+                yield buffer[start:end].decode('ascii')
+                start = end + len(separator)
+            del buffer[:start]
+            if status == Status.HALTED:
+                if buffer:
+                    yield buffer.decode('ascii')
+                    buffer.clear()
+                return
+            if status == Status.NEEDS_INPUT:
+                return
+
+    def lines(self):
+        """
+        Generator of the lines of text the program outputs, as the machine
+        runs. Stops when the machine halts, or needs input that isn't queued
+        (iterate again once it has been sent).
+        """
+        return self.__split(b"\n")
+
+    def frames(self):
+        """
+        Generator of the frames the program outputs, as the machine runs:
+        each is the text before a blank line. Stops like lines().
+        """
+        return self.__split(b"\n\n")
+
+
+class TestAscii(unittest.TestCase):
+    # Echoes its input until it reads a '.', then outputs 1000
+    ECHO = [3,17, 1008,17,46,18, 1005,18,14, 4,17, 1105,1,0, 104,1000, 99, 0, 0]
+
+    def test_lines(self):
+        io = AsciiIO(IntcodeSim(self.ECHO)).sendLines("hello", "world")
+        self.assertEqual(list(io.lines()), ["hello", "world"])
+        io.send("bye.")
+        self.assertEqual(list(io.lines()), ["bye"])
+        self.assertEqual(io.values, [1000])
+        self.assertTrue(io.sim.finished)
+        self.assertEqual(io.sim.outputCursor, 16)
+
+    def test_frames(self):
+        io = IntcodeSim(self.ECHO).ascii().send("#o\no#\n\n##\n##\n\n.")
+        self.assertEqual(list(io.frames()), ["#o\no#", "##\n##"])
+
+    def test_q17(self):
+        sim = IntcodeSim.fromFile("inputs/q17")
+        grid = list(AsciiIO(sim).lines())
+        self.assertEqual(grid[-1], "")
+        self.assertEqual(len({len(row) for row in grid[:-1]}), 1)
+        self.assertIn("^", "".join(grid))
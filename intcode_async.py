@@ -0,0 +1,111 @@
+"asyncio interface to IntcodeSim"
+import asyncio
+import unittest
+from intcode import IntcodeSim, Status
+
+# Instructions executed between chances for other tasks to run
+SLICE_STEPS = 10000
+
+class AsyncIntcodeSim(IntcodeSim):
+    """
+    IntcodeSim that takes its input from, and sends its output to, asyncio
+    queues, so many machines can run cooperatively in one event loop. A
+    machine only suspends when it's waiting for input (or an output queue is
+    full), or every SLICE_STEPS instructions so long computations don't
+    starve other tasks.
+
+    Inputs queued with queueInput() are used before the input channel.
+    Outputs are added to 'outputs' (and passed to outputFn) as usual, as well
+    as being put on the output channel.
+    """
+
+    def __init__(self, code, engine=None, inputChannel=None, outputChannel=None):
+        """
+        :param code: intcode, as a list of ints or a comma-separated string.
+        :param engine: Execution engine to use (see IntcodeSim)
+        :param inputChannel: asyncio.Queue to read inputs from; a new queue if
+                             not given. A value of None terminates the machine.
+        :param outputChannel: Optional asyncio.Queue to put outputs on. Pass
+                              another machine's inputChannel to connect them.
+        """
+        super().__init__(code, engine=engine)
+        self.inputChannel = inputChannel if inputChannel is not None else asyncio.Queue()
+        self.outputChannel = outputChannel
+
+    async def runAsync(self):
+        """
+        Execute the intcode until the program finishes.
+
+        :return: Self
+        """
+        pauseOnOutput = self.outputChannel is not None
+        while True:
+            status = self.runUntilIO(pauseOnOutput=pauseOnOutput, maxSteps=SLICE_STEPS)
+            if status == Status.HALTED:
+                return self
+            if status == Status.OUTPUT:
+                await self.outputChannel.put(self.outputs[-1])
+            elif status == Status.NEEDS_INPUT:
+                self.queuedInputs.append(await self.inputChannel.get())
+            else:
+                await asyncio.sleep(0)
+
+
+class TestAsyncIntcode(unittest.TestCase):
+    # Outputs each input doubled, until it reads a 0
+    DOUBLER = [3,15, 1006,15,14, 102,2,15,16, 4,16, 1105,1,0, 99, 0,0]
+
+    def test_channels(self):
+        async def main():
+            sim = AsyncIntcodeSim(self.DOUBLER, outputChannel=asyncio.Queue())
+            task = asyncio.create_task(sim.runAsync())
+            results = []
+            for value in (1, 2, 3):
+                await sim.inputChannel.put(value)
+                results.append(await sim.outputChannel.get())
+            await sim.inputChannel.put(0)
+            await task
+            return sim, results
+
+        sim, results = asyncio.run(main())
+        self.assertEqual(results, [2, 4, 6])
+        self.assertEqual(sim.outputs, [2, 4, 6])
+        self.assertTrue(sim.finished)
+
+    def test_many_machines(self):
+        "a chain of 500 machines in one event loop, each doubling its input"
+        async def main():
+            first = channel = asyncio.Queue()
+            machines = []
+            for _ in range(500):
+                machine = AsyncIntcodeSim(self.DOUBLER, engine="cached", inputChannel=channel,
+                                          outputChannel=asyncio.Queue())
+                machines.append(machine)
+                channel = machine.outputChannel
+            tasks = [asyncio.create_task(machine.runAsync()) for machine in machines]
+
+            await first.put(1)
+            result = await channel.get()
+            for machine in machines:
+                await machine.inputChannel.put(0)
+            await asyncio.gather(*tasks)
+            return result
+
+        self.assertEqual(asyncio.run(main()), 2 ** 500)
+
+    def test_time_slices(self):
+        "a machine busy in a long loop doesn't block others"
+        async def main():
+            # Counts down from 10 ** 5 before halting
+            busy = AsyncIntcodeSim([1001,9,-1,9, 1005,9,0, 99, 0, 10 ** 5])
+            quick = AsyncIntcodeSim(self.DOUBLER, outputChannel=asyncio.Queue())
+            busyTask = asyncio.create_task(busy.runAsync())
+            quickTask = asyncio.create_task(quick.runAsync())
+            await quick.inputChannel.put(21)
+            result = await quick.outputChannel.get()
+            finishedFirst = busy.finished
+            await quick.inputChannel.put(0)
+            await asyncio.gather(busyTask, quickTask)
+            return result, finishedFirst
+
+        self.assertEqual(asyncio.run(main()), (42, False))
@@ -0,0 +1,333 @@
+"Lockstep batch interpreter for many variants of one intcode program"
+import unittest
+from collections import deque
+import numpy as np
+from intcode import IntcodeSim, Opcode, ParameterMode
+
+# Lanes whose operands or results reach this magnitude are handed to the
+# scalar interpreter, which uses arbitrary precision.
+SPILL_MAGNITUDE = 2 ** 62
+
+# Lanes writing beyond this address are handed to the scalar interpreter,
+# rather than growing every lane's memory.
+MAX_BATCH_MEMORY = 1 << 20
+
+class BatchSim:
+    """
+    Runs many copies ("lanes") of one intcode program in lockstep. Memory is
+    held as a 2-D int64 array with a row per lane, so each instruction is
+    executed for all the lanes at it with a few array operations.
+
+    Each pass executes one instruction for the lanes at the same position
+    with the same opcode; when control flow (or self-modified code) diverges,
+    each group gets its own pass. Lanes whose arithmetic could overflow
+    int64, or that write very high, access negative addresses (or jump to
+    one) or hit an invalid opcode, are spilled: converted to an IntcodeSim and finished by
+    the scalar interpreter.
+
+    Input comes from each lane's queue of inputs; a lane needing input when
+    its queue is empty is terminated, as if inputFn had returned None.
+
+    :attribute memory: int64 array of shape (lanes, memory size)
+    :attribute pos: int64 array of each lane's instruction pointer
+    :attribute relativeBase: int64 array of each lane's relative base
+    :attribute finished: bool array, true for lanes that have halted
+    :attribute inputs: List of each lane's queued inputs
+    :attribute outputs: List of each lane's outputs
+    :attribute spilled: Lane -> IntcodeSim, for lanes handed to the scalar
+                        interpreter
+    :attribute errors: Lane -> exception raised by the scalar interpreter
+    :attribute passes: Number of vectorised instruction passes executed
+    """
+
+    def __init__(self, code, lanes):
+        """
+        :param code: intcode, as a list of ints or a comma-separated string.
+        :param lanes: Number of copies of the program to run
+        """
+        if isinstance(code, str):
+            code = IntcodeSim.split(code)
+        code = list(code)
+
+        self.memory = np.zeros((lanes, max(1, len(code))), dtype=np.int64)
+        self.memory[:, :len(code)] = code
+        self.pos = np.zeros(lanes, dtype=np.int64)
+        self.relativeBase = np.zeros(lanes, dtype=np.int64)
+        self.finished = np.zeros(lanes, dtype=bool)
+        # Lanes still being run in lockstep
+        self.active = np.ones(lanes, dtype=bool)
+
+        self.inputs = [deque() for _ in range(lanes)]
+        self.outputs = [[] for _ in range(lanes)]
+        self.spilled = {}
+        self.errors = {}
+        self.passes = 0
+
+    def setMemory(self, address, values):
+        """
+        Sets a memory cell in every lane.
+
+        :param values: A single value, or a sequence with one value per lane
+        """
+        self.__grow(address)
+        self.memory[:, address] = values
+
+    def queueInput(self, lane, value):
+        "Queues an input value for one lane. Returns self, for chaining."
+        self.inputs[lane].append(value)
+        return self
+
+    def cell(self, address):
+        "Returns the value at address in every lane, as a list of ints"
+        if address < self.memory.shape[1]:
+            values = self.memory[:, address].tolist()
+        else:
+            values = [0] * len(self.pos)
+        for lane, sim in self.spilled.items():
+            values[lane] = sim.arr[address]
+        return values
+
+    def run(self):
+        """
+        Execute every lane until it finishes.
+
+        :return: Self, for chaining
+        """
+        while self.active.any():
+            lanes = np.flatnonzero(self.active)
+            positions = self.pos[lanes]
+            # A negative index would wrap around to the end of memory
+            outside = (positions < 0) | (positions >= MAX_BATCH_MEMORY)
+            if outside.any():
+                self.__spill(lanes[outside])
+                lanes, positions = lanes[~outside], positions[~outside]
+            for pos in np.unique(positions).tolist():
+                group = lanes[positions == pos]
+                opcodes = self.__read(group, np.full(len(group), pos))
+                for fullOpcode in np.unique(opcodes).tolist():
+                    self.__step(group[opcodes == fullOpcode], pos, fullOpcode)
+
+        for lane, sim in self.spilled.items():
+            if not sim.finished and lane not in self.errors:
+                try:
+                    sim.run()
+                except Exception as e:
+                    self.errors[lane] = e
+            self.finished[lane] = sim.finished
+        return self
+
+    def __grow(self, address):
+        "make sure memory covers address"
+        size = self.memory.shape[1]
+        if address >= size:
+            extra = max(address + 1, 2 * size) - size
+            self.memory = np.hstack([self.memory, np.zeros((len(self.pos), extra), dtype=np.int64)])
+
+    def __read(self, lanes, addresses):
+        "returns memory[lane, address] for each lane, reading 0 beyond the end"
+        inside = addresses < self.memory.shape[1]
+        if inside.all():
+            return self.memory[lanes, addresses]
+        values = np.zeros(len(lanes), dtype=np.int64)
+        values[inside] = self.memory[lanes[inside], addresses[inside]]
+        return values
+
+    def __spill(self, lanes):
+        "hand lanes over to the scalar interpreter"
+        for lane in lanes.tolist():
+            sim = IntcodeSim(self.memory[lane].tolist())
+            sim.pos = int(self.pos[lane])
+            sim.relativeBase = int(self.relativeBase[lane])
+            sim.queuedInputs = self.inputs[lane]
+            sim.outputs = self.outputs[lane]
+            sim.inputFn = lambda: None
+            self.spilled[lane] = sim
+        self.active[lanes] = False
+
+    def __step(self, lanes, pos, fullOpcode):
+        "execute the instruction at pos, with the given full opcode, for lanes"
+        try:
+            opcode, modes = IntcodeSim.parseOpcode(fullOpcode)
+            if opcode.op.posArgs and modes[-1] == ParameterMode.IMMEDIATE:
+                raise ValueError("output address arguments cannot be in immediate mode")
+        except ValueError:
+            self.__spill(lanes)
+            return
+        op = opcode.op
+        nextPos = pos + op.args + 1
+
+        # Resolve each argument to an address (or a value, for immediates)
+        raw = [self.__read(lanes, np.full(len(lanes), pos + k)) for k in range(1, op.args + 1)]
+        addresses = []
+        for value, mode in zip(raw, modes):
+            if mode == ParameterMode.RELATIVE:
+                value = value + self.relativeBase[lanes]
+            addresses.append(value)
+
+        bad = np.zeros(len(lanes), dtype=bool)
+        for address, mode in zip(addresses, modes):
+            if mode != ParameterMode.IMMEDIATE:
+                bad |= (address < 0) | (address >= MAX_BATCH_MEMORY)
+        values = [
+            address if mode == ParameterMode.IMMEDIATE else self.__read(lanes, np.where(bad, 0, address))
+            for address, mode in zip(addresses[:op.inputs()], modes)
+        ]
+        for value in values:
+            bad |= (value >= SPILL_MAGNITUDE) | (value <= -SPILL_MAGNITUDE)
+        if bad.any():
+            self.__spill(lanes[bad])
+            keep = ~bad
+            lanes = lanes[keep]
+            addresses = [address[keep] for address in addresses]
+            values = [value[keep] for value in values]
+            if not len(lanes):
+                return
+
+        self.passes += 1
+        if opcode in (Opcode.ADD, Opcode.MULTIPLY, Opcode.LESS_THAN, Opcode.EQUALS):
+            a, b = values
+            if opcode == Opcode.ADD:
+                result = a + b
+            elif opcode == Opcode.MULTIPLY:
+                # Check the magnitude in floating point before multiplying
+                big = np.abs(a.astype(np.float64) * b) >= SPILL_MAGNITUDE
+                if big.any():
+                    self.__spill(lanes[big])
+                    lanes, a, b, addresses = lanes[~big], a[~big], b[~big], [x[~big] for x in addresses]
+                result = a * b
+            elif opcode == Opcode.LESS_THAN:
+                result = (a < b).astype(np.int64)
+            else:
+                result = (a == b).astype(np.int64)
+            dest = addresses[2]
+            if len(lanes):
+                self.__grow(int(dest.max()))
+            self.memory[lanes, dest] = result
+            self.pos[lanes] = nextPos
+
+        elif opcode == Opcode.INPUT:
+            # Lanes with no input left are terminated
+            waiting = np.array([not self.inputs[lane] for lane in lanes.tolist()], dtype=bool)
+            self.pos[lanes[waiting]] = nextPos
+            self.finished[lanes[waiting]] = True
+            self.active[lanes[waiting]] = False
+            reading = lanes[~waiting]
+            dest = addresses[0][~waiting]
+            # Inputs too big for the batch are left queued, and their lanes
+            # handed to the scalar interpreter to read them.
+            big = np.array([abs(self.inputs[lane][0]) >= SPILL_MAGNITUDE for lane in reading.tolist()],
+                           dtype=bool)
+            if big.any():
+                self.__spill(reading[big])
+                reading, dest = reading[~big], dest[~big]
+            if len(reading):
+                self.__grow(int(dest.max()))
+                self.memory[reading, dest] = [self.inputs[lane].popleft() for lane in reading.tolist()]
+                self.pos[reading] = nextPos
+
+        elif opcode == Opcode.OUTPUT:
+            for lane, value in zip(lanes.tolist(), values[0].tolist()):
+                self.outputs[lane].append(value)
+            self.pos[lanes] = nextPos
+
+        elif opcode == Opcode.JUMP_IF_TRUE:
+            self.pos[lanes] = np.where(values[0] != 0, values[1], nextPos)
+
+        elif opcode == Opcode.JUMP_IF_FALSE:
+            self.pos[lanes] = np.where(values[0] == 0, values[1], nextPos)
+
+        elif opcode == Opcode.ADJUST_RELBASE:
+            self.relativeBase[lanes] += values[0]
+            self.pos[lanes] = nextPos
+
+        elif opcode == Opcode.END:
+            self.pos[lanes] = nextPos
+            self.finished[lanes] = True
+            self.active[lanes] = False
+
+
+class TestBatch(unittest.TestCase):
+    def assertMatchesScalar(self, code, batch, setup):
+        "check each lane's memory and outputs against the scalar interpreter"
+        for lane in range(len(batch.pos)):
+            sim = IntcodeSim(code)
+            setup(sim, lane)
+            sim.inputFn = lambda: None
+            sim.run()
+            self.assertEqual(batch.cell(0)[lane], sim.arr[0])
+            self.assertEqual(batch.outputs[lane], sim.outputs)
+
+    def test_q02(self):
+        code = IntcodeSim.fromFile('inputs/q02').arr
+        batch = BatchSim(code, 10000)
+        batch.setMemory(1, np.repeat(np.arange(100), 100))
+        batch.setMemory(2, np.tile(np.arange(100), 100))
+        batch.run()
+
+        results = batch.cell(0)
+        self.assertEqual(divmod(results.index(19690720), 100), (98, 20))
+        self.assertFalse(batch.spilled)
+
+        # One pass per instruction: the lanes never diverge
+        sim = IntcodeSim(code)
+        steps = 0
+        while sim.runUntilIO(maxSteps=1).name == "PREEMPTED":
+            steps += 1
+        self.assertEqual(batch.passes, steps + 1)
+
+    def test_divergent_inputs(self):
+        # Outputs 999, 1000 or 1001 depending on whether the input is below,
+        # equal to or above 8
+        code = "3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99"
+        batch = BatchSim(code, 12)
+        for lane in range(12):
+            batch.queueInput(lane, lane + 2)
+        batch.run()
+        self.assertEqual(batch.outputs, [[999]] * 6 + [[1000]] + [[1001]] * 5)
+        self.assertTrue(batch.finished.all())
+
+    def test_spills(self):
+        # Squares the input twice, and outputs it
+        code = [3,0, 2,0,0,0, 2,0,0,0, 4,0, 99]
+        inputs = [3, -7, 2 ** 20, 2 ** 40, 2 ** 70]
+        batch = BatchSim(code, len(inputs))
+        for lane, value in enumerate(inputs):
+            batch.queueInput(lane, value)
+        batch.run()
+        self.assertEqual(batch.outputs, [[value ** 4] for value in inputs])
+        self.assertEqual(set(batch.spilled), {2, 3, 4})
+
+    def test_relative_mode(self):
+        code = IntcodeSim.fromFile('inputs/q09').arr
+        batch = BatchSim(code, 2)
+        batch.queueInput(0, 1)
+        batch.run()
+        self.assertEqual(batch.outputs[0], [3345854957])
+        # No input: terminated at the first INPUT
+        self.assertEqual(batch.outputs[1], [])
+        self.assertTrue(batch.finished.all())
+
+    def test_errors(self):
+        # Lane 1 jumps to an invalid opcode; lane 0 halts
+        code = [3,9, 1005,9,7, 99, 0, 42, 0, 0]
+        batch = BatchSim(code, 2)
+        batch.queueInput(0, 0).queueInput(1, 1)
+        batch.run()
+        self.assertIn(1, batch.errors)
+        self.assertTrue(batch.finished[0])
+        self.assertEqual(len(batch.errors), 1)
+
+    def test_negative_jump(self):
+        # Jumps to -3, which the scalar interpreter rejects
+        batch = BatchSim([1105,1,-3, 104,5, 99], 1).run()
+        self.assertEqual(batch.outputs, [[]])
+        self.assertIn(0, batch.spilled)
+        self.assertIn("negative", str(batch.errors[0]))
+
+    def test_self_modifying(self):
+        # Lane 1's input rewrites the add at address 2 into a multiply
+        code = [3,2, 1101,3,4,0, 99]
+        batch = BatchSim(code, 2)
+        batch.queueInput(0, 1101).queueInput(1, 1102)
+        batch.run()
+        self.assertEqual(batch.cell(0), [7, 12])
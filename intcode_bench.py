@@ -0,0 +1,191 @@
+"""
+Benchmarks for IntcodeSim: runs each intcode puzzle headless under each
+engine, reporting instructions executed, instructions per second, peak RSS
+and machine construction time. Results are stored as JSON and can be
+compared against a saved baseline, e.g.
+
+    python intcode_bench.py --save baseline.json
+    (change something)
+    python intcode_bench.py --baseline baseline.json --threshold 0.1
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import unittest
+from datetime import datetime, timezone
+from time import perf_counter
+from intcode import IntcodeSim, ENGINES
+from intcode_conformance import WORKLOADS
+
+# Each measurement runs a workload at least this many times...
+REPEAT = 3
+# ... and for at least this many seconds, so short workloads can be timed
+MIN_SECONDS = 0.2
+
+# Default fraction by which instructions/second can drop before it counts as
+# a regression
+THRESHOLD = 0.1
+
+def build(name, engine=None):
+    "create a machine set up to run workload name headless"
+    filename, setup = WORKLOADS[name]
+    sim = IntcodeSim.fromFile(filename, engine=engine)
+    # Programs that want more input than scripted are terminated
+    sim.inputFn = lambda: None
+    setup(sim)
+    return sim
+
+def countInstructions(name):
+    "number of instructions workload name executes (the same for every engine)"
+    sim = build(name)
+    profile = sim.startProfile()
+    sim.run()
+    return profile.total()
+
+def measure(name, engine, repeat=REPEAT, minSeconds=MIN_SECONDS):
+    """
+    Times workload name under engine, in this process.
+
+    :return: dict of instructions, seconds (the fastest run), instructions
+             per second, constructSeconds (the fastest build), runs, and the
+             process's peak RSS in KB
+    """
+    instructions = countInstructions(name)
+    best = construct = float('inf')
+    runs = 0
+    started = perf_counter()
+    while runs < repeat or perf_counter() - started < minSeconds:
+        start = perf_counter()
+        sim = build(name, engine)
+        built = perf_counter()
+        sim.run()
+        finished = perf_counter()
+        construct = min(construct, built - start)
+        best = min(best, finished - built)
+        runs += 1
+
+    return {
+        "instructions": instructions,
+        "seconds": best,
+        "instructionsPerSecond": instructions / best if best > 0 else None,
+        "constructSeconds": construct,
+        "runs": runs,
+        # ru_maxrss is in KB on Linux
+        "peakRssKB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def measureIsolated(name, engine, repeat=REPEAT):
+    "measure() in a fresh process, so peak RSS is for this workload alone"
+    output = subprocess.run(
+        [sys.executable, __file__, "--measure", name, engine, "--repeat", str(repeat)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def runSuite(names=None, engines=None, repeat=REPEAT, isolated=True, log=None):
+    """
+    Measures every combination of workload and engine.
+
+    :param isolated: Run each measurement in its own process
+    :param log: Optional function called with a line of progress
+    :return: dict with information about the machine, and 'results' mapping
+             "workload/engine" to measure()'s results
+    """
+    results = {}
+    for name in names or WORKLOADS:
+        for engine in engines or ENGINES:
+            if isolated:
+                result = measureIsolated(name, engine, repeat)
+            else:
+                result = measure(name, engine, repeat)
+            results[f"{name}/{engine}"] = result
+            if log is not None:
+                log(formatResult(f"{name}/{engine}", result))
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def formatResult(key, result):
+    ips = result["instructionsPerSecond"]
+    return (f"{key:<20}{result['instructions']:>10} instr  {result['seconds'] * 1e3:>9.2f}ms  "
+            f"{(ips or 0) / 1e6:>7.2f}M instr/s  construct {result['constructSeconds'] * 1e3:>6.2f}ms  "
+            f"RSS {result['peakRssKB'] / 1024:>6.1f}MB")
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares results from runSuite() with a baseline from an earlier run.
+
+    :param threshold: Fraction by which instructions/second may drop
+    :return: List of descriptions of the regressions found
+    """
+    regressions = []
+    for key, result in results["results"].items():
+        before = baseline["results"].get(key)
+        if before is None or not before["instructionsPerSecond"] or not result["instructionsPerSecond"]:
+            continue
+        if result["instructions"] != before["instructions"]:
+            regressions.append(f"{key}: executed {result['instructions']} instructions, "
+                               f"baseline {before['instructions']}")
+        change = result["instructionsPerSecond"] / before["instructionsPerSecond"] - 1
+        if change < -threshold:
+            regressions.append(f"{key}: {-change:.1%} fewer instructions/second than baseline")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark IntcodeSim on the intcode puzzles")
+    parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), help="default: all")
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), help="default: all")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="minimum runs per measurement")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved in this JSON file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="fractional slowdown reported as a regression")
+    parser.add_argument("--measure", nargs=2, metavar=("WORKLOAD", "ENGINE"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure, repeat=args.repeat)))
+        return 0
+
+    results = runSuite(args.workloads, args.engines, args.repeat, log=print)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+class TestBench(unittest.TestCase):
+    def test_measure(self):
+        result = measure("q05", "cached", repeat=2, minSeconds=0)
+        self.assertEqual(result["instructions"], countInstructions("q05"))
+        self.assertGreater(result["instructions"], 0)
+        self.assertGreaterEqual(result["runs"], 2)
+        self.assertGreater(result["peakRssKB"], 0)
+
+    def test_isolated(self):
+        suite = runSuite(["q02"], ["reference"], repeat=1)
+        self.assertEqual(suite["results"]["q02/reference"]["instructions"], countInstructions("q02"))
+        json.dumps(suite)
+
+    def test_compare(self):
+        def suite(ips, instructions=100):
+            return {"results": {"q09/compiled": {"instructions": instructions, "instructionsPerSecond": ips}}}
+        self.assertEqual(compare(suite(95), suite(100)), [])
+        self.assertEqual(len(compare(suite(85), suite(100))), 1)
+        self.assertEqual(compare(suite(85), suite(100), threshold=0.2), [])
+        self.assertEqual(len(compare(suite(100, 99), suite(100))), 1)
+        self.assertEqual(compare(suite(100), {"results": {}}), [])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"Decoded instruction cache for IntcodeSim"
+import unittest
+from collections import Counter
+from functools import lru_cache
+from intcode import (IntcodeSim, Instruction, Opcode, Status, Fusion, DispatchTable,
+                     findFusion, instructionSource, indent)
+
+def buildFactory(fullOpcode):
+    """
+    Generates a factory for decoded instructions with the given full opcode.
+
+    The factory is called with the engine, the instruction's address and its
+    raw arguments, and returns a handler that executes the instruction with
+    those baked in. Handlers for instructions that write to memory tell the
+    engine when they write over a cached instruction.
+    """
+    opcode, body, dest = instructionSource(fullOpcode, ["a", "b", "c"], "pos")
+    if dest is not None:
+        body += f"\nif {dest} in owners:\n    invalidate({dest})"
+
+    source = (
+        "def factory(engine, pos, a=0, b=0, c=0):\n"
+        "    owners = engine.owners\n"
+        "    invalidate = engine.invalidate\n"
+        "    def handler(sim):\n"
+        "        arr = sim.arr\n"
+        "        sim.lastOpcode = opcode\n"
+        + indent(body, 2) +
+        "    return handler\n"
+    )
+
+    namespace = {"opcode": opcode}
+    exec(compile(source, f"<intcode factory {fullOpcode}>", "exec"), namespace)
+    return namespace["factory"]
+
+FACTORIES = DispatchTable(buildFactory)
+
+# Opcodes that can start a superinstruction
+FUSABLE = {Opcode.ADD, Opcode.LESS_THAN, Opcode.EQUALS, Opcode.ADJUST_RELBASE}
+
+@lru_cache(maxsize=None)
+def buildFusedFactory(fusion, firstOpcode, secondOpcode, forwarded, counted=False):
+    """
+    Generates a factory for superinstructions made of two adjacent
+    instructions, matching the given Fusion.
+
+    The factory is called with the engine, the first instruction's address,
+    then the raw arguments of the first and second instructions (padded to
+    three each). The handler returns 1 if it stopped after the first
+    instruction. forwarded lists the input arguments of the second instruction
+    that read the result of the first; they're passed the result directly
+    rather than reading it back from memory. If counted is set, the handler
+    adds each execution to the engine's 'fused' Counter.
+    """
+    opcode1, body1, dest1 = instructionSource(
+        firstOpcode, ["a", "b", "c"], "pos", result="value" if forwarded else None)
+    opcode2, body2, dest2 = instructionSource(
+        secondOpcode, ["d", "e", "f"], "second",
+        inputs=["value" if i in forwarded else None for i in range(2)])
+
+    body = body1
+    if dest1 is not None:
+        # If the first instruction wrote over cached code (which might be the
+        # second instruction), stop here and let the engine re-decode.
+        body += f"\nif {dest1} in owners:\n    invalidate({dest1})\n    return 1"
+    if counted:
+        body += "\nfused[fusion] += 1"
+    body += "\nsim.lastOpcode = opcode2"
+    body += "\n" + body2
+    if dest2 is not None:
+        body += f"\nif {dest2} in owners:\n    invalidate({dest2})"
+
+    source = (
+        "def factory(engine, pos, a, b, c, d, e, f):\n"
+        "    owners = engine.owners\n"
+        "    invalidate = engine.invalidate\n"
+        "    fused = engine.fused\n"
+        f"    second = pos + {opcode1.op.args + 1}\n"
+        "    def handler(sim):\n"
+        "        arr = sim.arr\n"
+        "        sim.lastOpcode = opcode1\n"
+        + indent(body, 2) +
+        "    return handler\n"
+    )
+
+    namespace = {"opcode1": opcode1, "opcode2": opcode2, "fusion": fusion}
+    exec(compile(source, f"<intcode factory {fusion.name}>", "exec"), namespace)
+    return namespace["factory"]
+
+def padArgs(instruction):
+    "return the instruction's arguments, padded to 3 with zeroes"
+    return instruction.args + [0] * (3 - len(instruction.args))
+
+class InstructionCache(dict):
+    "Maps addresses to decoded instruction handlers, decoding on a miss"
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    def __missing__(self, address):
+        return self.engine.decode(address)
+
+class DecodeCacheEngine:
+    """
+    Execution engine that decodes each instruction once, the first time it is
+    executed, and keeps the decoded handler (with its arguments already read
+    from memory) for every later visit.
+
+    Writes that land inside a cached instruction discard it, so self-modifying
+    code is re-decoded before it next runs.
+
+    If fuse is set, pairs of instructions matching one of the Fusion patterns
+    are cached as a single superinstruction. Counting how often each one runs
+    costs a little on every execution, so is only done if countFused is set.
+
+    :attribute hits: Number of handlers executed from the cache
+    :attribute misses: Number of handlers that had to be decoded
+    :attribute invalidations: Number of cached handlers discarded after
+                              being written to
+    :attribute fused: Counter of superinstructions executed, by Fusion
+                      (only if countFused is set)
+    :attribute fusedDecoded: Counter of superinstructions decoded, by Fusion
+    """
+
+    def __init__(self, sim, fuse=False, countFused=False):
+        self.sim = sim
+        self.fuse = fuse
+        self.countFused = countFused
+        sim.engine = self
+
+        # Address -> handler
+        self.cache = InstructionCache(self)
+        # Address of cached instruction -> its length
+        self.spans = {}
+        # Address -> set of cached instruction addresses covering it
+        self.owners = {}
+        # Addresses of cached superinstructions
+        self.pairs = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.fused = Counter()
+        self.fusedDecoded = Counter()
+
+    def decode(self, address):
+        "decode the instruction at address, add it to the cache and return its handler"
+        first = Instruction.decode(self.sim.arr, address)
+
+        fused = None
+        if self.fuse and first.opcode in FUSABLE:
+            fused = self.decodeFused(first)
+
+        if fused is not None:
+            handler, length = fused
+            self.pairs.add(address)
+        else:
+            handler = FACTORIES[first.fullOpcode](self, address, *first.args)
+            length = first.length()
+
+        self.cache[address] = handler
+        self.spans[address] = length
+        for a in range(address, address + length):
+            self.owners.setdefault(a, set()).add(address)
+
+        self.misses += 1
+        return handler
+
+    def decodeFused(self, first):
+        """
+        If first and the instruction following it can be fused, returns a
+        handler for the superinstruction and its length, otherwise None.
+        """
+        try:
+            second = Instruction.decode(self.sim.arr, first.address + first.length())
+        except ValueError:
+            return None
+
+        fusion = findFusion(first, second)
+        if fusion is None:
+            return None
+
+        forwarded = ()
+        if fusion != Fusion.RELBASE_ACCESS:
+            forwarded = tuple(second.readsOf(first.dest()))
+
+        try:
+            factory = buildFusedFactory(fusion, first.fullOpcode, second.fullOpcode, forwarded,
+                                        self.countFused)
+        except ValueError:
+            # The second instruction is invalid: leave it to raise by itself
+            return None
+
+        handler = factory(self, first.address, *padArgs(first), *padArgs(second))
+        self.fusedDecoded[fusion] += 1
+        return handler, first.length() + second.length()
+
+    def invalidate(self, address):
+        "discard any cached instructions that cover address"
+        starts = self.owners.get(address)
+        if not starts:
+            return
+
+        for start in list(starts):
+            del self.cache[start]
+            self.pairs.discard(start)
+            for a in range(start, start + self.spans.pop(start)):
+                self.owners[a].discard(start)
+                if not self.owners[a]:
+                    del self.owners[a]
+            self.invalidations += 1
+
+    def run(self, maxSteps=None):
+        """
+        Execute until the program finishes, or maxSteps instructions have been
+        executed. Returns the number of instructions executed if maxSteps is set.
+        """
+        sim = self.sim
+        cache = self.cache
+        steps = 0
+        misses = self.misses
+        try:
+            if maxSteps is None:
+                while not sim.finished:
+                    steps += 1
+                    cache[sim.pos](sim)
+                return None
+
+            pairs = self.pairs
+            remaining = maxSteps
+            while remaining > 0 and not sim.finished:
+                steps += 1
+                pos = sim.pos
+                handler = cache[pos]
+                if pos not in pairs:
+                    handler(sim)
+                    remaining -= 1
+                elif remaining > 1:
+                    remaining -= handler(sim) or 2
+                else:
+                    # No room for both instructions: run the first by itself
+                    self.single(pos)(sim)
+                    remaining -= 1
+            return maxSteps - remaining
+        finally:
+            self.hits += steps - (self.misses - misses)
+
+    def single(self, address):
+        "return an uncached handler for just the instruction at address"
+        instruction = Instruction.decode(self.sim.arr, address)
+        return FACTORIES[instruction.fullOpcode](self, address, *instruction.args)
+
+
+class TestDecodeCache(unittest.TestCase):
+    def run_cached(self, code, inputs=(), fuse=False):
+        i = IntcodeSim(code)
+        engine = DecodeCacheEngine(i, fuse=fuse, countFused=fuse)
+        for value in inputs:
+            i.queueInput(value)
+        i.run()
+        return i, engine
+
+    def test_matches_interpreter(self):
+        code = "3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99"
+        for number in (7, 8, 9):
+            i, _ = self.run_cached(code, [number])
+            reference = IntcodeSim(code).queueInput(number).run()
+            self.assertEqual(i.outputs, reference.outputs)
+            self.assertEqual(i.arr, reference.arr)
+
+    def test_self_modifying(self):
+        i, engine = self.run_cached([1,1,1,4,99,5,6,0,99])
+        self.assertEqual(i.arr, [30,1,1,4,2,5,6,0,99])
+        self.assertEqual(engine.invalidations, 1)
+
+    def test_invalidation(self):
+        # Outputs the immediate at address 1, then increments it; loops 3 times
+        code = [104,5, 1001,1,1,1, 1001,20,-1,20, 1005,20,0, 99, 0,0,0,0,0,0, 3]
+        i, engine = self.run_cached(code)
+        self.assertEqual(i.outputs, [5, 6, 7])
+        self.assertEqual(engine.invalidations, 3)
+        self.assertEqual(engine.hits + engine.misses, 13)
+        self.assertEqual(engine.misses, 7)
+
+    def test_set_memory(self):
+        i, engine = self.run_cached([1105,1,3,104,1,99])
+        self.assertEqual(i.outputs, [1])
+        # Patching a cached instruction must invalidate it
+        i.setMemory(4, 2)
+        i.pos = 0
+        i.finished = False
+        i.run()
+        self.assertEqual(i.outputs, [1, 2])
+        self.assertEqual(engine.invalidations, 1)
+
+    def assertFusedMatches(self, code, inputs=()):
+        "run code with and without fusion, compare the results and return the fused engine"
+        i, engine = self.run_cached(code, inputs, fuse=True)
+        reference = IntcodeSim(code)
+        for value in inputs:
+            reference.queueInput(value)
+        reference.run()
+        self.assertEqual(i.arr, reference.arr)
+        self.assertEqual(i.pos, reference.pos)
+        self.assertEqual(i.relativeBase, reference.relativeBase)
+        self.assertEqual(i.outputs, reference.outputs)
+        self.assertEqual(i.lastOpcode, reference.lastOpcode)
+        return engine
+
+    def test_fusion(self):
+        # Counts down from 3: an add, then compare + branch on the counter
+        code = [1001,20,-1,20, 1007,20,1,21, 1006,21,0, 104,7, 99, 0,0,0,0,0,0, 3,0]
+        engine = self.assertFusedMatches(code)
+        self.assertEqual(engine.fused[Fusion.ADD_COMPARE], 3)
+
+        # Counts down from 3: compare + branch, then the add
+        code = [1007,20,1,21, 1005,21,15, 1001,20,-1,20, 1105,1,0, 99, 104,7, 99, 0,0, 3,0]
+        engine = self.assertFusedMatches(code)
+        self.assertEqual(engine.fused[Fusion.COMPARE_BRANCH], 4)
+
+        # Relative base adjustment followed by a relative load
+        engine = self.assertFusedMatches([109,10,204,-5,99,42])
+        self.assertEqual(engine.fused[Fusion.RELBASE_ACCESS], 1)
+
+    def test_fusion_self_modifying(self):
+        # The compare writes its flag over the following jump's target, which
+        # then jumps to 0 (if the flag is 0) or falls through. Counts down from 3.
+        code = [1001,20,-1,20, 1007,20,1,10, 1006,10,5, 99, 0,0,0,0,0,0,0,0, 3]
+        engine = self.assertFusedMatches(code)
+        self.assertEqual(engine.fused[Fusion.ADD_COMPARE], 3)
+        # The jump isn't cached yet the first time round
+        self.assertEqual(engine.invalidations, 2)
+
+    def test_fusion_programs(self):
+        code = "3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99"
+        for number in (7, 8, 9):
+            self.assertFusedMatches(code, [number])
+        self.assertFusedMatches([1,1,1,4,99,5,6,0,99])
+        self.assertFusedMatches([109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99])
+
+    def test_max_steps_splits_pairs(self):
+        # Every step lands between or on the two halves of a fused pair
+        code = [1101,1,2,20, 1008,20,3,21, 1005,21,12, 99, 1001,20,-3,20, 99]
+        reference = IntcodeSim(code)
+        i = IntcodeSim(code)
+        engine = DecodeCacheEngine(i, fuse=True)
+        while i.runUntilIO(maxSteps=1) == Status.PREEMPTED:
+            reference.runUntilIO(maxSteps=1)
+            self.assertEqual((i.pos, i.arr), (reference.pos, reference.arr))
+        self.assertEqual(i.arr[20], 0)
+        self.assertTrue(engine.pairs)
+
+    def test_fusion_survives_invalidation(self):
+        # The counter at 32 is first executed as part of the jump at 30, so the
+        # add's first write to it invalidates that jump. After that the fused
+        # add + compare should run in full.
+        code = [1105,1,30, 1001,32,-1,32, 1007,32,1,33, 1006,33,3, 99]
+        code += [0] * (30 - len(code)) + [1105,1,3]
+        engine = self.assertFusedMatches(code)
+        self.assertEqual(engine.invalidations, 1)
+        self.assertEqual(engine.fused[Fusion.ADD_COMPARE], 2)
+        self.assertNotIn(32, engine.owners)
@@ -0,0 +1,176 @@
+"Checkpoint file format for IntcodeSim (see IntcodeSim.save and IntcodeSim.load)"
+import hashlib
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+from collections import deque
+import intcode
+import intcode_image
+
+MAGIC = b"INTCODE\0"
+VERSION = 1
+
+# magic, version, program digest, pos, relativeBase, memory length,
+# finished, output cursor
+HEADER = struct.Struct("<8sH32sqqQ?Q")
+COUNT = struct.Struct("<Q")
+
+# How a list of numbers is stored
+INT64, TEXT = 0, 1
+
+def programDigest(memory):
+    "SHA-256 identifying a program, given the memory it starts with"
+    return hashlib.sha256(",".join(map(str, memory)).encode()).digest()
+
+def _writeNumbers(f, values):
+    """
+    write values as int64s, or as text if any are too big, or None (a queued
+    None input, which terminates the machine)
+    """
+    try:
+        kind, data = INT64, array('q', values).tobytes()
+    except (OverflowError, TypeError):
+        kind, data = TEXT, ",".join(map(str, values)).encode()
+    f.write(bytes([kind]) + COUNT.pack(len(data)) + data)
+
+def _readNumbers(f):
+    kind = f.read(1)[0]
+    (size,) = COUNT.unpack(f.read(COUNT.size))
+    data = f.read(size)
+    if kind == INT64:
+        values = array('q')
+        values.frombytes(data)
+        return values.tolist()
+    if kind == TEXT:
+        return [None if x == "None" else int(x) for x in data.decode().split(",")]
+    raise ValueError(f"unknown number encoding {kind}")
+
+def dump(sim, f):
+    """
+    Write sim's state to the binary file f. Only the pages of memory that
+    differ from the program the machine started with are written.
+    """
+    if not all(value is None or isinstance(value, int) for value in sim.queuedInputs):
+        raise ValueError("only integer (or None) inputs can be saved")
+
+    source = (sim.source or "").encode()
+    f.write(HEADER.pack(MAGIC, VERSION, programDigest(sim.image), sim.pos, sim.relativeBase,
+                        len(sim.arr), sim.finished, sim.outputCursor + len(sim.outputs)))
+    f.write(struct.pack("<H", len(source)) + source)
+    _writeNumbers(f, sim.queuedInputs)
+
+    pages = list(sim.arr.changedPages(sim.image))
+    f.write(COUNT.pack(len(pages)))
+    for number, cells in pages:
+        f.write(COUNT.pack(number))
+        _writeNumbers(f, cells)
+
+def save(sim, path):
+    "write a checkpoint of sim to path, atomically"
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            dump(sim, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def restore(cls, f, code=None, engine=None):
+    """
+    Read a machine saved by dump() from the binary file f.
+
+    :param cls: IntcodeSim class to create
+    :param code: The program the machine was running. If not given, it is
+                 loaded from the file the machine was created from.
+    :return: The machine
+    """
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("not an intcode checkpoint")
+    _, version, digest, pos, relativeBase, length, finished, outputCursor = HEADER.unpack(header)
+    if version != VERSION:
+        raise ValueError(f"unsupported checkpoint version {version}")
+    (size,) = struct.unpack("<H", f.read(2))
+    source = f.read(size).decode() or None
+
+    if code is None:
+        if source is None:
+            raise ValueError("checkpoint doesn't record its program: pass code")
+        code = intcode_image.load(source).memory()
+    sim = cls(code)
+    if programDigest(sim.image) != digest:
+        raise ValueError("checkpoint was saved from a different program")
+
+    sim.source = source
+    sim.queuedInputs = deque(_readNumbers(f))
+    (count,) = COUNT.unpack(f.read(COUNT.size))
+    for _ in range(count):
+        (number,) = COUNT.unpack(f.read(COUNT.size))
+        sim.arr.setPage(number, _readNumbers(f))
+    sim.arr.length = length
+    sim.pos = pos
+    sim.relativeBase = relativeBase
+    sim.finished = finished
+    sim.outputCursor = outputCursor
+    # Memory has been replaced, so start the engine afterwards
+    return sim.setEngine(engine)
+
+def load(cls, path, code=None, engine=None):
+    "read a checkpoint written by save()"
+    with open(path, 'rb') as f:
+        return restore(cls, f, code, engine)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "checkpoint")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        sim = intcode.IntcodeSim.fromFile('inputs/q09').queueInput(2)
+        sim.runUntilIO(maxSteps=100000)
+        sim.queueInput(2 ** 70)
+        sim.save(self.path)
+        # Most of memory is the original program, which isn't saved
+        self.assertLess(os.path.getsize(self.path), 3 * 8 * 1024)
+
+        restored = intcode.IntcodeSim.load(self.path, engine="cached")
+        self.assertEqual(restored.arr, sim.arr)
+        self.assertEqual((restored.pos, restored.relativeBase, list(restored.queuedInputs)),
+                         (sim.pos, sim.relativeBase, [2 ** 70]))
+        self.assertEqual(restored.run().outputs, sim.run().outputs)
+
+    def test_output_cursor(self):
+        sim = intcode.IntcodeSim("104,1,104,2,104,3,99")
+        sim.runUntilIO()
+        sim.save(self.path)
+        restored = intcode.IntcodeSim.load(self.path, code="104,1,104,2,104,3,99").run()
+        self.assertEqual((restored.outputCursor, restored.outputs), (1, [2, 3]))
+
+    def test_wrong_program(self):
+        intcode.IntcodeSim("104,1,99").save(self.path)
+        with self.assertRaises(ValueError):
+            intcode.IntcodeSim.load(self.path)
+        with self.assertRaises(ValueError):
+            intcode.IntcodeSim.load(self.path, code="104,2,99")
+        with open(self.path, 'wb') as f:
+            f.write(b"nonsense")
+        with self.assertRaises(ValueError):
+            intcode.IntcodeSim.load(self.path, code="104,1,99")
+
+    def test_automatic(self):
+        "a run killed part way through resumes from its last checkpoint"
+        reference = intcode.IntcodeSim.fromFile('inputs/q09').queueInput(2).run()
+
+        sim = intcode.IntcodeSim.fromFile('inputs/q09').queueInput(2)
+        sim.setCheckpoint(self.path, every=50000)
+        self.assertEqual(sim.runUntilIO(maxSteps=175000), intcode.Status.PREEMPTED)
+        restored = intcode.IntcodeSim.load(self.path)
+        self.assertEqual(restored.run().outputs, reference.outputs)
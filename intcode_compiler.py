@@ -0,0 +1,294 @@
+"Basic block compiler for IntcodeSim"
+import unittest
+from intcode import IntcodeSim, Opcode, DISPATCH, instructionSource, indent
+
+# Instructions that end a basic block: anything that changes control flow
+# or talks to the outside world.
+BLOCK_TERMINATORS = {
+    Opcode.INPUT,
+    Opcode.OUTPUT,
+    Opcode.JUMP_IF_TRUE,
+    Opcode.JUMP_IF_FALSE,
+    Opcode.END,
+}
+
+# Upper bound on the number of instructions compiled into one block
+MAX_BLOCK_LENGTH = 64
+
+class BlockCache(dict):
+    "Maps addresses to compiled blocks, compiling on a miss"
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    def __missing__(self, address):
+        return self.engine.compileBlock(address)
+
+class CompilingEngine:
+    """
+    Execution engine that compiles each basic block of intcode into a Python
+    function, with opcodes, parameter modes and arguments baked into the
+    source. Blocks are compiled the first time execution reaches them and
+    chained together by address.
+
+    If the program writes to memory that a compiled block was built from, the
+    block is thrown away and execution returns to the dispatcher, which
+    recompiles from the next instruction. Cells that have been written to in
+    this way are marked volatile: later compilations read them from memory
+    rather than baking them in, so programs that patch their own arguments
+    (a common way to index arrays in intcode) don't recompile every time.
+
+    :attribute blocksCompiled: Number of blocks compiled
+    :attribute invalidations: Number of compiled blocks discarded after being
+                              written to
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        sim.engine = self
+
+        # Address -> compiled block
+        self.blocks = BlockCache(self)
+        # Address of compiled block -> number of instructions in it
+        self.lengths = {}
+        # (address, length) -> block truncated to length instructions
+        self.partials = {}
+        # Address of compiled block -> addresses baked into it
+        self.spans = {}
+        # Address -> set of compiled block addresses baked from it
+        self.owners = {}
+        # Addresses that have been overwritten after being compiled
+        self.volatile = set()
+
+        self.blocksCompiled = 0
+        self.invalidations = 0
+
+    def blockSource(self, address, maxLength=MAX_BLOCK_LENGTH):
+        """
+        Returns the source of a function executing the basic block starting at
+        address (up to maxLength instructions), the addresses baked into it,
+        and the opcodes it references.
+
+        If the block stops early, because it wrote over compiled code, the
+        function returns the number of instructions it executed.
+        """
+        arr = self.sim.arr
+        lines = []
+        baked = []
+        opcodes = {}
+        pos = address
+
+        while len(opcodes) < maxLength:
+            fullOpcode = arr[pos]
+            try:
+                opcode, _ = IntcodeSim.parseOpcode(fullOpcode)
+                length = opcode.op.args + 1
+                operands = []
+                for k in range(1, length):
+                    if pos + k in self.volatile:
+                        operands.append(f"arr[{pos + k}]")
+                    else:
+                        operands.append(str(arr[pos + k]))
+                opcode, body, dest = instructionSource(fullOpcode, operands, str(pos))
+            except ValueError:
+                # Not a valid instruction: leave it for the interpreter to
+                # complain about, if we ever get there.
+                break
+
+            # The opcode is always baked in, even if volatile
+            baked.append(pos)
+            baked += [a for a in range(pos + 1, pos + length) if a not in self.volatile]
+            opcodes[pos] = opcode
+            name = f"op{pos}"
+
+            last = opcode in BLOCK_TERMINATORS or len(opcodes) == maxLength
+            if last:
+                lines.append(f"sim.lastOpcode = {name}")
+            lines.append(body)
+
+            if dest is not None:
+                if last:
+                    lines.append(f"if {dest} in owners:\n"
+                                 f"    invalidate({dest})")
+                else:
+                    # Leave the block if we've overwritten compiled code, as
+                    # it may be this block.
+                    lines.append(f"if {dest} in owners:\n"
+                                 f"    sim.lastOpcode = {name}\n"
+                                 f"    invalidate({dest})\n"
+                                 f"    return {len(opcodes)}")
+            if last:
+                break
+            pos += length
+
+        source = (
+            "def block(sim):\n"
+            "    arr = sim.arr\n"
+            + "".join(indent(line) for line in lines)
+        )
+        return source, baked, opcodes
+
+    def compileBlock(self, address):
+        "compile the block starting at address, add it to the cache and return it"
+        source, baked, opcodes = self.blockSource(address)
+        if not opcodes:
+            # The instruction at address is invalid: let the interpreter raise
+            return DISPATCH[self.sim.arr[address]]
+
+        block = self.define(source, address, opcodes)
+        self.blocks[address] = block
+        self.lengths[address] = len(opcodes)
+        self.spans[address] = baked
+        for a in baked:
+            self.owners.setdefault(a, set()).add(address)
+        self.blocksCompiled += 1
+        return block
+
+    def partialBlock(self, address, length):
+        """
+        Returns a function executing only the first length instructions of the
+        (already compiled) block at address. These aren't tracked separately:
+        they are thrown away whenever any block is invalidated.
+        """
+        block = self.partials.get((address, length))
+        if block is None:
+            source, _, opcodes = self.blockSource(address, length)
+            block = self.partials[address, length] = self.define(source, address, opcodes)
+        return block
+
+    def define(self, source, address, opcodes):
+        "compile block source, returning the function"
+        namespace = {f"op{pos}": opcode for pos, opcode in opcodes.items()}
+        namespace["owners"] = self.owners
+        namespace["invalidate"] = self.invalidate
+        exec(compile(source, f"<intcode block {address}>", "exec"), namespace)
+        return namespace["block"]
+
+    def invalidate(self, address):
+        "discard any compiled blocks built from address"
+        starts = self.owners.get(address)
+        if not starts:
+            return
+
+        self.volatile.add(address)
+        self.partials.clear()
+        for start in list(starts):
+            del self.blocks[start]
+            del self.lengths[start]
+            for a in self.spans.pop(start):
+                self.owners[a].discard(start)
+                if not self.owners[a]:
+                    del self.owners[a]
+            self.invalidations += 1
+
+    def run(self, maxSteps=None):
+        """
+        Execute until the program finishes, or maxSteps instructions have been
+        executed. Returns the number of instructions executed if maxSteps is set.
+        """
+        sim = self.sim
+        blocks = self.blocks
+        if maxSteps is None:
+            while not sim.finished:
+                blocks[sim.pos](sim)
+            return None
+
+        lengths = self.lengths
+        remaining = maxSteps
+        while remaining > 0 and not sim.finished:
+            pos = sim.pos
+            block = blocks[pos]
+            # Invalid instructions aren't compiled, and count as one step
+            length = lengths.get(pos, 1)
+            if length > remaining:
+                # Finish the budget one instruction at a time: single
+                # instructions are more likely to be reused than a block
+                # truncated to whatever budget happens to be left.
+                block = self.partialBlock(pos, 1)
+                length = 1
+            remaining -= block(sim) or length
+        return maxSteps - remaining
+
+
+class TestCompiler(unittest.TestCase):
+    def assertSameState(self, code, inputs=()):
+        "run code under the interpreter and compiler, and compare the results"
+        reference = IntcodeSim(code)
+        compiled = IntcodeSim(code)
+        engine = CompilingEngine(compiled)
+        for i in (reference, compiled):
+            for value in inputs:
+                i.queueInput(value)
+            i.run()
+
+        self.assertEqual(compiled.arr, reference.arr)
+        self.assertEqual(compiled.pos, reference.pos)
+        self.assertEqual(compiled.relativeBase, reference.relativeBase)
+        self.assertEqual(compiled.outputs, reference.outputs)
+        self.assertEqual(compiled.lastOpcode, reference.lastOpcode)
+        return compiled, engine
+
+    def test_examples(self):
+        self.assertSameState([1,1,1,4,99,5,6,0,99])
+        self.assertSameState("1,9,10,3,2,3,11,0,99,30,40,50")
+        self.assertSameState([109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99])
+        self.assertSameState([1102,34915192,34915192,7,4,7,99,0])
+        self.assertSameState([109,10,203,0,4,10,99], [42])
+        code = "3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99"
+        for number in (7, 8, 9):
+            self.assertSameState(code, [number])
+
+    def test_self_modifying_block(self):
+        # The first add rewrites the following instruction (in the same block)
+        # from an immediate-mode add into a position-mode multiply
+        code = [1101,1,1,4, 1101,3,4,13, 99, 0,0,0,0,0]
+        compiled, engine = self.assertSameState(code)
+        self.assertEqual(compiled.arr[13], 4 * 2)
+        self.assertEqual(engine.invalidations, 1)
+
+    def test_volatile_operands(self):
+        # Outputs the immediate at address 1, then increments it; loops 5 times
+        code = [104,5, 1001,1,1,1, 1001,20,-1,20, 1005,20,0, 99, 0,0,0,0,0,0, 5]
+        compiled, engine = self.assertSameState(code)
+        self.assertEqual(compiled.outputs, [5, 6, 7, 8, 9])
+        # Once address 1 is known to be volatile, it's no longer baked in
+        self.assertEqual(engine.invalidations, 1)
+
+    def test_volatile_opcode(self):
+        # Alternately rewrites the instruction at address 0 between an
+        # add (1) and a multiply (2); loops 4 times
+        code = [1,30,31,32, 4,32, 1002,0,-1,0, 1001,0,3,0, 1001,33,-1,33, 1005,33,0, 99,
+                0,0,0,0,0,0,0,0, 3,4,0,4]
+        compiled, engine = self.assertSameState(code)
+        self.assertEqual(compiled.outputs, [7, 12, 7, 12])
+        # Once per loop: the second write finds nothing compiled there
+        self.assertEqual(engine.invalidations, 4)
+
+    def test_q09(self):
+        i = IntcodeSim.fromFile('inputs/q09')
+        CompilingEngine(i)
+        i.queueInput(2).run()
+        self.assertEqual(i.outputs, [68938])
+
+    def test_input_into_compiled_code(self):
+        # Reads input over the immediate of the output instruction, 3 times
+        code = [104,0, 3,1, 1001,20,-1,20, 1005,20,0, 99] + [0] * 8 + [3]
+        compiled, _ = self.assertSameState(code, [7, 8, 9])
+        self.assertEqual(compiled.outputs, [0, 7, 8])
+
+    def test_write_at_block_limit(self):
+        # The 64th instruction of the first block rewrites the first block's
+        # initial immediate; the block is then run again.
+        code = [1101,3,0,500] + [1101,0,0,501] * 62 + [1101,7,0,1]
+        code += [4,500, 1001,600,-1,600, 1005,600,0, 99]
+        code += [0] * (600 - len(code)) + [2]
+        compiled, _ = self.assertSameState(code)
+        self.assertEqual(compiled.outputs, [3, 7])
+
+    def test_volatile_cells_settle(self):
+        # Once a cell is volatile, writing to it shouldn't split blocks
+        code = [104,5, 1001,1,1,1, 1001,20,-1,20, 1005,20,0, 99, 0,0,0,0,0,0, 50]
+        compiled, engine = self.assertSameState(code)
+        self.assertEqual(engine.invalidations, 1)
+        self.assertNotIn(1, engine.owners)
+        self.assertLess(engine.blocksCompiled, 6)
@@ -0,0 +1,392 @@
+"Differential conformance testing for IntcodeSim engines"
+import random
+import unittest
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Optional
+from intcode import IntcodeSim, ENGINES, Opcode, ParameterMode, Status
+
+@dataclass
+class Snapshot:
+    """
+    The state of a machine at an I/O boundary.
+
+    :param event: 'input', 'output', 'halt' or 'error'
+    :param value: The value input or output, or the exception raised
+    """
+    event: str
+    value: object
+    arr: List[int]
+    pos: int
+    relativeBase: int
+    outputs: List[int]
+    lastOpcode: Optional[Opcode] = None
+
+class EngineMismatch(Exception):
+    "Raised when two engines disagree about the state of a program"
+
+def traceEngine(code, engine, setup=None):
+    """
+    Runs code under the given engine, returning a Snapshot for every I/O
+    boundary and a final one for the state at halt (or the exception raised).
+
+    :param code: intcode, as accepted by IntcodeSim
+    :param engine: Engine name or factory, as accepted by IntcodeSim
+    :param setup: Optional function called with the IntcodeSim before running,
+                  which may patch memory, queue inputs or set inputFn/outputFn.
+                  If the program runs out of inputs, it is terminated rather
+                  than prompting on STDIN.
+    """
+    sim = IntcodeSim(code, engine=engine)
+    if setup is not None:
+        setup(sim)
+
+    trace = []
+    def snapshot(event, value):
+        trace.append(Snapshot(event, value, list(sim.arr), sim.pos, sim.relativeBase,
+                              list(sim.outputs), sim.lastOpcode))
+
+    # Take over the input queue so that every input passes through here
+    queued, sim.queuedInputs = sim.queuedInputs, deque()
+    inputFn, outputFn = sim.inputFn, sim.outputFn
+
+    def recordInput():
+        if queued:
+            value = queued.popleft()
+        elif inputFn is not None:
+            value = inputFn()
+        else:
+            value = None
+        snapshot('input', value)
+        return value
+
+    def recordOutput(value):
+        snapshot('output', value)
+        if outputFn is not None:
+            outputFn(value)
+
+    sim.inputFn = recordInput
+    sim.outputFn = recordOutput
+    try:
+        sim.run()
+        snapshot('halt', None)
+    except Exception as e:
+        snapshot('error', f"{type(e).__name__}: {e}")
+
+    return trace
+
+def compareEngines(code, engines=None, setup=None):
+    """
+    Runs code under each engine (with a fresh call to setup for each), and
+    checks that every engine passes through the same I/O boundaries as the
+    first, with identical memory, pos, relativeBase and outputs at each.
+
+    :param engines: List of engine names; defaults to all of ENGINES
+    :return: The number of snapshots compared
+    :raises EngineMismatch: describing the first difference found
+    """
+    engines = list(engines or ENGINES)
+    reference = traceEngine(code, engines[0], setup)
+
+    for engine in engines[1:]:
+        trace = traceEngine(code, engine, setup)
+        for step, (expected, got) in enumerate(zip(reference, trace)):
+            if expected != got:
+                for name in expected.__dataclass_fields__:
+                    if getattr(expected, name) != getattr(got, name):
+                        break
+                raise EngineMismatch(
+                    f"engine '{engine}' differs from '{engines[0]}' at {expected.event} "
+                    f"#{step}: {name} is {getattr(got, name)!r}, "
+                    f"expected {getattr(expected, name)!r}")
+
+        if len(trace) != len(reference):
+            raise EngineMismatch(
+                f"engine '{engine}' has {len(trace)} I/O boundaries, "
+                f"'{engines[0]}' has {len(reference)}")
+
+    return len(reference)
+
+def randomProgram(rng, length=30, dataSize=16, loopChance=0.1, patchChance=0.1):
+    """
+    Generates a random intcode program that always terminates: `length`
+    random instructions followed by END, then `dataSize` data cells.
+
+    Jumps only go forwards, except for loops: a counter that is decremented,
+    then tested, then a jump backwards while it is positive. The relative base
+    only increases, and relative addresses always land after the code.
+
+    Some writes go to the immediate arguments of other instructions, to
+    exercise self-modifying code. Patch loops make sure patched code is run
+    again: an output of an immediate, then an INPUT or ADD that overwrites
+    that immediate, then a loop back to the output.
+
+    :param rng: A random.Random
+    :param loopChance: Probability of adding a loop after each instruction
+    :param patchChance: Probability of adding a patch loop after each instruction
+    :return: list of ints
+    """
+    POSITION, IMMEDIATE, RELATIVE = ParameterMode
+    body = [op for op in Opcode if op != Opcode.END]
+
+    def loopTail(loop, target):
+        "instructions that decrement the loop's counter and jump to target while positive"
+        return [
+            (Opcode.ADD, [POSITION, IMMEDIATE, POSITION], ('decrement', loop)),
+            (Opcode.LESS_THAN, [IMMEDIATE, POSITION, POSITION], ('test', loop)),
+            (Opcode.JUMP_IF_TRUE, [POSITION, IMMEDIATE], ('jump', loop, target)),
+        ]
+
+    def isEntry(shape):
+        "whether jumping to shape is safe: not into the middle of a loop tail"
+        return shape[2] is None or shape[2][0] in ('output', 'decrement')
+
+    # First pass: choose opcodes and modes, so we know where everything is.
+    # Instructions that are part of a loop are tagged; jump targets are
+    # instruction indexes.
+    shapes = []
+    loops = 0
+    for _ in range(length):
+        opcode = rng.choice(body)
+        modes = [rng.choice(list(ParameterMode)) for _ in range(opcode.op.inputs())]
+        modes += [rng.choice([POSITION, RELATIVE]) for _ in range(opcode.op.posArgs)]
+        if opcode in (Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE):
+            modes[1] = IMMEDIATE
+        elif opcode == Opcode.ADJUST_RELBASE:
+            modes[0] = IMMEDIATE
+        shapes.append((opcode, modes, None))
+
+        if rng.random() < loopChance:
+            target = rng.choice([i for i, shape in enumerate(shapes) if isEntry(shape)])
+            shapes += loopTail(loops, target)
+            loops += 1
+
+        if rng.random() < patchChance:
+            output = len(shapes)
+            shapes.append((Opcode.OUTPUT, [IMMEDIATE], ('output',)))
+            if rng.random() < 0.5:
+                shapes.append((Opcode.INPUT, [POSITION], ('patch', output)))
+            else:
+                shapes.append((Opcode.ADD, [IMMEDIATE, IMMEDIATE, POSITION], ('patch', output)))
+            shapes += loopTail(loops, output)
+            loops += 1
+    shapes.append((Opcode.END, [], None))
+
+    addresses = []
+    codeEnd = 0
+    for opcode, modes, _ in shapes:
+        addresses.append(codeEnd)
+        codeEnd += len(modes) + 1
+    dataEnd = codeEnd + dataSize
+
+    # Loop counters (and the flag testing them) live out of reach of the
+    # random writes. Each loop jumps back at most 4 times, so no instruction
+    # runs more than 4 * loops + 1 times, and the relative base can't grow by
+    # more than 5 per instruction run.
+    counters = dataEnd + 5 * len(shapes) * (4 * loops + 1) + 1
+
+    # Immediate arguments that are safe to overwrite with any value
+    patchable = [
+        addresses[i] + k + 1
+        for i, (opcode, modes, tag) in enumerate(shapes)
+        if opcode in (Opcode.ADD, Opcode.MULTIPLY, Opcode.LESS_THAN, Opcode.EQUALS, Opcode.OUTPUT)
+        and (tag is None or tag[0] == 'output')
+        for k, mode in enumerate(modes) if mode == IMMEDIATE
+    ]
+
+    code = []
+    for i, (opcode, modes, tag) in enumerate(shapes):
+        code.append(opcode + sum(mode.value * 10 ** (k + 2) for k, mode in enumerate(modes)))
+
+        if tag is not None and tag[0] != 'output':
+            if tag[0] == 'patch':
+                # Overwrite the output's immediate, with input or a sum
+                if opcode == Opcode.ADD:
+                    code += [rng.randint(-10, 10), rng.randint(-10, 10)]
+                code.append(addresses[tag[1]] + 1)
+                continue
+
+            counter, flag = counters + 2 * tag[1], counters + 2 * tag[1] + 1
+            if tag[0] == 'decrement':
+                code += [counter, -1, counter]
+            elif tag[0] == 'test':
+                code += [0, counter, flag]
+            else:
+                code += [flag, addresses[tag[2]]]
+            continue
+
+        for k, mode in enumerate(modes):
+            if opcode in (Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE) and k == 1:
+                code.append(rng.choice([a for a, shape in zip(addresses[i + 1:], shapes[i + 1:])
+                                        if isEntry(shape)]))
+            elif opcode == Opcode.ADJUST_RELBASE:
+                code.append(rng.randint(0, 5))
+            elif mode == RELATIVE:
+                code.append(rng.randrange(codeEnd, dataEnd))
+            elif k >= opcode.op.inputs():
+                if patchable and rng.random() < 0.2:
+                    code.append(rng.choice(patchable))
+                else:
+                    code.append(rng.randrange(codeEnd, dataEnd))
+            elif mode == POSITION:
+                code.append(rng.randrange(0, dataEnd))
+            else:
+                code.append(rng.randint(-10, 10))
+
+    code += [rng.randint(-10, 10) for _ in range(dataSize)]
+    code += [0] * (counters - len(code))
+    for _ in range(loops):
+        code += [rng.randint(1, 4), 0]
+    return code
+
+def paintingRobot(sim):
+    "q11: paint panels as directed, starting on a white panel"
+    painted = {(0, 0): 1}
+    state = {"pos": (0, 0), "facing": 0, "turning": False}
+    moves = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+
+    def handleInput():
+        return painted.get(state["pos"], 0)
+
+    def handleOutput(value):
+        if state["turning"]:
+            state["facing"] = (state["facing"] + (1 if value == 1 else -1)) % 4
+            dx, dy = moves[state["facing"]]
+            state["pos"] = (state["pos"][0] + dx, state["pos"][1] + dy)
+        else:
+            painted[state["pos"]] = value
+        state["turning"] = not state["turning"]
+
+    sim.inputFn = handleInput
+    sim.outputFn = handleOutput
+
+def arcadeGame(sim, moves=None):
+    "q13: play for free, moving the bat towards the ball (for at most `moves` inputs)"
+    state = {"args": [], "ball": 0, "bat": 0, "moves": 0}
+
+    def handleOutput(value):
+        state["args"].append(value)
+        if len(state["args"]) == 3:
+            x, _, tile = state["args"]
+            state["args"] = []
+            if tile == 3:
+                state["bat"] = x
+            elif tile == 4:
+                state["ball"] = x
+
+    def handleInput():
+        state["moves"] += 1
+        if moves is not None and state["moves"] > moves:
+            return None
+        return (state["ball"] > state["bat"]) - (state["ball"] < state["bat"])
+
+    sim.setMemory(0, 2)
+    sim.inputFn = handleInput
+    sim.outputFn = handleOutput
+
+def repairDroid(sim, moves=2000, seed=15):
+    "q15: wander the maze with `moves` pseudo-random movement commands"
+    rng = random.Random(seed)
+    remaining = [moves]
+
+    def handleInput():
+        remaining[0] -= 1
+        return rng.randint(1, 4) if remaining[0] >= 0 else None
+
+    sim.inputFn = handleInput
+
+def vacuumRobot(sim, video='n'):
+    "q17: wake the robot and send it the movement routines"
+    sim.setMemory(0, 2)
+    for line in ["B,A,A,B,C,B,B,C,A,C", "R,12,L,8,R,10", "R,8,L,12,R,8",
+                 "R,8,L,8,L,8,R,8,R,10", video]:
+        for char in line:
+            sim.queueInput(ord(char))
+        sim.queueInput(10)
+
+# Headless runs of each intcode puzzle: name -> (input file, setup function)
+WORKLOADS = {
+    "q02": ("inputs/q02", lambda sim: (sim.setMemory(1, 12), sim.setMemory(2, 2))),
+    "q05": ("inputs/q05", lambda sim: sim.queueInput(5)),
+    "q07": ("inputs/q07", lambda sim: sim.queueInput(9).queueInput(0)),
+    "q09": ("inputs/q09", lambda sim: sim.queueInput(2)),
+    "q11": ("inputs/q11", paintingRobot),
+    "q13": ("inputs/q13", arcadeGame),
+    "q15": ("inputs/q15", repairDroid),
+    "q17": ("inputs/q17", vacuumRobot),
+}
+
+
+class TestConformance(unittest.TestCase):
+    def test_examples(self):
+        compareEngines([1,1,1,4,99,5,6,0,99])
+        compareEngines([109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99])
+        compareEngines([1102,34915192,34915192,7,4,7,99,0])
+        code = "3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99"
+        for number in (7, 8, 9):
+            compareEngines(code, setup=lambda sim: sim.queueInput(number))
+
+    def test_regressions(self):
+        # Input written into a compiled block
+        code = [104,0, 3,1, 1001,20,-1,20, 1005,20,0, 99] + [0] * 8 + [3]
+        compareEngines(code, setup=lambda sim: sim.queuedInputs.extend([7, 8, 9]))
+
+        # Write to compiled code by the last instruction of a full-length block
+        code = [1101,3,0,500] + [1101,0,0,501] * 62 + [1101,7,0,1]
+        code += [4,500, 1001,600,-1,600, 1005,600,0, 99]
+        compareEngines(code + [0] * (600 - len(code)) + [2])
+
+    def test_errors(self):
+        self.assertEqual(traceEngine([42], "compiled")[-1].event, 'error')
+        compareEngines([42])
+        compareEngines([1101,1,1,5,99,-1])
+
+    def test_detects_mismatch(self):
+        def setup(sim):
+            # Only the engine under test sees a patched program
+            if sim.engine is not None:
+                sim.setMemory(1, 6)
+        with self.assertRaises(EngineMismatch):
+            compareEngines([104,5,99], ["reference", "compiled"], setup=setup)
+
+    def test_programs(self):
+        for name, (filename, setup) in WORKLOADS.items():
+            if name == "q09":
+                # Part 2 takes a while under the reference engine; part 1
+                # covers the same code.
+                setup = lambda sim: sim.queueInput(1)
+            elif name == "q13":
+                setup = lambda sim: arcadeGame(sim, moves=300)
+            with self.subTest(name):
+                compareEngines(IntcodeSim.fromFile(filename).arr, setup=setup)
+
+    def test_random_programs(self):
+        rng = random.Random(2019)
+        for _ in range(300):
+            code = randomProgram(rng)
+            inputs = [rng.randint(-10, 10) for _ in range(rng.randint(0, 8))]
+            compareEngines(code, setup=lambda sim: sim.queuedInputs.extend(inputs))
+
+    def test_sliced_random_programs(self):
+        "engines stop in the same state after every maxSteps slice"
+        rng = random.Random(2010)
+        for _ in range(100):
+            code = randomProgram(rng)
+            inputs = [rng.randint(-10, 10) for _ in range(8)]
+            slices = [rng.randint(1, 80) for _ in range(50)]
+            traces = {}
+            for engine in ENGINES:
+                sim = IntcodeSim(code, engine=engine)
+                sim.queuedInputs.extend(inputs)
+                trace = traces[engine] = []
+                for steps in slices:
+                    try:
+                        status = sim.runUntilIO(pauseOnOutput=False, maxSteps=steps)
+                    except ValueError as e:
+                        status = str(e)
+                    trace.append((status, sim.pos, sim.relativeBase, list(sim.arr), list(sim.outputs)))
+                    if status != Status.PREEMPTED:
+                        break
+            for engine, trace in traces.items():
+                self.assertEqual(trace, traces["reference"], engine)
+
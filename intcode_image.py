@@ -0,0 +1,186 @@
+"Binary cache of parsed intcode programs"
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+from glob import glob
+from time import perf_counter
+from intcode_memory import IntcodeMemory
+
+# Where parsed programs are stored; override with $INTCODE_CACHE
+CACHE_DIR = os.environ.get("INTCODE_CACHE",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), ".intcode_cache"))
+
+# Number of times report() times each load
+REPEATS = 5
+
+def parse(text):
+    """
+    Converts intcode text to a list of integers. Each line is a
+    comma-separated list, as read by IntcodeSim.fromFile.
+    """
+    return [int(x) for line in text.rstrip('\n').split('\n') for x in line.split(',')]
+
+class ProgramImage:
+    """
+    A parsed program, held as a read-only image that machines share: each
+    machine's memory views the image until it writes to a page, when it
+    copies just that page (see IntcodeMemory).
+
+    :attribute digest: SHA-256 of the program text
+    :attribute path: The cache file the image is mapped from, or None if the
+                     program couldn't be stored as 64-bit integers
+    :attribute length: Number of cells in the program
+    """
+    def __init__(self, digest, path, memory):
+        self.digest = digest
+        self.path = path
+        self.length = len(memory)
+        self.__memory = memory
+
+    def memory(self):
+        "Return a new copy-on-write IntcodeMemory holding the program"
+        return self.__memory.copy()
+
+# digest -> ProgramImage, for programs already loaded by this process
+_images = {}
+
+def _mapFile(path):
+    "memory-map the int64 image at path, read-only"
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array('q'))
+        # The mapping stays open after the file is closed
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast('q')
+
+def _store(path, image):
+    "write image to path, atomically, so readers never see part of a file"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.tofile(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load(filename, cacheDir=None):
+    """
+    Loads the intcode program in filename. The text is parsed the first time
+    a program is seen, and the result stored in cacheDir as an array of
+    64-bit integers named after the text's hash; later loads (in any
+    process) memory-map that file instead of parsing. Within a process, each
+    program is only loaded once.
+
+    :param cacheDir: Directory for cached images; defaults to CACHE_DIR
+    :return: ProgramImage
+    """
+    with open(filename, 'rb') as f:
+        text = f.read()
+    digest = hashlib.sha256(text).hexdigest()
+    image = _images.get(digest)
+    if image is not None:
+        return image
+
+    # The byte order is part of the name, in case the cache is shared
+    path = os.path.join(cacheDir or CACHE_DIR, f"{digest}-{sys.byteorder}.q")
+    if not os.path.exists(path):
+        code = parse(text.decode())
+        try:
+            _store(path, array('q', code))
+        except OverflowError:
+            # Values too big for 64 bits: keep the parsed program in this
+            # process only
+            image = _images[digest] = ProgramImage(digest, None, IntcodeMemory(code))
+            return image
+
+    image = _images[digest] = ProgramImage(digest, path, IntcodeMemory.fromImage(_mapFile(path)))
+    return image
+
+def report(pattern="inputs/q*"):
+    """
+    Prints the time taken to load each intcode file matching pattern: by
+    parsing the text, from a cold (empty) cache, and from a warm one. Each is
+    the best of REPEATS runs.
+    """
+    print(f"{'file':<16}{'cells':>8}{'parse':>12}{'cold':>12}{'warm':>12}")
+    with tempfile.TemporaryDirectory() as cacheDir:
+        for filename in sorted(glob(pattern)):
+            with open(filename) as f:
+                text = f.read()
+            try:
+                code = parse(text)
+            except ValueError:
+                continue
+            if ',' not in text:
+                # One number per line: not intcode
+                continue
+
+            parsed = cold = warm = float('inf')
+            for _ in range(REPEATS):
+                start = perf_counter()
+                IntcodeMemory(parse(text))
+                parsed = min(parsed, perf_counter() - start)
+
+                for cached in os.listdir(cacheDir):
+                    os.unlink(os.path.join(cacheDir, cached))
+                _images.clear()
+                start = perf_counter()
+                load(filename, cacheDir).memory()
+                cold = min(cold, perf_counter() - start)
+
+                # A new process has an empty in-process table, but finds the file
+                _images.clear()
+                start = perf_counter()
+                load(filename, cacheDir).memory()
+                warm = min(warm, perf_counter() - start)
+
+            print(f"{filename:<16}{len(code):>8}{parsed * 1e6:>10.0f}us{cold * 1e6:>10.0f}us{warm * 1e6:>10.0f}us")
+    _images.clear()
+
+
+class TestProgramImage(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        _images.clear()
+
+    def tearDown(self):
+        _images.clear()
+        shutil.rmtree(self.cacheDir)
+
+    def test_load(self):
+        image = load('inputs/q09', self.cacheDir)
+        with open('inputs/q09') as f:
+            code = parse(f.read())
+        self.assertEqual(image.memory(), code)
+        self.assertIs(load('inputs/q09', self.cacheDir), image)
+        self.assertEqual(os.listdir(self.cacheDir), [os.path.basename(image.path)])
+
+        # Another process would map the cached file rather than parse
+        _images.clear()
+        again = load('inputs/q09', self.cacheDir)
+        self.assertIsNot(again, image)
+        self.assertEqual(again.memory(), code)
+
+    def test_shared_image(self):
+        image = load('inputs/q09', self.cacheDir)
+        first, second = image.memory(), image.memory()
+        first[0] = -1
+        self.assertEqual(second[0], 1102)
+        self.assertEqual(image.memory()[0], 1102)
+
+    def test_big_numbers(self):
+        path = os.path.join(self.cacheDir, "big")
+        with open(path, 'w') as f:
+            f.write(f"104,{2 ** 70},99\n")
+        image = load(path, self.cacheDir)
+        self.assertIsNone(image.path)
+        self.assertEqual(image.memory(), [104, 2 ** 70, 99])
+
+if __name__ == "__main__":
+    report()
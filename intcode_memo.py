@@ -0,0 +1,335 @@
+"Runtime memoisation of pure intcode subroutines"
+import sys
+import unittest
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+from intcode import IntcodeSim, Instruction, Opcode, ParameterMode, DISPATCH
+from intcode_analysis import analyse
+
+# A call that executes more than this many instructions (not counting
+# memoised calls it makes) isn't memoised
+MAX_CALL_STEPS = 10 ** 6
+
+class Layouts(dict):
+    "Maps full opcodes to (opcode, input modes, output address mode or None)"
+    def __missing__(self, fullOpcode):
+        instruction = Instruction.decode([fullOpcode, 0, 0, 0], 0)
+        dest = instruction.dest()
+        layout = self[fullOpcode] = (instruction.opcode, tuple(instruction.modes[:instruction.opcode.op.inputs()]),
+                                     dest[0] if dest is not None else None)
+        return layout
+
+LAYOUTS = Layouts()
+
+@dataclass
+class Recording:
+    """
+    A call in progress, watched to see what it depends on and changes.
+
+    :param entry: Address of the function
+    :param base: The relative base when it was called: its frame starts here
+    :param returnAddress: Where the call returns to (rel[0] on entry)
+    :param inputs: Frame offset -> value, for each cell read (in RELATIVE
+                   mode) before the call wrote to it, in the order read. The
+                   return address isn't included when it's only read to
+                   return, so calls from different places can share results.
+    :param written: Addresses the call has written to
+    :param effects: ('rel', frame offset) or ('abs', address) -> value last
+                    written, in the order last written
+    :param steps: Number of instructions the call has executed, including
+                  those of memoised calls it made
+    :param executed: Number of instructions actually executed watching it
+    """
+    entry: int
+    base: int
+    returnAddress: int
+    steps: int = 0
+    executed: int = 0
+    inputs: Dict[int, int] = field(default_factory=dict)
+    written: set = field(default_factory=set)
+    effects: Dict[Tuple[str, int], int] = field(default_factory=dict)
+
+    def read(self, address, relative, value):
+        "note a read: returns False if it makes the call impure"
+        if address in self.written:
+            return True
+        if not relative:
+            # Memory outside the stack, that the call didn't write itself
+            return False
+        self.inputs.setdefault(address - self.base, value)
+        return True
+
+    def write(self, address, relative, value):
+        self.written.add(address)
+        key = ('rel', address - self.base) if relative else ('abs', address)
+        self.effects.pop(key, None)
+        self.effects[key] = value
+
+@dataclass
+class Result:
+    """
+    The outcome of a memoised call, which returns to its caller's return
+    address with the relative base restored.
+
+    :param effects: Recording.effects, as a tuple of items
+    :param steps: Number of instructions the call executed
+    """
+    effects: Tuple[Tuple[Tuple[str, int], int], ...]
+    steps: int
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    hits: int = 0
+    recorded: int = 0
+    impure: int = 0
+
+class MemoEngine:
+    """
+    Execution engine that memoises calls to pure subroutines. Functions are
+    found by static analysis (intcode_analysis): entry points of calls that
+    start with an ADJUST_RELBASE prologue. Each call to one is watched as it
+    runs. If it does no I/O and only reads the stack (RELATIVE mode) or
+    memory it wrote itself, its result is stored, keyed by the values of the
+    stack cells it read. The result is the memory it wrote, and where it
+    returned to. A later call from a frame holding the same values skips
+    straight to the result.
+
+    Calls are recognised by the compiler's convention: the caller leaves the
+    return address at rel[0], and the call is over when execution reaches it
+    with the relative base restored.
+
+    Writes over instructions clear the stored results, and a function found
+    to be impure isn't watched again.
+
+    :attribute stats: Function entry -> CallStats
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        cfg = analyse(list(sim.arr))
+        self.entries = {entry for entry, function in cfg.functions.items()
+                        if function.frameSize and entry != cfg.entry}
+        self.code = cfg.codeCells()
+        # entry -> input offsets -> input values -> Result
+        self.memo = defaultdict(dict)
+        self.impure = set()
+        self.recordings = []
+        self.stats = defaultdict(CallStats)
+
+    def invalidate(self, address):
+        if address in self.code:
+            self.memo.clear()
+
+    def report(self):
+        "return a text summary of the calls seen"
+        lines = [f"{'function':>10}{'calls':>10}{'hits':>10}{'hit rate':>10}{'recorded':>10}{'impure':>8}"]
+        for entry, stats in sorted(self.stats.items()):
+            rate = stats.hits / stats.calls if stats.calls else 0
+            lines.append(f"{entry:>10}{stats.calls:>10}{stats.hits:>10}{rate:>10.1%}{stats.recorded:>10}{stats.impure:>8}")
+        return "\n".join(lines)
+
+    def __lookup(self, entry, base):
+        "return the stored Result for a call to entry with frame base, or None"
+        arr = self.sim.arr
+        for offsets, results in self.memo[entry].items():
+            result = results.get(tuple(arr[base + offset] for offset in offsets))
+            if result is not None:
+                return offsets, result
+        return None, None
+
+    def __replay(self, base, offsets, result):
+        "apply a stored Result to the machine, and to the calls being watched"
+        sim = self.sim
+        arr = sim.arr
+        returnAddress = arr[base]
+        for recording in self.recordings:
+            for offset in offsets:
+                recording.read(base + offset, True, arr[base + offset])
+        for (kind, where), value in result.effects:
+            address = base + where if kind == 'rel' else where
+            arr[address] = value
+            if address in self.code:
+                self.memo.clear()
+            for recording in self.recordings:
+                recording.write(address, kind == 'rel', value)
+        for recording in self.recordings:
+            recording.steps += result.steps
+        sim.pos = returnAddress
+        sim.relativeBase = base
+
+    def __abandon(self, recordings):
+        for recording in recordings:
+            self.impure.add(recording.entry)
+            self.stats[recording.entry].impure += 1
+        self.recordings = [recording for recording in self.recordings if recording not in recordings]
+
+    def __finish(self):
+        "store the results of the calls that have just returned"
+        sim = self.sim
+        while self.recordings:
+            recording = self.recordings[-1]
+            if sim.pos != recording.returnAddress or sim.relativeBase != recording.base:
+                break
+            self.recordings.pop()
+            if recording.entry in self.impure:
+                continue
+            result = Result(tuple(recording.effects.items()), recording.steps)
+            self.memo[recording.entry].setdefault(tuple(recording.inputs), {})[
+                tuple(recording.inputs.values())] = result
+            self.stats[recording.entry].recorded += 1
+
+    def run(self, maxSteps=None):
+        """
+        Execute until the program finishes, or maxSteps instructions have been
+        executed. Returns the number of instructions executed if maxSteps is set.
+        A memoised call counts as the instructions it executed when recorded.
+        """
+        sim = self.sim
+        arr = sim.arr
+        entries = self.entries
+        steps = 0
+        while not sim.finished and (maxSteps is None or steps < maxSteps):
+            pos = sim.pos
+            if pos in entries:
+                self.stats[pos].calls += 1
+            if pos in entries and pos not in self.impure:
+                base = sim.relativeBase
+                offsets, result = self.__lookup(pos, base)
+                if result is not None and (maxSteps is None or steps + result.steps <= maxSteps):
+                    self.stats[pos].hits += 1
+                    self.__replay(base, offsets, result)
+                    steps += result.steps
+                    self.__finish()
+                    continue
+                self.recordings.append(Recording(pos, base, arr[base]))
+
+            fullOpcode = arr[pos]
+            opcode, modes, destMode = LAYOUTS[fullOpcode]
+            relativeBase = sim.relativeBase
+            dest = None
+            if destMode is not None:
+                dest = arr[pos + len(modes) + 1]
+                if destMode == ParameterMode.RELATIVE:
+                    dest += relativeBase
+
+            recordings = self.recordings
+            if recordings:
+                if pos not in self.code:
+                    # Code static analysis missed: results depend on it too
+                    self.code.update(range(pos, pos + len(modes) + (dest is not None) + 1))
+                if opcode in (Opcode.INPUT, Opcode.OUTPUT):
+                    self.__abandon(list(recordings))
+                else:
+                    reads = []
+                    for i, mode in enumerate(modes):
+                        if mode != ParameterMode.IMMEDIATE:
+                            address = arr[pos + 1 + i]
+                            if mode == ParameterMode.RELATIVE:
+                                address += relativeBase
+                            reads.append((address, mode == ParameterMode.RELATIVE, arr[address]))
+                    # A jump to rel[0] from the frame a call started with is
+                    # its return (if taken, the call is over)
+                    returning = (opcode in (Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE)
+                                 and reads and reads[-1][0] == relativeBase and reads[-1][1])
+                    impure = [recording for recording in recordings
+                              if recording.executed >= MAX_CALL_STEPS
+                              or not all(recording.read(*read) for read in reads
+                                         if not (returning and recording.base == relativeBase
+                                                 and read is reads[-1]))]
+                    if impure:
+                        self.__abandon(impure)
+
+            DISPATCH[fullOpcode](sim)
+            steps += 1
+
+            if dest is not None:
+                if dest in self.code:
+                    self.memo.clear()
+                if self.recordings:
+                    relative = destMode == ParameterMode.RELATIVE
+                    value = arr[dest]
+                    for recording in self.recordings:
+                        recording.steps += 1
+                        recording.executed += 1
+                        recording.write(dest, relative, value)
+            else:
+                for recording in self.recordings:
+                    recording.steps += 1
+                    recording.executed += 1
+            if self.recordings:
+                self.__finish()
+        return steps if maxSteps is not None else None
+
+
+class TestMemo(unittest.TestCase):
+    # main calls fib(20) and outputs it. fib keeps its argument at rel[-1]
+    # and returns its result there
+    FIB = [109,1000, 21101,13,0,0, 21101,0,20,1, 1105,1,18,
+           204,1, 99, 0, 0,
+           # fib: if n < 2, return n
+           109,3, 22107,1,-2,-1, 1206,-1,57,
+           # fib(n - 1), returning to 38
+           21101,38,0,0, 21201,-2,-1,1, 1105,1,18,
+           # rel[-1] = fib(n - 1); fib(n - 2), returning to 53
+           21201,1,0,-1, 21101,53,0,0, 21201,-2,-2,1, 1105,1,18,
+           # rel[-2] = rel[-1] + fib(n - 2)
+           22201,-1,1,-2,
+           # return
+           109,-3, 2106,0,0]
+
+    def run_memo(self, code, inputs=()):
+        sim = IntcodeSim(code, engine=MemoEngine)
+        sim.queuedInputs.extend(inputs)
+        return sim.run()
+
+    def test_fib(self):
+        reference = IntcodeSim(self.FIB).run()
+        sim = self.run_memo(self.FIB)
+        self.assertEqual(reference.outputs, [6765])
+        self.assertEqual(sim.outputs, reference.outputs)
+        self.assertEqual(sim.arr, reference.arr)
+        stats = sim.engine.stats[18]
+        self.assertEqual(stats.calls, 39)
+        self.assertEqual(stats.hits, 18)
+
+    def test_q09(self):
+        reference = IntcodeSim.fromFile('inputs/q09').queueInput(2).run()
+        sim = IntcodeSim.fromFile('inputs/q09', engine=MemoEngine).queueInput(2).run()
+        self.assertEqual(sim.outputs, reference.outputs)
+        self.assertEqual(sim.arr, reference.arr)
+        stats = sim.engine.stats[922]
+        self.assertGreater(stats.hits, 0)
+        self.assertLess(stats.calls, 100)
+
+    def test_slices(self):
+        "memoised calls fit in a maxSteps budget"
+        code = list(self.FIB)
+        # fib(12)
+        code[8] = 12
+        reference = IntcodeSim(code)
+        sim = IntcodeSim(code, engine=MemoEngine)
+        while not reference.finished:
+            reference.runUntilIO(maxSteps=100)
+            sim.runUntilIO(maxSteps=100)
+            self.assertEqual((sim.pos, sim.relativeBase), (reference.pos, reference.relativeBase))
+        self.assertEqual(sim.arr, reference.arr)
+
+    def test_impure(self):
+        # f outputs its argument, so must run every time
+        code = [109,1000, 21101,13,0,0, 21101,0,7,1, 1105,1,26,
+                21101,24,0,0, 21101,0,7,1, 1105,1,26, 99, 0,
+                109,2, 204,-1, 109,-2, 2106,0,0]
+        sim = self.run_memo(code)
+        self.assertEqual(sim.outputs, [7, 7])
+        self.assertEqual(sim.engine.stats[26].hits, 0)
+        self.assertEqual(sim.engine.stats[26].impure, 1)
+
+if __name__ == "__main__":
+    # e.g. python intcode_memo.py inputs/q09 2
+    sim = IntcodeSim.fromFile(sys.argv[1], engine=MemoEngine)
+    for value in sys.argv[2:]:
+        sim.queueInput(int(value))
+    sim.run()
+    print(sim.outputs)
+    print(sim.engine.report())
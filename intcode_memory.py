@@ -1,17 +1,58 @@
-class IntcodeMemory(list):
+import unittest
+import tracemalloc
+from array import array
+
+# Memory is allocated in pages of 2 ** PAGE_BITS cells
+PAGE_BITS = 10
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+class IntcodeMemory:
     DEFAULT_VALUE = 0
 
     """
-    Subclass of list that defaults to a value of 0 and can extend to an
+    List-like intcode memory that defaults to a value of 0 and can extend to an
     infinite size. Negative values and slice access are forbidden.
+
+    Memory is stored in fixed-size pages, allocated on first write, so writing
+    to a high address only costs one page. The length is one more than the
+    highest address written, as if the memory were a list extended with
+    zeroes, and memory compares equal to lists with the same contents.
+
+    Pages are arrays of 64-bit integers. If a value too big for 64 bits is
+    written, its page is converted to a list of Python ints.
+
+    Copies share pages until one side writes to them: each memory keeps track
+    of the pages it owns, and copies any other page before writing to it.
+    Memory created with fromImage() starts with read-only pages viewing an
+    external buffer (such as a memory-mapped file), so it is never copied
+    unless written to.
     """
     def __init__(self, code=[]):
+        # Page number -> array('q') (or list, if promoted) of PAGE_SIZE cells
+        self.pages = {}
+        # The subset of pages that aren't shared, and can be written in place
+        self.owned = {}
+        self.length = 0
         # Initialse ourselves with code
-        self += code
+        self.extend(code)
 
-    def __fill(self, index):
-        "fill memory with zeroes up to index"
-        self += ([self.DEFAULT_VALUE] * (index - len(self) + 1))
+    def __own(self, number):
+        "return page number for writing, allocating or copying it if needed"
+        page = self.pages.get(number)
+        if page is None:
+            page = array('q', [self.DEFAULT_VALUE]) * PAGE_SIZE
+        elif isinstance(page, memoryview):
+            page = array('q', page)
+        else:
+            page = page[:]
+        self.pages[number] = self.owned[number] = page
+        return page
+
+    def __promote(self, number):
+        "convert page number to a list, so it can hold integers of any size"
+        page = self.pages[number] = self.owned[number] = list(self.pages[number])
+        return page
 
     def __setitem__(self, index, value):
         if isinstance(index, slice):
@@ -20,8 +61,15 @@ class IntcodeMemory(list):
         if index < 0:
             raise Exception("negative memory access")
 
-        self.__fill(index)
-        list.__setitem__(self, index, value)
+        page = self.owned.get(index >> PAGE_BITS)
+        if page is None:
+            page = self.__own(index >> PAGE_BITS)
+        try:
+            page[index & PAGE_MASK] = value
+        except OverflowError:
+            self.__promote(index >> PAGE_BITS)[index & PAGE_MASK] = value
+        if index >= self.length:
+            self.length = index + 1
 
     def __getitem__(self, index):
         if isinstance(index, slice):
@@ -30,23 +78,204 @@ class IntcodeMemory(list):
         if index < 0:
             raise Exception("negative memory access")
 
-        if index >= len(self):
+        page = self.pages.get(index >> PAGE_BITS)
+        if page is None:
             return self.DEFAULT_VALUE
-        else:
-            return list.__getitem__(self, index)
+        return page[index & PAGE_MASK]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for number in range((self.length + PAGE_MASK) >> PAGE_BITS):
+            page = self.pages.get(number)
+            cells = min(PAGE_SIZE, self.length - (number << PAGE_BITS))
+            if page is None:
+                yield from [self.DEFAULT_VALUE] * cells
+            else:
+                yield from page[:cells]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, IntcodeMemory)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def extend(self, values):
+        "append values after the highest address written"
+        index = self.length
+        for value in values:
+            self[index] = value
+            index += 1
 
     def __add__(self, other):
-        if isinstance(other, list):
-            r = self.copy()
-            r += other
-            return r
-        else:
-            return list.__add__(self, other)
+        r = self.copy()
+        r.extend(other)
+        return r
+
+    @classmethod
+    def fromImage(cls, image):
+        """
+        Create memory whose contents are the 64-bit integers in image, which
+        is shared rather than copied.
+
+        :param image: memoryview of format 'q'. It must stay valid while the
+                      memory (or any copy of it) is in use.
+        """
+        r = cls()
+        full = len(image) >> PAGE_BITS
+        for number in range(full):
+            r.pages[number] = image[number << PAGE_BITS:(number + 1) << PAGE_BITS]
+        # A partial last page is copied, so every page has PAGE_SIZE cells
+        tail = image[full << PAGE_BITS:]
+        if len(tail):
+            page = array('q')
+            page.frombytes(tail.tobytes())
+            page.extend(array('q', [cls.DEFAULT_VALUE]) * (PAGE_SIZE - len(tail)))
+            r.pages[full] = r.owned[full] = page
+        r.length = len(image)
+        return r
+
+    def changedPages(self, base):
+        """
+        Yield (number, cells) for each page whose contents differ from the
+        same page of base, a memory this one was copied from.
+        """
+        for number, page in self.pages.items():
+            original = base.pages.get(number)
+            if page is original:
+                continue
+            if original is None:
+                if any(page):
+                    yield number, list(page)
+            elif list(page) != list(original):
+                yield number, list(page)
+
+    def setPage(self, number, cells):
+        """
+        Overwrite page number with cells (at most PAGE_SIZE values, the rest
+        are zeroed). Doesn't change the length.
+        """
+        cells = list(cells) + [self.DEFAULT_VALUE] * (PAGE_SIZE - len(cells))
+        try:
+            page = array('q', cells)
+        except OverflowError:
+            page = cells
+        self.pages[number] = self.owned[number] = page
 
     def copy(self):
-        "Return a shallow copy of the list"
+        "Return a copy of the memory, sharing pages until either side writes"
         r = IntcodeMemory()
-        r += self
+        r.pages = self.pages.copy()
+        r.length = self.length
+        self.owned = {}
         return r
 
 
+class TestIntcodeMemory(unittest.TestCase):
+    def test_list_semantics(self):
+        mem = IntcodeMemory([1, 2, 3])
+        self.assertEqual(mem, [1, 2, 3])
+        self.assertEqual(mem[10], 0)
+        self.assertEqual(len(mem), 3)
+
+        mem[5] = 7
+        self.assertEqual(mem, [1, 2, 3, 0, 0, 7])
+        self.assertEqual(mem + [8], [1, 2, 3, 0, 0, 7, 8])
+        self.assertNotEqual(mem, [1, 2, 3])
+
+        with self.assertRaises(Exception):
+            mem[-1] = 1
+        with self.assertRaises(Exception):
+            mem[1:2]
+
+    def test_pages(self):
+        mem = IntcodeMemory(range(PAGE_SIZE + 1))
+        self.assertEqual(len(mem.pages), 2)
+        self.assertEqual(list(mem), list(range(PAGE_SIZE + 1)))
+
+        copy = mem.copy()
+        copy[PAGE_SIZE] = -1
+        self.assertEqual(mem[PAGE_SIZE], PAGE_SIZE)
+        self.assertEqual(copy[PAGE_SIZE], -1)
+
+    def test_big_numbers(self):
+        "values that don't fit in 64 bits promote their page to Python ints"
+        mem = IntcodeMemory([1, 2, 3])
+        mem[PAGE_SIZE] = 2 ** 63 - 1
+        self.assertIsInstance(mem.pages[1], array)
+
+        mem[2] = 2 ** 63
+        mem[PAGE_SIZE + 1] = -2 ** 64
+        self.assertEqual(mem, [1, 2, 2 ** 63] + [0] * (PAGE_SIZE - 3) + [2 ** 63 - 1, -2 ** 64])
+        self.assertIsInstance(mem.pages[0], list)
+        self.assertIsInstance(mem.pages[1], list)
+        self.assertEqual(mem.copy(), mem)
+
+    def test_copy_on_write(self):
+        mem = IntcodeMemory(range(2 * PAGE_SIZE))
+        copy = mem.copy()
+        self.assertIs(copy.pages[0], mem.pages[0])
+
+        mem[0] = -1
+        copy[PAGE_SIZE] = -2
+        self.assertEqual((mem[0], mem[PAGE_SIZE]), (-1, PAGE_SIZE))
+        self.assertEqual((copy[0], copy[PAGE_SIZE]), (0, -2))
+        # Each side copied the one page it wrote to
+        self.assertIsNot(copy.pages[0], mem.pages[0])
+        self.assertIsNot(copy.pages[1], mem.pages[1])
+
+        # Promotion doesn't affect the other copy
+        again = copy.copy()
+        again[1] = 2 ** 64
+        self.assertEqual(copy[1], 1)
+        self.assertIsInstance(copy.pages[0], array)
+
+    def test_image(self):
+        image = array('q', range(PAGE_SIZE + 3))
+        mem = IntcodeMemory.fromImage(memoryview(image))
+        self.assertEqual(mem, list(range(PAGE_SIZE + 3)))
+        self.assertIsInstance(mem.pages[0], memoryview)
+
+        # Writes copy the page, leaving the image alone
+        copy = mem.copy()
+        copy[0] = -1
+        mem[1] = 2 ** 64
+        self.assertEqual((mem[0], mem[1], copy[0], copy[1]), (0, 2 ** 64, -1, 1))
+        self.assertEqual(image[:2], array('q', [0, 1]))
+
+    def test_changed_pages(self):
+        base = IntcodeMemory(range(2 * PAGE_SIZE))
+        mem = base.copy()
+        mem[PAGE_SIZE] = PAGE_SIZE
+        mem[5 * PAGE_SIZE] = 0
+        self.assertEqual(list(mem.changedPages(base)), [])
+
+        mem[PAGE_SIZE + 1] = 2 ** 64
+        ((number, cells),) = mem.changedPages(base)
+        self.assertEqual((number, cells[1]), (1, 2 ** 64))
+
+        restored = base.copy()
+        restored.setPage(number, cells)
+        self.assertEqual(restored[PAGE_SIZE + 1], 2 ** 64)
+        self.assertEqual(restored[PAGE_SIZE + 2], PAGE_SIZE + 2)
+
+    def test_sparse_writes(self):
+        "writes up to address 10**9 only allocate the pages written to"
+        tracemalloc.start()
+        mem = IntcodeMemory([1, 2, 3])
+        for power in range(3, 10):
+            mem[10 ** power] = power
+            mem.copy()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertEqual(len(mem), 10 ** 9 + 1)
+        self.assertEqual(mem[10 ** 9], 9)
+        self.assertEqual(mem[10 ** 9 - 1], 0)
+        self.assertLessEqual(len(mem.pages), 8)
+        self.assertLess(peak, 1024 * 1024)
@@ -0,0 +1,170 @@
+"Execution profiler for IntcodeSim"
+import sys
+import unittest
+from collections import defaultdict
+from time import perf_counter
+from intcode import IntcodeSim, Opcode, ParameterMode, Pause, DISPATCH
+
+MODE_LETTERS = {ParameterMode.POSITION: "P", ParameterMode.IMMEDIATE: "I", ParameterMode.RELATIVE: "R"}
+
+def describe(fullOpcode):
+    "name an opcode and its parameter modes, e.g. 'MULTIPLY(P,I,P)'"
+    opcode, modes = IntcodeSim.parseOpcode(fullOpcode)
+    return f"{opcode.name}({','.join(MODE_LETTERS[mode] for mode in modes)})"
+
+class Profile:
+    """
+    Execution counts gathered by a ProfilingEngine.
+
+    :attribute addresses: Address -> number of instructions executed there
+    :attribute opcodes: Full opcode (with parameter modes) -> count
+    :attribute backEdges: (jump address, target) -> number of times a jump
+                          went backwards from one to the other
+    :attribute runs: List of (instructions, seconds) for each time the
+                     engine was run (i.e. each runUntilIO call)
+    """
+    def __init__(self):
+        self.addresses = defaultdict(int)
+        self.opcodes = defaultdict(int)
+        self.backEdges = defaultdict(int)
+        self.runs = []
+
+    def total(self):
+        "number of instructions executed"
+        return sum(self.opcodes.values())
+
+    def byOpcode(self):
+        "return Opcode -> count, ignoring parameter modes"
+        counts = defaultdict(int)
+        for fullOpcode, count in self.opcodes.items():
+            counts[Opcode(fullOpcode % 100)] += count
+        return counts
+
+    def loops(self):
+        """
+        Finds the program's loops from the jumps taken backwards: each is the
+        address range from the jump's target to the jump.
+
+        :return: List of (start, end, iterations, instructions executed in the
+                 range), most instructions first
+        """
+        loops = []
+        for (source, target), iterations in self.backEdges.items():
+            executed = sum(count for address, count in self.addresses.items()
+                           if target <= address <= source)
+            loops.append((target, source, iterations, executed))
+        return sorted(loops, key=lambda loop: -loop[3])
+
+    def report(self, top=10):
+        "return a text report of where the time went"
+        total = self.total() or 1
+        seconds = sum(elapsed for _, elapsed in self.runs)
+        lines = [f"{self.total()} instructions in {seconds:.3f}s over {len(self.runs)} runs"]
+
+        def table(title, rows):
+            lines.append("")
+            lines.append(title)
+            for label, count in rows:
+                lines.append(f"  {label:<32}{count:>12}{100 * count / total:>8.1f}%")
+
+        table("By opcode:", sorted(((opcode.name, count) for opcode, count in self.byOpcode().items()),
+                                   key=lambda row: -row[1]))
+        table("By opcode and parameter modes:",
+              [(describe(fullOpcode), count) for fullOpcode, count
+               in sorted(self.opcodes.items(), key=lambda item: -item[1])[:top]])
+        table("Hottest addresses:",
+              [(str(address), count) for address, count
+               in sorted(self.addresses.items(), key=lambda item: -item[1])[:top]])
+        table("Hot loops:",
+              [(f"{start}-{end} ({iterations} iterations)", executed)
+               for start, end, iterations, executed in self.loops()[:top]])
+        return "\n".join(lines)
+
+class ProfilingEngine:
+    """
+    Execution engine that runs the reference interpreter's handlers, counting
+    what it executes in a Profile. Only machines using this engine pay for
+    profiling; see IntcodeSim.startProfile().
+    """
+    def __init__(self, sim, profile=None):
+        self.sim = sim
+        self.profile = profile if profile is not None else Profile()
+
+    def invalidate(self, address):
+        pass
+
+    def run(self, maxSteps=None):
+        """
+        Execute until the program finishes, or maxSteps instructions have been
+        executed. Returns the number of instructions executed if maxSteps is set.
+        """
+        sim = self.sim
+        arr = sim.arr
+        addresses = self.profile.addresses
+        opcodes = self.profile.opcodes
+        backEdges = self.profile.backEdges
+        steps = 0
+        start = perf_counter()
+        try:
+            while not sim.finished and (maxSteps is None or steps < maxSteps):
+                pos = sim.pos
+                fullOpcode = arr[pos]
+                try:
+                    DISPATCH[fullOpcode](sim)
+                except Pause:
+                    # Output pauses once the instruction has run; waiting
+                    # for input pauses before it does
+                    if sim.pos != pos:
+                        steps += 1
+                        addresses[pos] += 1
+                        opcodes[fullOpcode] += 1
+                    raise
+                steps += 1
+                addresses[pos] += 1
+                opcodes[fullOpcode] += 1
+                if sim.pos < pos:
+                    backEdges[pos, sim.pos] += 1
+        finally:
+            self.profile.runs.append((steps, perf_counter() - start))
+        return steps if maxSteps is not None else None
+
+
+class TestProfile(unittest.TestCase):
+    def test_counts(self):
+        # Counts down from 3 before halting
+        sim = IntcodeSim([1001,9,-1,9, 1005,9,0, 99, 0, 3])
+        profile = sim.startProfile()
+        sim.run()
+        self.assertEqual(dict(profile.addresses), {0: 3, 4: 3, 7: 1})
+        self.assertEqual(dict(profile.opcodes), {1001: 3, 1005: 3, 99: 1})
+        self.assertEqual(profile.byOpcode()[Opcode.ADD], 3)
+        self.assertEqual(profile.loops(), [(0, 4, 2, 6)])
+        self.assertEqual(profile.total(), 7)
+
+    def test_io(self):
+        # Outputs each input doubled, until it reads a 0
+        sim = IntcodeSim([3,15, 1006,15,14, 102,2,15,16, 4,16, 1105,1,0, 99, 0,0])
+        profile = sim.startProfile()
+        sim.runUntilIO()
+        sim.queueInput(1).runUntilIO()
+        sim.queueInput(0).run()
+        self.assertEqual(profile.addresses[0], 2)
+        self.assertEqual(profile.addresses[9], 1)
+        self.assertEqual([steps for steps, _ in profile.runs], [0, 4, 4])
+
+    def test_report(self):
+        sim = IntcodeSim.fromFile('inputs/q09').queueInput(1)
+        profile = sim.startProfile()
+        sim.run()
+        report = profile.report(top=3)
+        self.assertIn("By opcode:", report)
+        self.assertIn("Hot loops:", report)
+
+if __name__ == "__main__":
+    # e.g. python intcode_profile.py inputs/q09 2
+    sim = IntcodeSim.fromFile(sys.argv[1])
+    for value in sys.argv[2:]:
+        sim.queueInput(int(value))
+    profile = sim.startProfile()
+    sim.run()
+    print(profile.report())
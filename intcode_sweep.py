@@ -0,0 +1,188 @@
+"Parallel parameter sweeps over an intcode program"
+import unittest
+from array import array
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from typing import Dict, List
+from intcode import IntcodeSim
+from intcode_memory import IntcodeMemory, PAGE_SIZE
+
+# Number of jobs sent to a worker at a time
+CHUNK_SIZE = 100
+
+@dataclass
+class Job:
+    """
+    One run of the program in a sweep.
+
+    :param patches: Memory address -> value, written before running
+    :param inputs: Values queued as input
+    """
+    patches: Dict[int, int] = field(default_factory=dict)
+    inputs: List[int] = field(default_factory=list)
+
+def firstCell(sim):
+    "result extractor returning the value at address 0"
+    return sim.arr[0]
+
+def allOutputs(sim):
+    "result extractor returning the list of outputs"
+    return sim.outputs
+
+# The program as loaded by each worker process; jobs fork from it
+_base = None
+# The shared memory block holding it, kept open for as long as the worker runs
+_block = None
+
+def _loadProgram(name, length, code, engine):
+    """
+    Worker initialiser: maps the program from the shared memory block called
+    name (or loads it from code, if the program wasn't shared). Its pages
+    are only copied into the worker when a job writes to them.
+    """
+    global _base, _block
+    if name is not None:
+        _block = shared_memory.SharedMemory(name=name)
+        code = IntcodeMemory.fromImage(_block.buf[:length * 8].cast('q'))
+    _base = IntcodeSim(code, engine=engine)
+
+def _runChunk(jobs, extract, stop):
+    """
+    Runs jobs in a worker, returning their results. Stops after the first
+    result matching stop.
+    """
+    results = []
+    for job in jobs:
+        sim = _base.fork()
+        for address, value in job.patches.items():
+            sim.setMemory(address, value)
+        sim.queuedInputs.extend(job.inputs)
+        # A program wanting more input than given is terminated
+        sim.inputFn = lambda: None
+        sim.run()
+        results.append(extract(sim))
+        if stop is not None and stop(results[-1]):
+            break
+    return results
+
+def sweep(code, jobs, extract=firstCell, stop=None, engine=None, workers=None,
+          chunkSize=CHUNK_SIZE):
+    """
+    Runs code once for each job, spread across a pool of worker processes.
+    The program is parsed once and placed in shared memory, which each worker
+    maps; every job then runs on a copy-on-write fork of it, so only the
+    pages a job writes to are copied.
+
+    extract and stop are sent to the workers, so must be picklable (i.e.
+    defined at module level, not lambdas).
+
+    :param code: intcode, as a list of ints or a comma-separated string
+    :param jobs: Iterable of Jobs
+    :param extract: Function called with each finished IntcodeSim, returning
+                    the job's result
+    :param stop: Optional function called with each result; if it returns
+                 true, no jobs after that one are run
+    :param engine: Execution engine name for the workers (see IntcodeSim)
+    :param workers: Number of worker processes; defaults to the CPU count
+    :param chunkSize: Number of jobs sent to a worker at a time
+    :return: List of results, in job order. If stop matched, the list ends
+             with the first matching result.
+    """
+    if isinstance(code, str):
+        code = IntcodeSim.split(code)
+    jobs = list(jobs)
+    chunks = [jobs[i:i + chunkSize] for i in range(0, len(jobs), chunkSize)]
+
+    try:
+        image = array('q', code)
+    except OverflowError:
+        # Too big for 64 bits: send the program to each worker instead
+        image = None
+
+    block = None
+    try:
+        if image is not None:
+            block = shared_memory.SharedMemory(create=True, size=max(1, len(image) * 8))
+            block.buf[:len(image) * 8] = image.tobytes()
+            initargs = (block.name, len(image), None, engine)
+        else:
+            initargs = (None, 0, code, engine)
+
+        with ProcessPoolExecutor(workers, initializer=_loadProgram, initargs=initargs) as pool:
+            futures = {pool.submit(_runChunk, chunk, extract, stop): i for i, chunk in enumerate(chunks)}
+            results = [None] * len(chunks)
+            # Index of the first chunk known to contain a match
+            matched = len(chunks)
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = futures[future]
+                    results[i] = future.result()
+                    if stop is not None and results[i] and stop(results[i][-1]):
+                        if i < matched:
+                            matched = i
+                            # Later chunks aren't needed; earlier ones are
+                            for other in list(pending):
+                                if futures[other] > i:
+                                    other.cancel()
+                                    pending.discard(other)
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    return [result for chunk in results[:matched + 1] if chunk is not None for result in chunk]
+
+
+def _isTarget(value):
+    return value == 19690720
+
+class TestSweep(unittest.TestCase):
+    def test_patches(self):
+        # Adds addresses 9 and 10 into 0
+        code = [1,9,10,0, 99, 0,0,0,0, 0,0]
+        jobs = [Job({9: a, 10: b}) for a in range(10) for b in range(10)]
+        results = sweep(code, jobs, workers=2, chunkSize=7)
+        self.assertEqual(results, [a + b for a in range(10) for b in range(10)])
+
+    def test_inputs(self):
+        jobs = [Job(inputs=[n]) for n in (7, 8, 9)]
+        code = "3,9,8,9,10,9,4,9,99,-1,8"
+        self.assertEqual(sweep(code, jobs, allOutputs, workers=2, chunkSize=1),
+                         [[0], [1], [0]])
+
+    def test_big_numbers(self):
+        # Outputs the large number in the middle of the program
+        code = [104, 2 ** 70, 99]
+        self.assertEqual(sweep(code, [Job()], allOutputs, workers=1), [[2 ** 70]])
+
+    def test_shared_image(self):
+        "workers run on the shared block, copying only the pages they write"
+        global _base, _block
+        # Writes 3 to address 0, in the first of four pages
+        image = array('q', [1101,1,2,0, 99] + [0] * (4 * PAGE_SIZE - 5))
+        block = shared_memory.SharedMemory(create=True, size=len(image) * 8)
+        try:
+            block.buf[:len(image) * 8] = image.tobytes()
+            _loadProgram(block.name, len(image), None, None)
+            sim = _base.fork()
+            self.assertEqual(sim.run().arr[0], 3)
+            self.assertEqual(_base.arr[0], 1101)
+            self.assertFalse(_base.arr.owned)
+            self.assertEqual(list(sim.arr.owned), [0])
+        finally:
+            # Drop the views of the block before closing it
+            sim = _base = None
+            _block.close()
+            _block = None
+            block.close()
+            block.unlink()
+
+    def test_stop(self):
+        code = IntcodeSim.fromFile('inputs/q02').arr
+        jobs = [Job({1: noun, 2: verb}) for noun in range(100) for verb in range(100)]
+        results = sweep(code, jobs, stop=_isTarget)
+        self.assertEqual(len(results), 98 * 100 + 20 + 1)
+        self.assertTrue(_isTarget(results[-1]))
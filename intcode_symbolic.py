@@ -0,0 +1,356 @@
+"Symbolic execution of intcode over patched memory cells"
+import unittest
+from collections import Counter, deque
+from itertools import product
+from intcode import IntcodeSim, Opcode, ParameterMode
+
+class Poly:
+    """
+    A polynomial with integer coefficients over named integer variables.
+
+    :attribute terms: Monomial -> coefficient, where a monomial is a sorted
+                      tuple of variable names (repeated for powers), and ()
+                      is the constant term
+    """
+    def __init__(self, terms):
+        self.terms = {monomial: c for monomial, c in terms.items() if c != 0}
+
+    @classmethod
+    def variable(cls, name):
+        return cls({(name,): 1})
+
+    @classmethod
+    def lift(cls, value):
+        "returns value as a Poly"
+        return value if isinstance(value, Poly) else cls({(): value})
+
+    def simplify(self):
+        "returns the polynomial as an int if it's constant, otherwise itself"
+        if not self.terms:
+            return 0
+        if list(self.terms) == [()]:
+            return self.terms[()]
+        return self
+
+    def __add__(self, other):
+        if isinstance(other, Unknown):
+            return NotImplemented
+        terms = Counter(self.terms)
+        terms.update(Poly.lift(other).terms)
+        return Poly(terms).simplify()
+
+    __radd__ = __add__
+
+    def __mul__(self, other):
+        if isinstance(other, Unknown):
+            return NotImplemented
+        terms = Counter()
+        for m1, c1 in self.terms.items():
+            for m2, c2 in Poly.lift(other).terms.items():
+                terms[tuple(sorted(m1 + m2))] += c1 * c2
+        return Poly(terms).simplify()
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        return isinstance(other, (Poly, int)) and self.terms == Poly.lift(other).terms
+
+    def __hash__(self):
+        return hash(frozenset(self.terms.items()))
+
+    def variables(self):
+        return {name for monomial in self.terms for name in monomial}
+
+    def split(self, name):
+        """
+        If the polynomial is linear in name, returns (a, b) such that it equals
+        a * name + b, with neither a nor b containing name. Otherwise None.
+        """
+        a, b = Counter(), Counter()
+        for monomial, c in self.terms.items():
+            count = monomial.count(name)
+            if count > 1:
+                return None
+            rest = tuple(v for v in monomial if v != name)
+            (a if count else b)[rest] += c
+        return Poly(a).simplify(), Poly(b).simplify()
+
+    def evaluate(self, values):
+        "returns the value of the polynomial, given a dict of variable values"
+        total = 0
+        for monomial, c in self.terms.items():
+            for name in monomial:
+                c *= values[name]
+            total += c
+        return total
+
+    def __repr__(self):
+        parts = []
+        for monomial, c in sorted(self.terms.items(), key=lambda t: (-len(t[0]), t[0])):
+            factors = [f"{name}^{n}" if n > 1 else name for name, n in sorted(Counter(monomial).items())]
+            if not factors:
+                parts.append(str(c))
+            elif c == 1:
+                parts.append("*".join(factors))
+            else:
+                parts.append("*".join([str(c)] + factors))
+        return " + ".join(parts).replace("+ -", "- ")
+
+class Unknown:
+    """
+    The value of a cell read through a symbolic address: it could be
+    anything. Arithmetic on it gives UNKNOWN; it's only an error (a
+    SymbolicBranch) if the program depends on it.
+    """
+    def __add__(self, other):
+        return self
+
+    __radd__ = __mul__ = __rmul__ = __add__
+
+    def __repr__(self):
+        return "?"
+
+UNKNOWN = Unknown()
+
+def evaluate(value, values):
+    "evaluates a Poly or int given a dict of variable values"
+    return value.evaluate(values) if isinstance(value, Poly) else value
+
+class SymbolicBranch(Exception):
+    "Raised when control flow, an address or an opcode depends on a symbolic value"
+
+class SymbolicSim:
+    """
+    Executes intcode where some memory cells (and inputs) are symbolic: Poly
+    values built from named variables. ADD and MULTIPLY build up polynomials,
+    while control flow stays concrete; anything that would need the value of
+    a symbolic expression (a comparison, jump, opcode or written address)
+    raises SymbolicBranch. Reading through a symbolic address gives UNKNOWN,
+    which is fine as long as nothing depends on the result.
+
+    :attribute arr: Memory, as a dict of address -> int or Poly
+    :attribute outputs: List of values output (ints or Polys)
+    """
+
+    def __init__(self, code, symbols=None):
+        """
+        :param code: intcode, as a list of ints or a comma-separated string.
+        :param symbols: Dict of address -> variable name for symbolic cells
+        """
+        if isinstance(code, str):
+            code = IntcodeSim.split(code)
+        self.arr = dict(enumerate(code))
+        for address, name in (symbols or {}).items():
+            self.arr[address] = Poly.variable(name)
+
+        self.pos = 0
+        self.relativeBase = 0
+        self.finished = False
+        self.queuedInputs = deque()
+        self.outputs = []
+
+    def queueInput(self, value):
+        "Queues an input value (an int or a Poly). Returns self, for chaining."
+        self.queuedInputs.append(value)
+        return self
+
+    def cell(self, address):
+        "Returns the value at address, as an int or Poly"
+        return self.arr.get(address, 0)
+
+    def __concrete(self, value, what):
+        if isinstance(value, (Poly, Unknown)):
+            raise SymbolicBranch(f"{what} at {self.pos} depends on {value}")
+        return value
+
+    def __address(self, raw, mode):
+        address = self.__concrete(raw, "address")
+        if mode == ParameterMode.RELATIVE:
+            address += self.relativeBase
+        if address < 0:
+            raise Exception("negative memory access")
+        return address
+
+    def __read(self, raw, mode):
+        "reads the cell addressed by a POSITION or RELATIVE argument"
+        if isinstance(raw, (Poly, Unknown)):
+            return UNKNOWN
+        return self.cell(self.__address(raw, mode))
+
+    def run(self, maxSteps=10 ** 6):
+        """
+        Execute the intcode until the program finishes.
+
+        :param maxSteps: Give up (raising RuntimeError) after this many steps
+        :return: Self, for chaining
+        """
+        for _ in range(maxSteps):
+            if self.finished:
+                return self
+            self.step()
+        raise RuntimeError(f"program still running after {maxSteps} steps")
+
+    def step(self):
+        "Execute one instruction"
+        pos = self.pos
+        opcode, modes = IntcodeSim.parseOpcode(self.__concrete(self.cell(pos), "opcode"))
+        args = [self.cell(pos + k) for k in range(1, opcode.op.args + 1)]
+        values = [
+            args[i] if mode == ParameterMode.IMMEDIATE else self.__read(args[i], mode)
+            for i, mode in enumerate(modes[:opcode.op.inputs()])
+        ]
+        nextPos = pos + opcode.op.args + 1
+        if opcode.op.posArgs:
+            if modes[-1] == ParameterMode.IMMEDIATE:
+                raise ValueError("output address arguments cannot be in immediate mode")
+            dest = self.__address(args[-1], modes[-1])
+
+        if opcode == Opcode.ADD:
+            self.arr[dest] = values[0] + values[1]
+        elif opcode == Opcode.MULTIPLY:
+            self.arr[dest] = values[0] * values[1]
+        elif opcode == Opcode.LESS_THAN:
+            a, b = (self.__concrete(v, "comparison") for v in values)
+            self.arr[dest] = 1 if a < b else 0
+        elif opcode == Opcode.EQUALS:
+            a, b = (self.__concrete(v, "comparison") for v in values)
+            self.arr[dest] = 1 if a == b else 0
+        elif opcode == Opcode.INPUT:
+            if not self.queuedInputs:
+                raise ValueError(f"no input queued for INPUT at {pos}")
+            self.arr[dest] = self.queuedInputs.popleft()
+        elif opcode == Opcode.OUTPUT:
+            self.outputs.append(values[0])
+        elif opcode in (Opcode.JUMP_IF_TRUE, Opcode.JUMP_IF_FALSE):
+            condition = self.__concrete(values[0], "jump")
+            if (condition != 0) == (opcode == Opcode.JUMP_IF_TRUE):
+                nextPos = self.__concrete(values[1], "jump target")
+        elif opcode == Opcode.ADJUST_RELBASE:
+            self.relativeBase += self.__concrete(values[0], "relative base")
+        elif opcode == Opcode.END:
+            self.finished = True
+        self.pos = nextPos
+
+def bruteForce(code, target, cells, resultCell=0):
+    """
+    Tries every combination of values for cells, returning the first (in
+    order) that leaves target in resultCell, or None.
+    """
+    base = IntcodeSim(code)
+    for values in product(*cells.values()):
+        sim = base.fork()
+        for address, value in zip(cells, values):
+            sim.setMemory(address, value)
+        if sim.run().arr[resultCell] == target:
+            return values
+    return None
+
+def solve(code, target, cells, resultCell=0, fallback=None):
+    """
+    Finds values for the given memory cells that leave target in resultCell
+    when the program is run, by running it once with the cells symbolic and
+    solving the resulting polynomial. Candidate combinations are tried in
+    order; for each combination of the other cells, a polynomial that is
+    linear in the last cell is solved for it directly.
+
+    If the program can't be run symbolically (see SymbolicBranch), falls back
+    to running every combination.
+
+    :param cells: Dict of address -> candidate values (e.g. a range)
+    :param fallback: Optional function, called with no arguments, to use
+                     instead of the built-in brute force search
+    :return: Tuple of values, in the order of cells, or None
+    """
+    names = {address: f"cell{address}" for address in cells}
+    try:
+        expression = SymbolicSim(code, names).run().cell(resultCell)
+        if isinstance(expression, Unknown) or (
+                isinstance(expression, Poly)
+                and any(isinstance(c, Unknown) for c in expression.terms.values())):
+            raise SymbolicBranch(f"cell {resultCell} depends on a symbolic address")
+    except SymbolicBranch:
+        return fallback() if fallback is not None else bruteForce(code, target, cells, resultCell)
+
+    *others, last = cells
+    split = expression.split(names[last]) if isinstance(expression, Poly) else (0, expression)
+    lastValues = cells[last]
+    for values in product(*(cells[address] for address in others)):
+        bound = {names[address]: value for address, value in zip(others, values)}
+        if split is None:
+            for value in lastValues:
+                bound[names[last]] = value
+                if evaluate(expression, bound) == target:
+                    return values + (value,)
+            continue
+
+        # target = a * last + b
+        a, b = (evaluate(part, bound) for part in split)
+        if a == 0:
+            if b == target and len(lastValues):
+                return values + (lastValues[0],)
+        elif (target - b) % a == 0 and (target - b) // a in lastValues:
+            return values + ((target - b) // a,)
+    return None
+
+
+class TestSymbolic(unittest.TestCase):
+    def test_poly(self):
+        x, y = Poly.variable("x"), Poly.variable("y")
+        p = (x + 2) * (y + 3) * x
+        self.assertEqual(p.evaluate({"x": 2, "y": 5}), 64)
+        self.assertEqual(repr(p), "x^2*y + 3*x^2 + 2*x*y + 6*x")
+        self.assertEqual(x + 1 + -1 * x, 1)
+        self.assertIsInstance(x * 0, int)
+        self.assertIsNone(p.split("x"))
+        self.assertEqual(p.split("y"), (x * x + 2 * x, 3 * x * x + 6 * x))
+
+    def test_q02_expression(self):
+        code = IntcodeSim.fromFile('inputs/q02').arr
+        expression = SymbolicSim(code, {1: "noun", 2: "verb"}).run().cell(0)
+        self.assertEqual(expression.variables(), {"noun", "verb"})
+        self.assertEqual(expression.evaluate({"noun": 12, "verb": 2}), 2782414)
+        # It's affine
+        self.assertTrue(all(len(monomial) <= 1 for monomial in expression.terms))
+
+    def test_solve_q02(self):
+        code = IntcodeSim.fromFile('inputs/q02').arr
+        self.assertEqual(solve(code, 19690720, {1: range(100), 2: range(100)}), (98, 20))
+        self.assertIsNone(solve(code, 1, {1: range(100), 2: range(100)}))
+
+    def test_nonlinear(self):
+        # arr[0] = arr[5] * arr[6]
+        code = [2,5,6,0,99,0,0]
+        self.assertEqual(solve(code, 12, {5: range(1, 7), 6: range(1, 7)}), (2, 6))
+        # arr[0] = arr[5] * arr[5]
+        code = [2,5,5,0,99,0]
+        self.assertEqual(solve(code, 49, {5: range(10)}), (7,))
+
+    def test_symbolic_outputs(self):
+        # Outputs input * 3 + 1
+        code = [3,13, 1002,13,3,13, 1001,13,1,13, 4,13, 99, 0]
+        sim = SymbolicSim(code).queueInput(Poly.variable("x")).run()
+        self.assertEqual(repr(sim.outputs[0]), "3*x + 1")
+
+    def test_unknown(self):
+        # Reads through symbolic address a into 0, which is then overwritten
+        code = [1,0,0,0, 1101,2,3,0, 99]
+        self.assertEqual(SymbolicSim(code, {1: "a"}).run().cell(0), 5)
+
+        # ... but is kept here, so solve has to try each value of a
+        code = [1,0,5,0, 99, 0]
+        self.assertIs(SymbolicSim(code, {1: "a"}).run().cell(0), UNKNOWN)
+        self.assertEqual(solve(code, 99, {1: range(5)}), (4,))
+
+        # ... or combined with a polynomial: arr[0] = b + arr[a]
+        code = [1,9,10,0, 99, 0,0,0,0,0, 5]
+        self.assertIs(SymbolicSim(code, {2: "a", 9: "b"}).run().cell(0), UNKNOWN)
+        self.assertEqual(solve(code, 7, {2: range(11), 9: range(10)}), (0, 6))
+
+    def test_branch_falls_back(self):
+        # arr[0] = arr[17] + arr[18]; if arr[0] == 7 then arr[0] = 100
+        code = [1,17,18,0, 1008,0,7,19, 1005,19,12, 99, 1101,100,0,0, 99, 0,0,0]
+        with self.assertRaises(SymbolicBranch):
+            SymbolicSim(code, {17: "a", 18: "b"}).run()
+        self.assertEqual(solve(code, 100, {17: range(10), 18: range(10)}), (0, 7))
+        self.assertEqual(solve(code, 100, {17: range(10), 18: range(10)}, fallback=lambda: "fallback"),
+                         "fallback")
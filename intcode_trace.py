@@ -0,0 +1,347 @@
+"Execution trace recorder and replay for IntcodeSim"
+import io
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from glob import escape, glob
+from typing import NamedTuple
+import intcode_checkpoint
+from intcode import IntcodeSim, Instruction, Opcode, ParameterMode, Pause, Status, DISPATCH
+
+MAGIC = b"INTTRACE"
+VERSION = 1
+
+# magic, version, capacity, number of instructions recorded
+HEADER = struct.Struct("<8sHQQ")
+# pos, fullOpcode, the three raw arguments, address written (-1 if none),
+# value written or output, relativeBase after, and pos after
+RECORD = struct.Struct("<9q")
+
+# Default number of instructions kept
+CAPACITY = 1 << 16
+
+# The trace is split into this many segments, with a checkpoint at the start
+# of each, so any recorded step can be replayed from a recent checkpoint
+SEGMENTS = 4
+
+# Recorded in place of values that don't fit in 64 bits
+OVERFLOW = -1 << 63
+
+class TraceRecord(NamedTuple):
+    """
+    One executed instruction.
+
+    :param step: Index of the instruction since tracing started
+    :param pos: Address of the instruction
+    :param fullOpcode: The integer opcode, including parameter modes
+    :param args: Raw value of the three cells following the opcode
+    :param address: Address written to, or -1 if none
+    :param value: Value written to address, or the value output
+    :param relativeBase: The relative base after the instruction
+    :param nextPos: The instruction pointer after the instruction
+    """
+    step: int
+    pos: int
+    fullOpcode: int
+    args: tuple
+    address: int
+    value: int
+    relativeBase: int
+    nextPos: int
+
+class Layouts(dict):
+    "Maps full opcodes to (opcode, number of arguments, mode of the output address)"
+    def __missing__(self, fullOpcode):
+        instruction = Instruction.decode([fullOpcode, 0, 0, 0], 0)
+        dest = instruction.dest()
+        layout = self[fullOpcode] = (instruction.opcode, len(instruction.args),
+                                     dest[0] if dest is not None else None)
+        return layout
+
+LAYOUTS = Layouts()
+
+class Trace:
+    """
+    Fixed-size ring buffer holding the last 'capacity' instructions executed,
+    either in memory or in a memory-mapped file, plus checkpoints (see
+    IntcodeSim.save) from which any recorded step can be reconstructed.
+
+    Memory and disk use are bounded however long the program runs: the
+    buffer itself, and at most SEGMENTS + 1 checkpoints, each holding the
+    memory pages the program has changed. (Values too big for 64 bits are
+    recorded as OVERFLOW, with an extra checkpoint after the instruction.)
+
+    :attribute capacity: Number of records kept
+    :attribute count: Number of instructions recorded since tracing started
+    """
+    def __init__(self, capacity=CAPACITY, path=None, program=None):
+        """
+        :param path: If set, the trace is kept in this file (and checkpoints in
+                     files next to it), which can be read back with open()
+        :param program: The memory the traced machine started with
+        """
+        self.capacity = capacity
+        self.path = path
+        self.program = program
+        self.count = 0
+        # step -> checkpoint bytes (or file name, if path is set)
+        self.snapshots = {}
+        self.segment = max(1, capacity // SEGMENTS)
+        size = HEADER.size + capacity * RECORD.size
+        if path is None:
+            self.buffer = bytearray(size)
+        else:
+            with open(path, 'wb+') as f:
+                f.truncate(size)
+                self.buffer = mmap.mmap(f.fileno(), size)
+        self.flush()
+
+    @classmethod
+    def open(cls, path, program=None):
+        """
+        Reads a trace recorded to path.
+
+        :param program: The program that was traced, as for IntcodeSim.load.
+                        Only needed if it wasn't loaded with fromFile().
+        """
+        trace = cls.__new__(cls)
+        with open(path, 'rb') as f:
+            trace.buffer = f.read()
+        magic, version, trace.capacity, trace.count = HEADER.unpack_from(trace.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} intcode trace")
+        trace.path = path
+        trace.program = program
+        trace.segment = max(1, trace.capacity // SEGMENTS)
+        trace.snapshots = {
+            int(name[len(path) + 1:-len(".checkpoint")]): name
+            for name in glob(escape(path) + ".*.checkpoint")
+        }
+        return trace
+
+    def flush(self):
+        "write the header, so the trace file is complete up to count"
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, self.capacity, self.count)
+
+    def close(self):
+        self.flush()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def oldest(self):
+        "the first step still held in the buffer"
+        return max(0, self.count - self.capacity)
+
+    def snapshot(self, sim):
+        "save a checkpoint of sim, as the state before step count"
+        f = io.BytesIO()
+        intcode_checkpoint.dump(sim, f)
+        if self.path is None:
+            self.snapshots[self.count] = f.getvalue()
+        else:
+            name = f"{self.path}.{self.count}.checkpoint"
+            with open(name, 'wb') as out:
+                out.write(f.getvalue())
+            self.snapshots[self.count] = name
+
+        # Only the newest checkpoint at or before the oldest record is needed
+        oldest = self.oldest()
+        base = max(step for step in self.snapshots if step <= oldest)
+        for step in [step for step in self.snapshots if step < base]:
+            if self.path is not None:
+                os.unlink(self.snapshots[step])
+            del self.snapshots[step]
+
+    def record(self, step):
+        "return the TraceRecord for step"
+        if not self.oldest() <= step < self.count:
+            raise IndexError(f"step {step} is not in the trace")
+        offset = HEADER.size + (step % self.capacity) * RECORD.size
+        pos, fullOpcode, a, b, c, address, value, relativeBase, nextPos = \
+            RECORD.unpack_from(self.buffer, offset)
+        return TraceRecord(step, pos, fullOpcode, (a, b, c), address, value, relativeBase, nextPos)
+
+    def records(self, start=None, stop=None):
+        "yield the TraceRecords from start to stop (defaulting to all of them)"
+        start = self.oldest() if start is None else start
+        stop = self.count if stop is None else stop
+        for step in range(start, stop):
+            yield self.record(step)
+
+    def stateAt(self, step):
+        """
+        Reconstructs the machine as it was just before step was executed (or
+        after the last instruction, if step is count), by restoring the latest
+        checkpoint before it and replaying the recorded writes.
+
+        The machine's outputs are those since the checkpoint, with
+        outputCursor set to the number before.
+
+        :return: An IntcodeSim
+        """
+        if not self.oldest() <= step <= self.count:
+            raise IndexError(f"step {step} is not in the trace")
+        base = max(s for s in self.snapshots if s <= step)
+        snapshot = self.snapshots[base]
+        if self.path is None:
+            sim = intcode_checkpoint.restore(IntcodeSim, io.BytesIO(snapshot), self.program)
+        else:
+            sim = intcode_checkpoint.load(IntcodeSim, snapshot, self.program)
+
+        for record in self.records(base, step):
+            opcode = LAYOUTS[record.fullOpcode][0]
+            if record.address >= 0:
+                sim.arr[record.address] = record.value
+            elif opcode == Opcode.OUTPUT:
+                sim.outputs.append(record.value)
+            sim.pos = record.nextPos
+            sim.relativeBase = record.relativeBase
+            if opcode == Opcode.INPUT:
+                # Inputs come from the queue first; None leaves no write
+                if sim.queuedInputs:
+                    sim.queuedInputs.popleft()
+                if record.address < 0:
+                    sim.finished = True
+            elif opcode == Opcode.END:
+                sim.finished = True
+        return sim
+
+class TracingEngine:
+    """
+    Execution engine that runs the reference interpreter's handlers, recording
+    each instruction in a Trace. Only machines using this engine pay for
+    tracing; see IntcodeSim.startTrace().
+    """
+    def __init__(self, sim, capacity=CAPACITY, path=None):
+        self.sim = sim
+        self.trace = Trace(capacity, path, sim.image)
+        self.trace.snapshot(sim)
+
+    def invalidate(self, address):
+        pass
+
+    def run(self, maxSteps=None):
+        """
+        Execute until the program finishes, or maxSteps instructions have been
+        executed. Returns the number of instructions executed if maxSteps is set.
+        """
+        sim = self.sim
+        trace = self.trace
+        arr = sim.arr
+        buffer = trace.buffer
+        capacity = trace.capacity
+        segment = trace.segment
+        pack = RECORD.pack_into
+        steps = 0
+        try:
+            while not sim.finished and (maxSteps is None or steps < maxSteps):
+                count = trace.count
+                if count % segment == 0 and count:
+                    trace.snapshot(sim)
+                pos = sim.pos
+                fullOpcode = arr[pos]
+                opcode, length, destMode = LAYOUTS[fullOpcode]
+                args = (arr[pos + 1], arr[pos + 2], arr[pos + 3])
+                address = -1
+                if destMode is not None:
+                    address = args[length - 1]
+                    if destMode == ParameterMode.RELATIVE:
+                        address += sim.relativeBase
+
+                pause = None
+                try:
+                    DISPATCH[fullOpcode](sim)
+                except Pause as exc:
+                    # Waiting for input: the instruction will be run again.
+                    # Pausing after output happens once it has completed.
+                    if sim.pos == pos:
+                        raise
+                    pause = exc
+                steps += 1
+
+                if opcode == Opcode.OUTPUT:
+                    value = sim.outputs[-1]
+                elif opcode == Opcode.INPUT and sim.finished:
+                    # Terminated by a None input: nothing was written
+                    address = value = -1
+                else:
+                    value = arr[address] if address >= 0 else 0
+
+                offset = HEADER.size + (count % capacity) * RECORD.size
+                trace.count = count + 1
+                try:
+                    pack(buffer, offset, pos, fullOpcode, *args, address, value, sim.relativeBase, sim.pos)
+                except struct.error:
+                    fields = (pos, fullOpcode, *args, address, value, sim.relativeBase, sim.pos)
+                    pack(buffer, offset, *(f if OVERFLOW <= f < -OVERFLOW else OVERFLOW for f in fields))
+                    # Replay can't recreate the value: start again after it
+                    trace.snapshot(sim)
+
+                if pause is not None:
+                    raise pause
+        finally:
+            trace.flush()
+        return steps if maxSteps is not None else None
+
+
+class TestTrace(unittest.TestCase):
+    def assertSameState(self, sim, reference):
+        self.assertEqual((sim.arr, sim.pos, sim.relativeBase, sim.finished),
+                         (reference.arr, reference.pos, reference.relativeBase, reference.finished))
+
+    def test_replay(self):
+        sim = IntcodeSim.fromFile('inputs/q09').queueInput(2)
+        trace = sim.startTrace(capacity=1000)
+        sim.run()
+        self.assertGreater(trace.count, 300000)
+        self.assertLessEqual(len(trace.snapshots), SEGMENTS + 1)
+        self.assertEqual(trace.record(trace.count - 1).fullOpcode, 99)
+        self.assertSameState(trace.stateAt(trace.count), sim)
+
+        step = trace.count - 600
+        reference = IntcodeSim.fromFile('inputs/q09').queueInput(2)
+        reference.runUntilIO(pauseOnOutput=False, maxSteps=step)
+        self.assertSameState(trace.stateAt(step), reference)
+        with self.assertRaises(IndexError):
+            trace.stateAt(trace.count - 1001)
+
+    def test_io(self):
+        # Outputs each input doubled, until it reads a 0
+        sim = IntcodeSim([3,15, 1006,15,14, 102,2,15,16, 4,16, 1105,1,0, 99, 0,0])
+        trace = sim.startTrace(capacity=8)
+        self.assertEqual(sim.runUntilIO(), Status.NEEDS_INPUT)
+        self.assertEqual(trace.count, 0)
+        sim.queueInput(21)
+        self.assertEqual(sim.runUntilIO(), Status.OUTPUT)
+        self.assertEqual(trace.record(trace.count - 1)[1:], (9, 4, (16, 1105, 1), -1, 42, 0, 11))
+
+        sim.queueInput(2 ** 70).queueInput(0).run()
+        self.assertEqual(sim.outputs, [42, 2 ** 71])
+        final = trace.stateAt(trace.count)
+        self.assertSameState(final, sim)
+        self.assertEqual(final.outputCursor + len(final.outputs), 2)
+
+    def test_terminating_input(self):
+        # inputFn's None is queued when a checkpoint falls due
+        sim = IntcodeSim([1101,0,0,20, 3,21, 99])
+        sim.inputFn = lambda: None
+        trace = sim.startTrace(capacity=4)
+        sim.run()
+        self.assertTrue(sim.finished)
+        self.assertSameState(trace.stateAt(trace.count), sim)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace")
+            sim = IntcodeSim.fromFile('inputs/q09').queueInput(1)
+            sim.startTrace(capacity=100, path=path)
+            sim.run()
+            sim.engine.trace.close()
+            self.assertEqual(os.path.getsize(path), HEADER.size + 100 * RECORD.size)
+
+            trace = Trace.open(path)
+            self.assertEqual(trace.count, sim.engine.trace.count)
+            self.assertSameState(trace.stateAt(trace.count), sim)
+            self.assertEqual(trace.stateAt(trace.count).outputs, sim.outputs)
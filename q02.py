@@ -1,8 +1,12 @@
 "Day 2 - 1202 Program Alarm"
 import intcode
+import operator
 import unittest
 import util
+from functools import partial
 from typing import Optional, Tuple
+from intcode_sweep import Job, sweep
+from intcode_symbolic import solve
 
 def part1(filename: str) -> int:
     """
@@ -23,19 +27,21 @@ def part2(filename: str, target_output: int) -> Optional[Tuple[int, int]]:
     """
     code = util.slurp(filename)
 
-    # The solution requires us to return 100 * noun + verb. Therefore it's a
-    # good bet that both noun and verb are positive and have a maximum of two
-    # digits.
-    for noun in range(100):
-        for verb in range(100):
-            i = intcode.IntcodeSim(code)
-            i.arr[1] = noun
-            i.arr[2] = verb
-            i.run()
-            if i.arr[0] == target_output:
-                return noun, verb
+    def search():
+        # The solution requires us to return 100 * noun + verb. Therefore it's a
+        # good bet that both noun and verb are positive and have a maximum of two
+        # digits.
+        jobs = [Job({1: noun, 2: verb}) for noun in range(100) for verb in range(100)]
+        results = sweep(code, jobs, stop=partial(operator.eq, target_output))
+        if results and results[-1] == target_output:
+            return divmod(len(results) - 1, 100)
+        return None
 
-    return None
+    # Running the program symbolically gives arr[0] as an expression in noun
+    # and verb, which can be solved directly; the sweep is only needed if that
+    # fails.
+    return solve(intcode.IntcodeSim.split(code), target_output,
+                 {1: range(100), 2: range(100)}, fallback=search)
 
 class TestQ2(unittest.TestCase):
     """
@@ -1,21 +1,24 @@
-import multiprocessing
+import asyncio
 import unittest
 from itertools import permutations
+import intcode_image
 from intcode import IntcodeSim
+from intcode_async import AsyncIntcodeSim
+from intcode_memory import IntcodeMemory
 
 def part1():
     """
     Open the Q7 input and calculate the max signal in serial mode
     """
-    code = open('inputs/q07', 'r').read().rstrip('\n')
-    print(findMaxSignalPart1(code))
+    code = intcode_image.load('inputs/q07').memory()
+    print(PrefixSearch(code, range(0,5)).search())
 
 def part2():
     """
     Open the Q7 input and calculate the max signal in feedback mode
     """
-    code = open('inputs/q07', 'r').read().rstrip('\n')
-    print(findMaxSignalPart2(code))
+    code = intcode_image.load('inputs/q07').memory()
+    print(PrefixSearch(code, range(5,10), feedback=True).search())
 
 def findMaxSignalPart1(code):
     return findMaxSignal(code, getSignal, range(0,5))
@@ -25,6 +28,11 @@ def findMaxSignalPart2(code):
 
 def findMaxSignal(code, getSignalFn, allowedPhaseSettings):
     """ find the maximum signal for all permutations of phase settings """
+    if isinstance(code, str):
+        code = IntcodeSim.split(code)
+    # Parse once: every amplifier shares the memory's pages until it writes
+    if not isinstance(code, IntcodeMemory):
+        code = IntcodeMemory(code)
     maxSignal = None
     maxSignalConfiguration = None
     for configuration in permutations(allowedPhaseSettings):
@@ -35,21 +43,6 @@ def findMaxSignal(code, getSignalFn, allowedPhaseSettings):
 
     return maxSignal, maxSignalConfiguration
 
-def worker(code, inQueue, outQueue):
-    """ amplifier worker function. accepts input from inQueue and sends output
-        to outQueue """
-    sim = IntcodeSim(code)
-    sim.inputFn = inQueue.get
-    sim.outputFn = outQueue.put
-    sim.run()
-
-def looperWorker(inQueue, outQueue, lastOutputValue):
-    """ send inQueue to outQueue, tracking the last value received """
-    while True:
-        val = inQueue.get()
-        lastOutputValue.value = val
-        outQueue.put(val)
-
 def getSignal(code, phaseSettings, feedback=False):
     """
     start 5 amplifiers running the controller software in series
@@ -64,59 +57,161 @@ def getSignal(code, phaseSettings, feedback=False):
     In feedback mode, E's output is not accepted immediately as the final
     result, but rather sent to A as input until all amplifiers have halted.
 
+    The amplifiers take turns in this thread: each runs until it needs
+    input it doesn't have, then its outputs are queued as the next one's
+    input.
+    """
+    amplifiers = [IntcodeSim(code).queueInput(phase) for phase in phaseSettings]
+    amplifiers[0].queueInput(0)
+    return runAmplifiers(amplifiers, feedback)[0]
+
+def runAmplifiers(amplifiers, feedback=False, signal=None):
+    """
+    Runs amplifiers in turn (see getSignal) until they have all halted.
+
+    :param signal: The last signal E output before this call, if any
+    :return: tuple of the last signal output by E, and the number of times an
+             amplifier was run (until it halted or needed input)
+    """
+    runs = 0
+    while not all(amplifier.finished for amplifier in amplifiers):
+        progress = False
+        for i, amplifier in enumerate(amplifiers):
+            if amplifier.finished:
+                continue
+            amplifier.runUntilIO(pauseOnOutput=False)
+            runs += 1
+            if amplifier.finished or amplifier.outputs:
+                progress = True
+
+            if i + 1 < len(amplifiers):
+                amplifiers[i + 1].queuedInputs.extend(amplifier.outputs)
+            elif amplifier.outputs:
+                signal = amplifier.outputs[-1]
+                if feedback:
+                    amplifiers[0].queuedInputs.extend(amplifier.outputs)
+            amplifier.outputs.clear()
+
+        if not progress:
+            raise RuntimeError("amplifiers are all waiting for input")
+
+    return signal, runs
+
+class PrefixSearch:
+    """
+    Finds the maximum signal for all permutations of phase settings, like
+    findMaxSignal, but walks the permutations as a tree, depth first, so
+    that the work for a shared prefix of phase settings is only done once.
+
+    In serial mode, amplifier outputs are cached by phase setting and input
+    signal. In feedback mode, the first pass through the amplifiers is
+    shared: each amplifier runs until it needs its second input, and the
+    suspended machines are forked for every permutation starting with them.
+
+    :attribute runs: Number of times an amplifier was run (until it halted
+                     or needed input)
     """
-    threads = []
-    queues = []
-
-    # Create the input queue for the first worker, which this thread
-    # will manage
-    firstQueue = multiprocessing.Queue(maxsize=1)
-    queues.append(firstQueue)
-
-    for i in range(5):
-        # Create a queue for passing input to the worker
-        queue = multiprocessing.Queue(maxsize=1)
-        queues.append(queue)
-
-        # Pass the previous queue for input, and the newly-created queue for
-        # output
-        p = multiprocessing.Process(target=worker, args=(code,queues[i],queue))
-        threads.append(p)
-        p.start()
-
-    # Send phase settings
-    for i in range(5):
-        queues[i].put(phaseSettings[i])
-
-    # Send input value for first amplifier
-    queues[0].put(0)
-
-    if feedback:
-        lastOutput = multiprocessing.Value('i', -1, lock=False)
-        # Create a new thread to repeatedly retrieve input from the output queue
-        # and pass it back onto the first amplifier
-        looper = multiprocessing.Process(target=looperWorker, args=(queues[-1], queues[0], lastOutput))
-        looper.start()
-
-        for thread in threads:
-            thread.join()
-        
-        looper.terminate()
-
-        return lastOutput.value
-    else :
-        # Retrieve output value from last amplifier
-        signal = queues[-1].get()
-
-        # At this point all amplifiers should be finished, but let's be polite
-        for thread in threads:
-            thread.join()
-
-        return signal
+
+    def __init__(self, code, allowedPhaseSettings, feedback=False):
+        if isinstance(code, str):
+            code = IntcodeSim.split(code)
+        if not isinstance(code, IntcodeMemory):
+            code = IntcodeMemory(code)
+        self.code = code
+        self.phases = tuple(allowedPhaseSettings)
+        self.feedback = feedback
+        self.runs = 0
+        # (phase, input signal) -> output signal, in serial mode
+        self.outputs = {}
+        self.best = (None, None)
+
+    def search(self):
+        """
+        :return: tuple of the maximum signal and the phase settings giving it
+        """
+        self.best = (None, None)
+        if self.feedback:
+            self.__searchFeedback((), [], [0])
+        else:
+            self.__searchSerial((), 0)
+        return self.best
+
+    def __record(self, signal, configuration):
+        if self.best[0] is None or self.best[0] < signal:
+            self.best = (signal, configuration)
+
+    def __searchSerial(self, prefix, signal):
+        if len(prefix) == len(self.phases):
+            self.__record(signal, prefix)
+            return
+
+        for phase in self.phases:
+            if phase in prefix:
+                continue
+            key = (phase, signal)
+            if key not in self.outputs:
+                amplifier = IntcodeSim(self.code).queueInput(phase).queueInput(signal)
+                amplifier.runUntilIO(pauseOnOutput=False)
+                self.runs += 1
+                self.outputs[key] = amplifier.outputs[-1]
+            self.__searchSerial(prefix + (phase,), self.outputs[key])
+
+    def __searchFeedback(self, prefix, amplifiers, signals):
+        """
+        :param amplifiers: Machines for the phases in prefix, suspended after
+                           the first pass
+        :param signals: Values output by the last of them in the first pass
+        """
+        if len(prefix) == len(self.phases):
+            # Other permutations share these machines: run copies
+            forks = [amplifier.fork() for amplifier in amplifiers]
+            forks[0].queuedInputs.extend(signals)
+            signal, runs = runAmplifiers(forks, feedback=True,
+                                         signal=signals[-1] if signals else None)
+            self.runs += runs
+            self.__record(signal, prefix)
+            return
+
+        for phase in self.phases:
+            if phase in prefix:
+                continue
+            amplifier = IntcodeSim(self.code).queueInput(phase)
+            amplifier.queuedInputs.extend(signals)
+            amplifier.runUntilIO(pauseOnOutput=False)
+            self.runs += 1
+            outputs, amplifier.outputs = amplifier.outputs, []
+            self.__searchFeedback(prefix + (phase,), amplifiers + [amplifier], outputs)
 
 def getSignalWithFeedback(code, phaseSettings):
     return getSignal(code, phaseSettings, feedback=True)
 
+async def amplify(code, phaseSettings, feedback=False):
+    """
+    Runs the amplifiers (as for getSignal) as AsyncIntcodeSims in the current
+    event loop, with each amplifier's output channel being the next one's
+    input channel. In feedback mode, E's output channel is A's input channel.
+    """
+    channels = [asyncio.Queue() for _ in phaseSettings]
+    amplifiers = []
+    for i, phase in enumerate(phaseSettings):
+        output = channels[(i + 1) % len(channels)] if feedback or i + 1 < len(channels) else None
+        amplifier = AsyncIntcodeSim(code, inputChannel=channels[i], outputChannel=output)
+        amplifier.queueInput(phase)
+        amplifiers.append(amplifier)
+
+    await channels[0].put(0)
+    await asyncio.gather(*(amplifier.runAsync() for amplifier in amplifiers))
+    return amplifiers[-1].outputs[-1]
+
+def getSignalAsync(code, phaseSettings, feedback=False):
+    """
+    getSignal, with the amplifiers running as asyncio tasks in one thread
+    """
+    return asyncio.run(amplify(code, phaseSettings, feedback))
+
+def getSignalWithFeedbackAsync(code, phaseSettings):
+    return getSignalAsync(code, phaseSettings, feedback=True)
+
 class TestQ7Part1(unittest.TestCase):
     def test_one(self):
         signal, sequence = findMaxSignalPart1("3,15,3,16,1002,16,10,16,1,16,15,15,4,15,99,0,0")
@@ -143,3 +238,52 @@ class TestQ7Part2(unittest.TestCase):
         signal, sequence = findMaxSignalPart2("3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10")
         self.assertEqual(signal, 18216)
         self.assertEqual(sequence, (9,7,8,5,6))
+
+    def test_input(self):
+        code = open('inputs/q07', 'r').read().rstrip('\n')
+        self.assertEqual(findMaxSignalPart2(code), (33660560, (7,5,9,6,8)))
+
+class TestPrefixSearch(unittest.TestCase):
+    def test_part1(self):
+        search = PrefixSearch("3,15,3,16,1002,16,10,16,1,16,15,15,4,15,99,0,0", range(0,5))
+        self.assertEqual(search.search(), (43210, (4,3,2,1,0)))
+        # One run per distinct (phase, signal) pair, not 5 per permutation
+        self.assertLess(search.runs, 5 * 120)
+
+    def test_feedback(self):
+        search = PrefixSearch("3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5",
+                              range(5,10), feedback=True)
+        self.assertEqual(search.search(), (139629729, (9,8,7,6,5)))
+
+        search = PrefixSearch("3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10",
+                              range(5,10), feedback=True)
+        self.assertEqual(search.search(), (18216, (9,7,8,5,6)))
+
+    def test_input(self):
+        code = open('inputs/q07', 'r').read().rstrip('\n')
+        self.assertEqual(PrefixSearch(code, range(0,5)).search(), findMaxSignalPart1(code))
+        self.assertEqual(PrefixSearch(code, range(5,10), feedback=True).search(),
+                         (33660560, (7,5,9,6,8)))
+
+class TestQ7Async(unittest.TestCase):
+    def test_part1(self):
+        signal, sequence = findMaxSignal("3,15,3,16,1002,16,10,16,1,16,15,15,4,15,99,0,0",
+                                         getSignalAsync, range(0,5))
+        self.assertEqual(signal, 43210)
+        self.assertEqual(sequence, (4,3,2,1,0))
+
+    def test_feedback(self):
+        signal, sequence = findMaxSignal("3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5",
+                                         getSignalWithFeedbackAsync, range(5,10))
+        self.assertEqual(signal, 139629729)
+        self.assertEqual(sequence, (9,8,7,6,5))
+
+        signal, sequence = findMaxSignal("3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10",
+                                         getSignalWithFeedbackAsync, range(5,10))
+        self.assertEqual(signal, 18216)
+        self.assertEqual(sequence, (9,7,8,5,6))
+
+    def test_input(self):
+        code = open('inputs/q07', 'r').read().rstrip('\n')
+        self.assertEqual(findMaxSignal(code, getSignalWithFeedbackAsync, range(5,10)),
+                         (33660560, (7,5,9,6,8)))
@@ -43,31 +43,27 @@ def handleInput():
     else:
         return Color.black.value
 
-def handleOutput(x):
+def handleOutput(record):
+    "paints the current panel, then turns and moves forward one panel"
     global pos
     global facing
-    if handleOutput.goingToTurn:
-        print(f"going to turn (x={x})")
-        newFacing = facing.value + (1 if x == 1 else -1)
-        newFacing = newFacing % len(Direction)
-        print(f"facing {facing} -> {Direction(newFacing)}")
-        facing = Direction(newFacing)
+    color, turn = record
+    print(f"going to paint (x={color})")
+    painted[pos] = Color(color)
 
-        # Move forward one panel
-        move = MOVEMENT[facing]
-        pos = (pos[0] + move[0], pos[1] + move[1])
-        print(f"pos now {pos} (move={move})")
+    print(f"going to turn (x={turn})")
+    newFacing = facing.value + (1 if turn == 1 else -1)
+    newFacing = newFacing % len(Direction)
+    print(f"facing {facing} -> {Direction(newFacing)}")
+    facing = Direction(newFacing)
 
-        # Next output is painting
-        handleOutput.goingToTurn = False
-    else:
-        print(f"going to paint (x={x})")
-        painted[pos] = Color(x)
-        handleOutput.goingToTurn = True
-handleOutput.goingToTurn = False
+    # Move forward one panel
+    move = MOVEMENT[facing]
+    pos = (pos[0] + move[0], pos[1] + move[1])
+    print(f"pos now {pos} (move={move})")
 
 i.inputFn = handleInput
-i.outputFn = handleOutput
+i.setOutputSink(handleOutput, arity=2)
 i.run()
 
 # Find out how many unique panels were painted (part1)
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from enum import Enum
 from intcode import IntcodeSim
 from typing import *
@@ -55,19 +55,12 @@ class Screen():
 
 def part1():
     screen = Screen()
-    state = []
-    def handleOutput(output: int):
-        nonlocal state
-        if len(state) < 3:
-            state.append(output)
-
-        if len(state) == 3:
-            x, y, tileNo = state
-            state = []
+    def handleOutput(tiles: List[Tuple[int, int, int]]):
+        for x, y, tileNo in tiles:
             screen.set(x, y, Tile(tileNo))
 
     i = IntcodeSim.fromFile("inputs/q13")
-    i.outputFn = handleOutput
+    i.setOutputSink(handleOutput, arity=3, batch=True)
     i.run()
     renderedScreen = screen.render()
     print(renderedScreen)
@@ -80,7 +73,6 @@ def part2():
 
     @dataclass
     class State():
-        args: List[int] = field(default_factory=list)
         score: int = 0
         step: int = 0
         ballX: Optional[int] = None
@@ -88,18 +80,13 @@ def part2():
 
     state = State()
 
-    def handleOutput(output: int) -> None:
-        if len(state.args) < 2:
-            # Record x,y co-ordinates for next call
-            state.args.append(output)
-            return
+    def handleOutput(tiles: List[Tuple[int, int, int]]) -> None:
+        "called with the (x, y, tile) updates made before each move"
+        for x, y, output in tiles:
+            if x == -1 and y == 0:
+                state.score = output
+                continue
 
-        x, y = state.args
-        state.args.clear()
-
-        if x == -1 and y == 0:
-            state.score = output
-        else:
             tile = Tile(output)
             screen.set(x, y, tile)
 
@@ -108,13 +95,13 @@ def part2():
                 state.batX = x
             elif tile == Tile.ball:
                 state.ballX = x
-
             state.step += 1
-            # Wait for the machine to output the whole screen once
-            # before we start rendering
-            if state.step > 900:
-                print(screen.render())
-                print("Score: " + str(state.score))
+
+        # Wait for the machine to output the whole screen once
+        # before we start rendering
+        if state.step > 900:
+            print(screen.render())
+            print("Score: " + str(state.score))
 
     def handleInput() -> int:
         return util.sign(state.ballX - state.batX)
@@ -123,7 +110,7 @@ def part2():
     # Set machine to 'play for free' mode
     i.setMemory(0, 2)
     i.inputFn = handleInput
-    i.outputFn = handleOutput
+    i.setOutputSink(handleOutput, arity=3, batch=True)
     i.run()
     print(f"finished with score: {state.score}")
 
@@ -64,35 +64,18 @@ program = intcode.IntcodeSim.fromFile("inputs/q17")
 assert program.arr[0] == 1
 program.setMemory(0, 2)
 
-# Send movement functions on start
-for function in [Movement, A, B, C]:
-    for char in function:
-        program.queueInput(ord(char))
-
-    program.queueInput(10)
-
-# Indicate if we want the video feed
-program.queueInput(ord('y')).queueInput(10)
+# Send movement functions on start, and ask for the video feed
+feed = program.ascii().sendLines(Movement, A, B, C, "y")
 
 def clearScreen():
     print(chr(27)+'[2j')
     print('\033c')
     print('\x1bc')
 
-buf = ""
-def handleOutput(char):
-    "handle screen rendering and final dust value"
-    global buf
-    if char == 10 and buf.endswith("\n"):
-        clearScreen()
-        print(buf)
-        buf = ""
-    elif char > 255:
-        print(f"Dust: {char}")
-    else:
-        buf += chr(char)
-
-program.outputFn = handleOutput
 clearScreen()
-program.run()
+for frame in feed.frames():
+    clearScreen()
+    print(frame)
+for dust in feed.values:
+    print(f"Dust: {dust}")
 print("finished")